@@ -0,0 +1,557 @@
+# Copyright 2015 SUSE Linux Products GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks for the hybrid backends on top of fakeldap and SQLite.
+
+They are run like the tests (copy this file next to test_backend_hybrid.py)::
+
+    python -m testtools.run keystone.tests.bench_hybrid
+
+Every benchmark builds a dataset whose size is set with these environment
+variables:
+
+    HYBRID_BENCH_LDAP_USERS    LDAP users (500)
+    HYBRID_BENCH_SQL_USERS     SQL users (50)
+    HYBRID_BENCH_PROJECTS      projects besides the default project (20)
+    HYBRID_BENCH_ASSIGNMENTS   role assignments of users on projects (200)
+    HYBRID_BENCH_MAP_ENTRIES   LDAP users in the user project map (500)
+
+TraceReplay replays a trace recorded with [ldap_hybrid] trace_file, set
+HYBRID_BENCH_TRACE to its path. The users, projects and roles the trace
+refers to are created first, then the calls are made by
+HYBRID_BENCH_CONCURRENCY threads (1 by default) as fast as possible.
+
+Every measurement is appended as a line of JSON to the file named by the
+HYBRID_BENCH_OUTPUT environment variable (bench_output.txt by default). It
+holds the throughput, the p50 and p99 latency in seconds, the CPU time per
+call in seconds, the peak memory of a single call in bytes and the dataset
+sizes. Set HYBRID_BENCH_LABEL to
+tell the results of different versions apart.
+
+"""
+
+import collections
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import six
+
+from keystone.assignment.backends import hybrid_json_assignment
+from keystone.common import driver_hints
+from keystone.common import hybrid_common
+from keystone import exception
+from keystone.identity.backends import hybrid_identity
+from keystone import tests
+from keystone.tests import test_backend_hybrid
+
+BENCH_OUTPUT = os.environ.get('HYBRID_BENCH_OUTPUT', 'bench_output.txt')
+BENCH_LABEL = os.environ.get('HYBRID_BENCH_LABEL')
+ITERATIONS = int(os.environ.get('HYBRID_BENCH_ITERATIONS', 200))
+MAP_SIZES = [int(size) for size in os.environ.get(
+    'HYBRID_BENCH_MAP_SIZES', '10000,100000,1000000').split(',')]
+LDAP_USERS = int(os.environ.get('HYBRID_BENCH_LDAP_USERS', 500))
+SQL_USERS = int(os.environ.get('HYBRID_BENCH_SQL_USERS', 50))
+PROJECTS = int(os.environ.get('HYBRID_BENCH_PROJECTS', 20))
+ASSIGNMENTS = int(os.environ.get('HYBRID_BENCH_ASSIGNMENTS', 200))
+MAP_ENTRIES = int(os.environ.get('HYBRID_BENCH_MAP_ENTRIES', 500))
+TRACE = os.environ.get('HYBRID_BENCH_TRACE')
+CONCURRENCY = int(os.environ.get('HYBRID_BENCH_CONCURRENCY', 1))
+
+
+def percentile(samples, percent):
+    samples = sorted(samples)
+    if not samples:
+        return 0.0
+    return samples[int(round(percent / 100.0 * (len(samples) - 1)))]
+
+
+def record(result):
+    result['label'] = BENCH_LABEL
+    result['python'] = platform.python_version()
+    result['time'] = time.time()
+    with open(BENCH_OUTPUT, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+    return result
+
+
+def cpu_time():
+    """User and system CPU seconds used by the process so far."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure_memory(func):
+    """Call func and return its result and the memory it allocated.
+
+    With tracemalloc this is the peak of the traced allocations during the
+    call, otherwise the growth of the maximum resident set size.
+
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            result = func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return result, peak
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = func()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result, (after - before) * 1024
+
+
+class BenchmarkTests(test_backend_hybrid.HybridTests):
+    """Builds the dataset and measures calls against it."""
+
+    def setUp(self):
+        super(BenchmarkTests, self).setUp()
+        self.password = uuid.uuid4().hex
+        self.ldap_user_ids = [self.create_ldap_user(password=self.password)
+                              for i in range(LDAP_USERS)]
+        self.sql_user_ids = [self.identity_api.create_user(
+            {'name': uuid.uuid4().hex,
+             'domain_id': test_backend_hybrid.DEFAULT_DOMAIN_ID,
+             'password': self.password, 'enabled': True})['id']
+            for i in range(SQL_USERS)]
+        self.projects = []
+        for i in range(PROJECTS):
+            project = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex,
+                       'domain_id': test_backend_hybrid.DEFAULT_DOMAIN_ID}
+            self.assignment_api.create_project(project['id'], project)
+            self.projects.append(project)
+        role = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex}
+        self.assignment_api.create_role(role['id'], role)
+        user_ids = self.ldap_user_ids + self.sql_user_ids
+        # every assignment is for a different user and project pair
+        for i in range(min(ASSIGNMENTS, len(user_ids) * PROJECTS)):
+            self.assignment_api.add_role_to_user_and_project(
+                user_ids[i % len(user_ids)],
+                self.projects[(i // len(user_ids)) % PROJECTS]['id'],
+                role['id'])
+
+    def measure(self, name, func, iterations=ITERATIONS, **params):
+        """Call func repeatedly and record its latency distribution.
+
+        func is called once more beforehand to measure its peak memory,
+        which also warms up the caches.
+
+        """
+        memory = measure_memory(lambda: func(0))[1]
+        samples = []
+        start = time.time()
+        cpu_start = cpu_time()
+        for i in range(iterations):
+            call_start = time.time()
+            func(i)
+            samples.append(time.time() - call_start)
+        elapsed = time.time() - start
+        cpu = cpu_time() - cpu_start
+        params.update({'ldap_users': LDAP_USERS,
+                       'sql_users': SQL_USERS,
+                       'projects': PROJECTS,
+                       'assignments': ASSIGNMENTS})
+        return record({'name': name,
+                       'iterations': iterations,
+                       'throughput': iterations / elapsed if elapsed else 0.0,
+                       'p50': percentile(samples, 50),
+                       'p99': percentile(samples, 99),
+                       'cpu_per_call': cpu / iterations,
+                       'peak_memory': memory,
+                       'params': params})
+
+    def cycle(self, items):
+        return lambda i: items[i % len(items)]
+
+
+class HybridBenchmark(BenchmarkTests):
+    def _bench_ldap_login(self, name):
+        driver = self.identity_api.driver
+        user_id = self.cycle(self.ldap_user_ids)
+
+        def login(i):
+            driver.authenticate(user_id(i), self.password)
+
+        return self.measure(name, login)
+
+    def test_ldap_login_uncached(self):
+        self.identity_api.driver.ldap_user_cache = hybrid_common.LRUCache(0, 0)
+        self._bench_ldap_login('authenticate_ldap_uncached')
+
+    def test_ldap_login_search_and_bind(self):
+        self.identity_api.driver.ldap_user_cache = hybrid_common.LRUCache(0, 0)
+        self.config_fixture.config(group='ldap_hybrid',
+                                   ldap_search_and_bind=True)
+        self._bench_ldap_login('authenticate_ldap_search_and_bind')
+
+    def test_ldap_login_cached(self):
+        self._bench_ldap_login('authenticate_ldap_cached')
+
+    def test_sql_login(self):
+        driver = self.identity_api.driver
+        user_id = self.cycle(self.sql_user_ids)
+        self.measure('authenticate_sql',
+                     lambda i: driver.authenticate(user_id(i), self.password))
+
+    def test_repeated_login(self):
+        users = (('sql', self.sql_user_ids[0]),
+                 ('ldap', self.ldap_user_ids[0]))
+        for auth_cache_size in (0, 1000):
+            # a driver of its own, set up like keystone would with the
+            # option
+            self.config_fixture.config(group='ldap_hybrid',
+                                       auth_cache_size=auth_cache_size)
+            driver = hybrid_identity.Identity()
+            for kind, user_id in users:
+                self.measure('authenticate_%s_repeated' % kind,
+                             lambda i: driver.authenticate(user_id,
+                                                           self.password),
+                             auth_cache_size=auth_cache_size)
+
+    def test_token_issue(self):
+        identity_driver = self.identity_api.driver
+        assignment_driver = self.assignment_api.driver
+        user_id = self.cycle(self.ldap_user_ids + self.sql_user_ids)
+
+        def issue_token(i):
+            # the driver calls keystone makes for a project scoped token
+            identity_driver.get_user(user_id(i))
+            assignment_driver.list_project_ids_for_user(
+                user_id(i), [], driver_hints.Hints())
+            identity_driver.get_user(user_id(i))
+            for k in range(3):
+                try:
+                    assignment_driver._get_metadata(
+                        user_id=user_id(i),
+                        tenant_id=assignment_driver.default_project_id)
+                except exception.MetadataNotFound:
+                    pass
+            identity_driver.get_user(user_id(i))
+
+        def issue_token_memoised(i):
+            with hybrid_common.request_scope():
+                issue_token(i)
+
+        self.measure('token_issue', issue_token)
+        self.measure('token_issue_memoised', issue_token_memoised)
+
+    def test_get_user(self):
+        driver = self.identity_api.driver
+        ldap_user_id = self.cycle(self.ldap_user_ids)
+        sql_user_id = self.cycle(self.sql_user_ids)
+        self.measure('get_user_ldap',
+                     lambda i: driver.get_user(ldap_user_id(i)))
+        self.measure('get_user_sql',
+                     lambda i: driver.get_user(sql_user_id(i)))
+
+    def test_list_users(self):
+        driver = self.identity_api.driver
+
+        def list_users(i):
+            driver.list_users(driver_hints.Hints())
+
+        def list_users_limit(i):
+            hints = driver_hints.Hints()
+            hints.set_limit(20)
+            driver.list_users(hints)
+
+        self.measure('list_users', list_users, iterations=ITERATIONS // 10)
+        self.measure('list_users_limit', list_users_limit, limit=20)
+
+    def test_get_metadata(self):
+        driver = self.assignment_api.driver
+        user_id = self.cycle(self.ldap_user_ids)
+        self.measure('get_metadata',
+                     lambda i: driver._get_metadata(
+                         user_id=user_id(i),
+                         tenant_id=driver.default_project_id))
+
+    def _metadata_pairs(self, users=50):
+        driver = self.assignment_api.driver
+        return [(user_id, driver.default_project_id)
+                for user_id in self.ldap_user_ids[:users]]
+
+    def test_metadata_per_call(self):
+        driver = self.assignment_api.driver
+        pairs = self._metadata_pairs()
+
+        def resolve(i):
+            driver.invalidate_ldap_user()
+            for user_id, project_id in pairs:
+                driver._get_metadata(user_id=user_id, tenant_id=project_id)
+
+        self.measure('get_metadata_per_call', resolve,
+                     iterations=ITERATIONS // 10, pairs=len(pairs))
+
+    def test_metadata_batch(self):
+        driver = self.assignment_api.driver
+        pairs = self._metadata_pairs()
+
+        def resolve(i):
+            driver.invalidate_ldap_user()
+            driver.get_metadata_batch(pairs)
+
+        self.measure('get_metadata_batch', resolve,
+                     iterations=ITERATIONS // 10, pairs=len(pairs))
+
+    def test_list_role_assignments(self):
+        driver = self.assignment_api.driver
+        user_id = self.cycle(self.ldap_user_ids)
+        self.measure('list_role_assignments',
+                     lambda i: driver.list_role_assignments(),
+                     iterations=ITERATIONS // 10)
+        self.measure('list_role_assignments_user',
+                     lambda i: driver.list_role_assignments(
+                         user_id=user_id(i)))
+
+    def test_list_project_ids_for_user(self):
+        driver = self.assignment_api.driver
+        user_id = self.cycle(self.ldap_user_ids + self.sql_user_ids)
+        self.measure('list_project_ids_for_user',
+                     lambda i: driver.list_project_ids_for_user(
+                         user_id(i), [], driver_hints.Hints()))
+
+
+class JsonAssignmentBenchmark(BenchmarkTests):
+    """The JSON assignment backend, with a user project map."""
+
+    def setUp(self):
+        super(JsonAssignmentBenchmark, self).setUp()
+        fd, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        names = [project['name'] for project in self.projects]
+        with os.fdopen(fd, 'w') as f:
+            # LDAP users are created with their id as name
+            json.dump(dict((user_id, [names[(i + k) % len(names)]
+                                      for k in range(i % 3 + 1)])
+                           for i, user_id in
+                           enumerate(self.ldap_user_ids[:MAP_ENTRIES])), f)
+        self.config_fixture.config(group='ldap_hybrid',
+                                   user_project_map=path)
+        self.driver = hybrid_json_assignment.Assignment()
+
+    def measure(self, name, func, iterations=ITERATIONS, **params):
+        params['map_entries'] = MAP_ENTRIES
+        return super(JsonAssignmentBenchmark, self).measure(
+            name, func, iterations, **params)
+
+    def test_get_metadata(self):
+        user_id = self.cycle(self.ldap_user_ids)
+        project = self.cycle(self.projects)
+
+        def get_metadata(i):
+            try:
+                self.driver._get_metadata(user_id=user_id(i),
+                                          tenant_id=project(i)['id'])
+            except exception.MetadataNotFound:
+                pass
+
+        self.measure('json_get_metadata', get_metadata)
+
+    def test_list_role_assignments(self):
+        self.measure('json_list_role_assignments',
+                     lambda i: self.driver.list_role_assignments(),
+                     iterations=ITERATIONS // 10)
+
+    def test_list_project_ids_for_user(self):
+        user_id = self.cycle(self.ldap_user_ids + self.sql_user_ids)
+        self.measure('json_list_project_ids_for_user',
+                     lambda i: self.driver.list_project_ids_for_user(
+                         user_id(i), [], driver_hints.Hints()))
+
+
+class TraceReplay(test_backend_hybrid.HybridTests):
+    """Replays a trace of driver calls against fakeldap and SQLite.
+
+    Users looked up by the identity driver which were only ever found in
+    SQL are created in SQL, all other users in LDAP. Every user gets the
+    same password, which stands in for the passwords left out of the trace.
+
+    """
+
+    def setUp(self):
+        if not TRACE:
+            self.skipTest('HYBRID_BENCH_TRACE is not set')
+        super(TraceReplay, self).setUp()
+        with open(TRACE) as f:
+            self.calls = [json.loads(line) for line in f if line.strip()]
+        self.password = uuid.uuid4().hex
+        self.create_dataset()
+
+    def create_dataset(self):
+        user_ids = set()
+        ldap_user_ids = set()
+        user_names = set()
+        project_ids = set()
+        role_ids = set()
+        for call in self.calls:
+            args = call['args']
+            if args.get('user_id'):
+                user_ids.add(args['user_id'])
+                if (call['driver'] != 'identity' or
+                        set(call['sources']) & set(['ldap', 'mirror'])):
+                    ldap_user_ids.add(args['user_id'])
+            if args.get('user_name'):
+                user_names.add(args['user_name'])
+            for name in ('tenant_id', 'project_id'):
+                if args.get(name):
+                    project_ids.add(args[name])
+            project_ids.update(args.get('project_ids') or ())
+            if args.get('role_id'):
+                role_ids.add(args['role_id'])
+            for user_id, project_id in args.get('pairs') or ():
+                user_ids.add(user_id)
+                ldap_user_ids.add(user_id)
+                project_ids.add(project_id)
+
+        identity_driver = self.identity_api.driver
+        for user_id in user_ids:
+            user = {'id': user_id, 'name': user_id, 'enabled': True,
+                    'password': self.password,
+                    'domain_id': test_backend_hybrid.DEFAULT_DOMAIN_ID}
+            if user_id in ldap_user_ids:
+                del user['domain_id']
+                identity_driver.ldap.create_user(user_id, user)
+            else:
+                identity_driver.create_user(user_id, user)
+        for name in user_names - user_ids:
+            user_id = uuid.uuid4().hex
+            identity_driver.ldap.create_user(
+                user_id, {'id': user_id, 'name': name, 'enabled': True,
+                          'password': self.password})
+        for project_id in project_ids:
+            self.assignment_api.create_project(
+                project_id,
+                {'id': project_id, 'name': project_id,
+                 'domain_id': test_backend_hybrid.DEFAULT_DOMAIN_ID})
+        for role_id in role_ids:
+            self.assignment_api.create_role(role_id, {'id': role_id,
+                                                      'name': role_id})
+
+    def replay_args(self, args):
+        replayed = {}
+        for name, value in args.items():
+            if value == '***':
+                value = self.password
+            elif isinstance(value, dict) and '__hints__' in value:
+                hints = driver_hints.Hints()
+                hints.filters = value['__hints__']['filters']
+                limit = value['__hints__']['limit']
+                if limit:
+                    hints.set_limit(limit['limit'])
+                value = hints
+            elif name == 'pairs':
+                value = [tuple(pair) for pair in value]
+            replayed[name] = value
+        return replayed
+
+    def test_replay(self):
+        drivers = {'identity': self.identity_api.driver,
+                   'assignment': self.assignment_api.driver}
+        calls = six.moves.queue.Queue()
+        for call in self.calls:
+            calls.put(call)
+        latencies = collections.defaultdict(list)
+        # calls which failed in the trace but not in the replay, or the
+        # other way round
+        mismatches = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    call = calls.get_nowait()
+                except six.moves.queue.Empty:
+                    return
+                method = getattr(drivers[call['driver']], call['method'])
+                args = self.replay_args(call['args'])
+                error = None
+                start = time.time()
+                try:
+                    method(**args)
+                except Exception as e:
+                    error = e.__class__.__name__
+                elapsed = time.time() - start
+                with lock:
+                    latencies[call['method']].append(elapsed)
+                    if error != call['error']:
+                        mismatches.append(call['method'])
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(CONCURRENCY)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        samples = [latency for method_latencies in latencies.values()
+                   for latency in method_latencies]
+        record({'name': 'trace_replay',
+                'iterations': len(samples),
+                'throughput': len(samples) / elapsed if elapsed else 0.0,
+                'p50': percentile(samples, 50),
+                'p99': percentile(samples, 99),
+                'mismatches': len(mismatches),
+                'methods': dict(
+                    (method, {'count': len(method_latencies),
+                              'p50': percentile(method_latencies, 50),
+                              'p99': percentile(method_latencies, 99)})
+                    for method, method_latencies in latencies.items()),
+                'params': {'trace': TRACE,
+                           'concurrency': CONCURRENCY}})
+
+
+class UserProjectMapBenchmark(tests.TestCase):
+    projects = 1000
+
+    def write_map(self, users):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            # a few projects per user, drawn from a fixed pool of projects
+            json.dump(dict(('user%d' % i,
+                            ['project%d' % ((i + k) % self.projects)
+                             for k in range(i % 3 + 1)])
+                           for i in range(users)), f)
+        return path
+
+    def resolve(self, names):
+        return dict((name, uuid.uuid5(uuid.NAMESPACE_DNS, name).hex)
+                    for name in names)
+
+    def test_load(self):
+        for users in MAP_SIZES:
+            path = self.write_map(users)
+            start = time.time()
+            usermap, memory = measure_memory(
+                lambda: hybrid_json_assignment.UserProjectMap(path,
+                                                              self.resolve))
+            record({'name': 'user_project_map_load',
+                    'seconds': time.time() - start,
+                    'memory': memory,
+                    'params': {'users': users, 'projects': self.projects}})
+            self.assertEqual(users, len(usermap))
@@ -16,11 +16,9 @@
 from oslo_config import cfg
 from keystone import config
 from keystone.assignment.backends import sql as sql_assign
-from keystone.assignment.role_backends import sql as sql_role
-from keystone.common import sql
+from keystone.common import hybrid_common
 from keystone.common import manager
 from keystone import exception
-from keystone.i18n import _
 from keystone.identity.backends import ldap as ldap_backend
 
 from oslo_log import log
@@ -46,124 +44,222 @@ CONF = config.CONF
 CONF.register_opts(hybrid_opts, 'ldap_hybrid')
 
 
-class Assignment(sql_assign.Assignment):
-    _default_roles = list()
-    _default_project = None
-
+class Assignment(hybrid_common.LdapUserAssignmentMixin,
+                 sql_assign.Assignment):
     def __init__(self, *args, **kwargs):
         super(Assignment, self).__init__(*args, **kwargs)
         self.ldap_user = ldap_backend.UserApi(CONF)
+        self.membership_cache = hybrid_common.membership_cache()
+        self.mirror = hybrid_common.directory_mirror(self.ldap_user)
         self.resource_driver = manager.load_driver(
             'keystone.resource', self.default_resource_driver())
+        self.defaults = hybrid_common.ResolvedDefaults(self.resource_driver)
+        hybrid_common.configure_metrics()
 
+    @hybrid_common.timed('assignment.get_metadata')
+    @hybrid_common.memoised('assignment.get_metadata')
     def _get_metadata(self, user_id=None, tenant_id=None,
                       domain_id=None, group_id=None, session=None):
+        if CONF.ldap_hybrid.trust_materialised_assignments:
+            return super(Assignment, self)._get_metadata(
+                user_id, tenant_id, domain_id, group_id, session)
         # We only want to apply 'default_roles' to users from LDAP, so
         # check if this is an LDAP User first
-        is_ldap = False
-        try:
-            self.ldap_user.get(user_id)
-        except exception.UserNotFound:
-            # Not an LDAP User
-            pass
-        else:
-            is_ldap = True
+        username = self._ldap_user_name(user_id)
 
         try:
             res = super(Assignment, self)._get_metadata(
                 user_id, tenant_id, domain_id, group_id, session)
         except exception.MetadataNotFound:
-            if self.default_project_id == tenant_id and is_ldap:
-                return {
-                    'roles': [
-                        {'id': role_id} for role_id in self.default_roles
-                    ]
-                }
-            else:
-                raise
-        else:
-            if is_ldap:
-                roles = res.get('roles', [])
-                res['roles'] = roles + [
-                    {'id': role_id} for role_id in self.default_roles
-                ]
-            return res
+            res = None
+        res = self._merge_default_roles(username, tenant_id, res)
+        if res is None:
+            raise exception.MetadataNotFound()
+        return res
+
+    def _merge_default_roles(self, username, tenant_id, res):
+        """Add the default roles to the SQL metadata of an assignment.
 
-    @property
-    def default_project(self):
-        if self._default_project is None:
-            self._default_project = self.resource_driver.get_project_by_name(
-                CONF.ldap_hybrid.default_project,
-                CONF.identity.default_domain_id)
-        return dict(self._default_project)
-
-    @property
-    def default_project_id(self):
-        return self.default_project['id']
-
-    @property
-    def default_roles(self):
-        if not self._default_roles:
-            with sql.transaction() as session:
-                query = session.query(sql_role.RoleTable)
-                query = query.filter(sql_role.RoleTable.name.in_(
-                    CONF.ldap_hybrid.default_roles))
-                role_refs = query.all()
-
-            if len(role_refs) != len(CONF.ldap_hybrid.default_roles):
-                raise exception.RoleNotFound(
-                    message=_('Could not find one or more roles: %s') %
-                    ', '.join(CONF.ldap_hybrid.default_roles))
-
-            self._default_roles = [role_ref.id for role_ref in role_refs]
-        return self._default_roles
+        ``username`` is None for non-LDAP users and ``res`` is None if there
+        is no assignment in SQL. Returns None if there is no metadata at
+        all.
 
+        """
+        if username is None:
+            return res
+        if res is None:
+            if self.default_project_id == tenant_id:
+                return {'roles': self.defaults.role_refs}
+            return None
+        roles = res.get('roles', [])
+        res['roles'] = roles + self.defaults.role_refs
+        return res
+
+    @hybrid_common.timed('assignment.list_role_assignments')
+    @hybrid_common.memoised('assignment.list_role_assignments',
+                            required='user_id')
     def list_role_assignments(self, role_id=None, user_id=None, group_ids=None,
                               domain_id=None, project_ids=None,
                               inherited_to_projects=None):
-        role_assignments = super(Assignment, self).list_role_assignments(
-            role_id=role_id, user_id=user_id, group_ids=group_ids,
-            domain_id=domain_id, project_ids=project_ids,
-            inherited_to_projects=inherited_to_projects)
+        def list_sql_assignments():
+            return super(Assignment, self).list_role_assignments(
+                role_id=role_id, user_id=user_id, group_ids=group_ids,
+                domain_id=domain_id, project_ids=project_ids,
+                inherited_to_projects=inherited_to_projects)
+
+        if not self._matches_default_assignments(
+                role_id, user_id, group_ids, domain_id, project_ids,
+                inherited_to_projects):
+            # None of the default assignments can pass the filters, so there
+            # is no need to enumerate the LDAP users at all
+            return list_sql_assignments()
+
+        # resolved before the LDAP users are fanned out, so that a failed
+        # lookup can't leave the background search behind
+        roles = [role for role in self.default_roles
+                 if role_id is None or role == role_id]
+        default_project_id = self.default_project_id
         if user_id:
-            ldap_users = [self.ldap_user.get_filtered(user_id)]
+            if self._ldap_user_name(user_id) is None:
+                return list_sql_assignments()
+            role_assignments = list_sql_assignments()
+            ldap_users = [(user_id, self._default_project_ids(
+                default_project_id,
+                hybrid_common.get_user_project_ids([user_id]).get(
+                    user_id, ())))]
+        elif project_ids and default_project_id not in project_ids:
+            # Only the LDAP users with a role on these projects in SQL get
+            # the default roles on them, so there is no need to go through
+            # all LDAP users
+            role_assignments = list_sql_assignments()
+            ldap_users = self._project_members(default_project_id,
+                                               project_ids)
         else:
-            ldap_users = self.ldap_user.get_all_filtered(None)
-        # This will be really slow for setups with lots of users, but there
-        # is not other way to achieve it currently
-        for user in ldap_users:
-            # Skip LDAP User if it already as an assignemt, else add the default
-            # assignment
-            if any(a for a in role_assignments if
-                   ('user_id'in a and a['user_id'] == user['id'])):
-                continue
-            else:
-                for role in self.default_roles:
+            # stream the LDAP users page by page instead of loading the
+            # whole directory into memory. With parallel_fanout they are
+            # fetched while SQL is being queried.
+            role_assignments, ldap_users = hybrid_common.fan_out(
+                list_sql_assignments,
+                lambda sql_result: self._iter_ldap_users_projects(
+                    default_project_id))
+            if role_assignments is None:
+                # SQL failed and partial results are fine
+                role_assignments = []
+
+        # Index the assignments which are in SQL already, so that checking
+        # each default assignment is a set lookup instead of a scan of all
+        # assignments
+        existing = set((a['user_id'], a['project_id'], a['role_id'])
+                       for a in role_assignments
+                       if 'user_id' in a and 'project_id' in a)
+        wanted = set(project_ids) if project_ids else None
+        for ldap_user_id, ldap_project_ids in ldap_users:
+            if wanted is not None:
+                ldap_project_ids = wanted.intersection(ldap_project_ids)
+            for project_id in ldap_project_ids:
+                for role in roles:
+                    if (ldap_user_id, project_id, role) in existing:
+                        continue
                     role_assignments.append({
                         'role_id': role,
-                        'project_id': self.default_project_id,
-                        'user_id': user['id']
+                        'project_id': project_id,
+                        'user_id': ldap_user_id
                     })
         return role_assignments
 
+    def _matches_default_assignments(self, role_id, user_id, group_ids,
+                                     domain_id, project_ids,
+                                     inherited_to_projects):
+        """Check if any default assignment can pass the given filters.
+
+        Default assignments are direct, non-inherited user assignments of the
+        default roles, see _default_project_ids() for their projects.
+
+        """
+        if CONF.ldap_hybrid.trust_materialised_assignments:
+            # they are in SQL already
+            return False
+        if domain_id or inherited_to_projects:
+            return False
+        if group_ids and not user_id:
+            return False
+        if role_id and role_id not in self.default_roles:
+            return False
+        return True
+
+    def _default_project_ids(self, default_project_id, sql_project_ids=()):
+        """Return the projects an LDAP user gets the default roles on.
+
+        These are the default project and the projects the user has a role
+        on in SQL, exactly those _get_metadata() adds the default roles for.
+
+        """
+        project_ids = set(sql_project_ids)
+        project_ids.add(default_project_id)
+        return project_ids
+
+    def _iter_ldap_users_projects(self, default_project_id):
+        """Yield (user id, default role project ids) of all LDAP users."""
+        sql_project_ids = hybrid_common.get_user_project_ids()
+        for user_id in hybrid_common.iter_read_through(
+                self.mirror, lambda: self.mirror.iter_user_ids(),
+                lambda: hybrid_common.iter_ldap_user_ids(self.ldap_user)):
+            yield user_id, self._default_project_ids(
+                default_project_id, sql_project_ids.get(user_id, ()))
+
+    def _project_members(self, default_project_id, project_ids):
+        """Return (user id, default role project ids) of project members.
+
+        The members are the LDAP users with a role on any of the projects
+        in SQL, which don't include the default project.
+
+        """
+        user_ids = hybrid_common.get_project_user_ids(project_ids)
+        ldap_user_ids = [user_id for user_id, name in
+                         self._ldap_user_names(user_ids).items()
+                         if name is not None]
+        if not ldap_user_ids:
+            return []
+        sql_project_ids = hybrid_common.get_user_project_ids(ldap_user_ids)
+        return [(user_id, self._default_project_ids(
+            default_project_id, sql_project_ids.get(user_id, ())))
+            for user_id in ldap_user_ids]
+
+    @hybrid_common.timed('assignment.list_project_ids_for_user')
+    @hybrid_common.memoised('assignment.list_project_ids_for_user')
     def list_project_ids_for_user(self, user_id, group_ids, hints):
         project_ids = super(Assignment, self).list_project_ids_for_user(
             user_id, group_ids, hints)
+        if CONF.ldap_hybrid.trust_materialised_assignments:
+            return project_ids
 
         # Make sure the default project is in the project list for the user
         # user_id
-        for project_id in project_ids:
-            if project_id == self.default_project_id:
-                return project_ids
+        if self.default_project_id in project_ids:
+            return project_ids
 
         # We only want to apply 'default_project' to users from LDAP, so
         # check if this is an LDAP User first
-        try:
-            self.ldap_user.get(user_id)
-        except exception.UserNotFound:
-            # Not an LDAP User
-            pass
-        else:
+        if self._ldap_user_name(user_id) is not None:
             project_ids.append(self.default_project_id)
 
         return project_ids
+
+    def iter_implicit_assignments(self, sql_project_ids):
+        """Yield (user id, project id, role id) of all default assignments.
+
+        These are what _get_metadata() adds: the default roles of every LDAP
+        user on the default project and on the projects in
+        ``sql_project_ids`` (a dict of sets by user id), the projects the
+        user has other roles on in SQL.
+
+        """
+        default_project_id = self.default_project_id
+        role_ids = self.default_roles
+        for user_id in hybrid_common.iter_read_through(
+                self.mirror, lambda: self.mirror.iter_user_ids(),
+                lambda: hybrid_common.iter_ldap_user_ids(self.ldap_user)):
+            for project_id in self._default_project_ids(
+                    default_project_id, sql_project_ids.get(user_id, ())):
+                for role_id in role_ids:
+                    yield user_id, project_id, role_id
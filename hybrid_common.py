@@ -0,0 +1,2017 @@
+# Copyright 2015 SUSE Linux Products GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Helpers shared by the hybrid Identity and Assignment backends"""
+
+import atexit
+import collections
+import contextlib
+import copy
+import datetime
+import functools
+import inspect
+import json
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from keystone.assignment.backends import sql as sql_assign
+from keystone.assignment.role_backends import sql as sql_role
+from keystone.common import driver_hints
+from keystone.common import sql
+from keystone import exception
+from keystone.i18n import _
+from keystone import notifications
+import ldap
+import ldap.filter
+from oslo_config import cfg
+from oslo_log import log
+import six
+import sqlalchemy
+
+CONF = cfg.CONF
+LOG = log.getLogger(__name__)
+
+common_opts = [
+    cfg.IntOpt('membership_cache_size',
+               default=10000,
+               help='Maximum number of users whose LDAP membership is '
+                    'cached by the hybrid assignment backends. Set to 0 '
+                    'to disable the cache.'),
+    cfg.IntOpt('membership_cache_ttl',
+               default=300,
+               help='Number of seconds a positive "is an LDAP user" '
+                    'lookup is cached.'),
+    cfg.IntOpt('membership_cache_negative_ttl',
+               default=60,
+               help='Number of seconds a negative "is an LDAP user" '
+                    'lookup (i.e. a SQL-only user) is cached.'),
+    cfg.IntOpt('defaults_ttl',
+               default=600,
+               help='Number of seconds the ids of the default project and '
+                    'roles are cached. Changes to projects and roles made '
+                    'through this keystone process take effect at once.'),
+    cfg.IntOpt('defaults_max_backoff',
+               default=60,
+               help='Maximum number of seconds to wait before looking up '
+                    'a default project or role again which could not be '
+                    'found.'),
+    cfg.IntOpt('ldap_page_size',
+               default=500,
+               help='Number of entries requested per page (RFC 2696 '
+                    'simple paged results) when the hybrid backends '
+                    'enumerate LDAP users. Set to 0 to disable paging for '
+                    'LDAP servers which don\'t support it; each '
+                    'enumeration is then a single search, subject to the '
+                    'size limit of the server.'),
+    cfg.BoolOpt('directory_mirror',
+                default=False,
+                help='Keep a copy of the LDAP users (id, name, enabled, '
+                     'email and DN) in SQL and serve LDAP user reads from '
+                     'it. The copy is kept up to date by the identity '
+                     'backend (see directory_sync_interval) or by the '
+                     'sync_directory command of hybrid_manage.py.'),
+    cfg.IntOpt('directory_sync_interval',
+               default=0,
+               help='Number of seconds between two incremental syncs of '
+                    'the directory mirror by a background thread of the '
+                    'identity backend. Set to 0 to sync only with '
+                    'hybrid_manage.py.'),
+    cfg.IntOpt('directory_full_sync_interval',
+               default=86400,
+               help='Number of seconds between two full syncs of the '
+                    'directory mirror, which also remove the users deleted '
+                    'from LDAP.'),
+    cfg.IntOpt('directory_max_staleness',
+               default=900,
+               help='Reads are served from the directory mirror as long as '
+                    'its last sync is at most this many seconds old. An '
+                    'older mirror is only used when LDAP fails.'),
+    cfg.BoolOpt('parallel_fanout',
+                default=False,
+                help='Query SQL and LDAP at the same time, in separate '
+                     'threads, when listing users and role assignments.'),
+    cfg.FloatOpt('fanout_sql_timeout',
+                 default=0,
+                 help='Seconds to wait for the SQL query of a parallel '
+                      'fan-out. Set to 0 to wait as long as it takes.'),
+    cfg.FloatOpt('fanout_ldap_timeout',
+                 default=0,
+                 help='Seconds to wait for the LDAP search of a parallel '
+                      'fan-out. Set to 0 to wait as long as it takes.'),
+    cfg.BoolOpt('fanout_partial_results',
+                default=False,
+                help='When the SQL or the LDAP half of a parallel fan-out '
+                     'fails or times out, return the results of the other '
+                     'half instead of an error.'),
+    cfg.IntOpt('ldap_breaker_threshold',
+               default=0,
+               help='Number of consecutive LDAP calls failing because the '
+                    'server is down or timed out after which LDAP is not '
+                    'called for ldap_breaker_reset_timeout seconds. '
+                    'Meanwhile LDAP user reads fail at once or are served '
+                    'from the directory mirror, and the assignment '
+                    'backends treat users whose membership is not cached '
+                    'as SQL users. Set to 0 to disable.'),
+    cfg.IntOpt('ldap_breaker_reset_timeout',
+               default=30,
+               help='Number of seconds the LDAP circuit breaker stays open '
+                    'before a single call is let through to check whether '
+                    'LDAP is back.'),
+    cfg.BoolOpt('trust_materialised_assignments',
+                default=False,
+                help='Read the default assignments of LDAP users from the '
+                     'SQL assignment table, where the '
+                     'materialise_assignments command of hybrid_manage.py '
+                     'wrote them, instead of adding them at runtime.'),
+    cfg.StrOpt('metrics_sink',
+               default='none',
+               choices=['none', 'registry', 'statsd'],
+               help='Where to send the call counts and timings of the '
+                    'hybrid backends: nowhere, an in-process registry '
+                    '(hybrid_common.METRICS.sink.snapshot()) or a statsd '
+                    'server.'),
+    cfg.StrOpt('metrics_statsd_host',
+               default='localhost',
+               help='Host of the statsd server.'),
+    cfg.IntOpt('metrics_statsd_port',
+               default=8125,
+               help='UDP port of the statsd server.'),
+    cfg.StrOpt('metrics_prefix',
+               default='keystone.hybrid',
+               help='Prefix of the metric names sent to statsd.'),
+    cfg.StrOpt('trace_file',
+               help='Append every call of the hybrid drivers to this file, '
+                    'with its arguments (passwords left out), duration and '
+                    'the backends it used, to be replayed by '
+                    'bench_hybrid.py.'),
+]
+
+CONF.register_opts(common_opts, 'ldap_hybrid')
+
+# Number of values in a single LDAP "or" filter or SQL "in" clause. SQLite
+# doesn't allow more than 999 variables per statement.
+BATCH_SIZE = 400
+
+# Returned by LRUCache.get() when a key is absent or expired, so that None
+# can be cached as a legitimate value.
+MISSING = object()
+
+
+class LRUCache(object):
+    """Bounded, thread-safe LRU cache with per-entry expiry.
+
+    Values are stored together with their expiry time. Entries are evicted
+    in least recently used order once ``maxsize`` is reached. A ``maxsize``
+    of 0 disables the cache: nothing is stored and every lookup misses.
+
+    """
+
+    def __init__(self, maxsize, ttl, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # hits and misses are counted as cache.<name>.hit/miss metrics
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            # expired entries are kept until they are evicted or replaced,
+            # for get_stale()
+            value, expires = self._data.get(key, (None, None))
+            if expires is None or expires < time.time():
+                self.misses += 1
+                if self.name:
+                    METRICS.incr('cache.%s.miss' % self.name)
+                return MISSING
+            # re-insert to mark the entry as most recently used
+            del self._data[key]
+            self._data[key] = (value, expires)
+            self.hits += 1
+            if self.name:
+                METRICS.incr('cache.%s.hit' % self.name)
+            return value
+
+    def get_stale(self, key):
+        """Return the value of ``key`` even if it expired.
+
+        Meant for answering while the source of the values is unavailable.
+        Doesn't count as a hit or a miss.
+
+        """
+        with self._lock:
+            return self._data.get(key, (MISSING, None))[0]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._data[key] = (value, time.time() + ttl)
+
+    def invalidate(self, key=None):
+        """Drop ``key`` from the cache, or everything if no key is given."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        return {'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class LatencyStats(object):
+    """Count and timing summary of an operation.
+
+    Keeps the totals plus a window of the most recent samples from which
+    percentiles are computed.
+
+    """
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self._samples.append(seconds)
+
+    def percentile(self, percent):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def stats(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99)}
+
+
+class RegistrySink(object):
+    """Keeps the metrics in memory, to be read with snapshot()."""
+
+    def __init__(self):
+        self._counters = collections.defaultdict(int)
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] += count
+
+    def timing(self, name, seconds):
+        try:
+            stats = self._timings[name]
+        except KeyError:
+            with self._lock:
+                stats = self._timings.setdefault(name, LatencyStats())
+        stats.record(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timings = dict(self._timings)
+        return {'counters': counters,
+                'timings': dict((name, stats.stats())
+                                for name, stats in timings.items())}
+
+
+class StatsdSink(object):
+    """Sends the metrics to a statsd server, without waiting for it."""
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix + '.' if prefix else ''
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, socket.gaierror):
+            # metrics must never fail a request
+            pass
+
+    def incr(self, name, count=1):
+        self._send('%s%s:%d|c' % (self.prefix, name, count))
+
+    def timing(self, name, seconds):
+        self._send('%s%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+
+class TraceRecorder(object):
+    """Writes the calls of the hybrid drivers to a file, as JSON lines.
+
+    Every line holds the driver, the method, its arguments by name, the
+    start time, the duration in seconds, the name of the exception raised
+    if any, and how often each backend was used by the call. Arguments and
+    dict entries named like passwords are replaced with "***".
+
+    """
+
+    SECRETS = frozenset(['password', 'original_password', 'new_password'])
+    REDACTED = '***'
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Close the file. Calls still in progress are not written."""
+        with self._lock:
+            self._file.close()
+
+    def describe(self, driver, method, arg_names, args, kwargs):
+        """Return the start of a trace entry, before the call is made."""
+        named = dict(zip(arg_names, args))
+        named.update(kwargs)
+        return {'driver': driver, 'method': method,
+                'args': dict((name, self._redact(name, value))
+                             for name, value in named.items())}
+
+    def _redact(self, name, value):
+        if name in self.SECRETS:
+            return self.REDACTED
+        if isinstance(value, driver_hints.Hints):
+            return {'__hints__': {'filters': self._redact(None,
+                                                          value.filters),
+                                  'limit': value.limit}}
+        if isinstance(value, dict):
+            return dict((key, self._redact(key, item))
+                        for key, item in value.items())
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return [self._redact(None, item) for item in value]
+        if value is None or isinstance(value, (bool, int, float) +
+                                       six.string_types):
+            return value
+        return repr(value)
+
+    def write(self, entry, start, elapsed, sources, error):
+        entry.update({'start': round(start, 6),
+                      'latency': round(elapsed, 6),
+                      'sources': sources,
+                      'error': error})
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line + '\n')
+            self._file.flush()
+
+
+# How often each backend was used by the traced call in progress
+_trace_local = threading.local()
+
+
+def _trace_source(name, count):
+    sources = getattr(_trace_local, 'sources', None)
+    if sources is None:
+        return
+    kind = name.split('.', 1)[0]
+    if kind in ('cache', 'memo'):
+        if not name.endswith('.hit'):
+            return
+    elif kind not in ('ldap', 'sql', 'mirror', 'json_map', 'breaker'):
+        return
+    sources[kind] += count
+
+
+class Metrics(object):
+    """Call counts and timings of the hybrid backends.
+
+    Without a sink every call is a no-op, so instrumenting the hot paths
+    costs next to nothing when metrics are disabled. With a trace recorder
+    the counts are also attributed to the traced call in progress.
+
+    """
+
+    def __init__(self):
+        self.sink = None
+        self.recorder = None
+
+    def incr(self, name, count=1):
+        if self.recorder is not None:
+            _trace_source(name, count)
+        if self.sink is not None:
+            self.sink.incr(name, count)
+
+    def timing(self, name, seconds):
+        if self.recorder is not None:
+            _trace_source(name, 1)
+        if self.sink is not None:
+            self.sink.timing(name, seconds)
+
+
+METRICS = Metrics()
+
+
+def configure_metrics():
+    """Set up METRICS according to [ldap_hybrid] metrics_sink.
+
+    Called by the hybrid drivers when they are loaded. An existing sink of
+    the right kind is kept, so that all drivers share one registry.
+
+    """
+    kind = CONF.ldap_hybrid.metrics_sink
+    if kind == 'registry':
+        if not isinstance(METRICS.sink, RegistrySink):
+            METRICS.sink = RegistrySink()
+    elif kind == 'statsd':
+        if not isinstance(METRICS.sink, StatsdSink):
+            METRICS.sink = StatsdSink(CONF.ldap_hybrid.metrics_statsd_host,
+                                      CONF.ldap_hybrid.metrics_statsd_port,
+                                      CONF.ldap_hybrid.metrics_prefix)
+    else:
+        METRICS.sink = None
+    trace_file = CONF.ldap_hybrid.trace_file
+    if not trace_file:
+        _replace_recorder(None)
+    elif METRICS.recorder is None or METRICS.recorder.path != trace_file:
+        _replace_recorder(TraceRecorder(trace_file))
+    if METRICS.sink is not None or METRICS.recorder is not None:
+        engine = sql.get_engine()
+        if not sqlalchemy.event.contains(engine, 'before_cursor_execute',
+                                         _before_sql_query):
+            sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                    _before_sql_query)
+            sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                                    _after_sql_query)
+
+
+def _replace_recorder(recorder):
+    """Make ``recorder`` the trace recorder, closing the previous one."""
+    previous = METRICS.recorder
+    METRICS.recorder = recorder
+    if previous is not None and previous is not recorder:
+        previous.close()
+
+
+atexit.register(_replace_recorder, None)
+
+
+def _before_sql_query(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('hybrid_query_start', []).append(time.time())
+
+
+def _after_sql_query(conn, cursor, statement, parameters, context,
+                     executemany):
+    starts = conn.info.get('hybrid_query_start')
+    if starts:
+        METRICS.timing('sql.query', time.time() - starts.pop())
+
+
+def _arg_names(func):
+    """Return the argument names of a method, without self."""
+    while hasattr(func, '__wrapped__'):
+        func = func.__wrapped__
+    try:
+        spec = inspect.getfullargspec(func)
+    except AttributeError:
+        spec = inspect.getargspec(func)
+    return spec.args[1:]
+
+
+def timed(name):
+    """Decorator recording the duration of every call as metric ``name``.
+
+    With a trace recorder, the call is also written to the trace, unless it
+    is made by another traced call.
+
+    """
+    driver = name.split('.', 1)[0]
+
+    def decorator(func):
+        arg_names = _arg_names(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = METRICS.recorder
+            if METRICS.sink is None and recorder is None:
+                return func(*args, **kwargs)
+            entry = None
+            if (recorder is not None and
+                    getattr(_trace_local, 'sources', None) is None):
+                entry = recorder.describe(driver, func.__name__, arg_names,
+                                          args[1:], kwargs)
+                _trace_local.sources = collections.defaultdict(int)
+            error = None
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = e.__class__.__name__
+                raise
+            finally:
+                elapsed = time.time() - start
+                METRICS.timing(name, elapsed)
+                if entry is not None:
+                    sources = dict(_trace_local.sources)
+                    _trace_local.sources = None
+                    recorder.write(entry, start, elapsed, sources, error)
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+# LDAP errors which mean that the server can't be used at the moment, as
+# opposed to errors about the request
+LDAP_OUTAGE_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT,
+                      ldap.TIMELIMIT_EXCEEDED, ldap.UNAVAILABLE, ldap.BUSY)
+
+
+class CircuitOpen(ldap.SERVER_DOWN):
+    """Raised instead of calling LDAP while the circuit breaker is open.
+
+    It is an LDAP error, so that the directory mirror stands in for LDAP
+    like it does when the server is down.
+
+    """
+
+
+class CircuitBreaker(object):
+    """Stop calling a backend which keeps failing.
+
+    After ``ldap_breaker_threshold`` consecutive failures the breaker opens
+    and calls fail at once with CircuitOpen, instead of each waiting for the
+    backend to time out. After ``ldap_breaker_reset_timeout`` seconds one
+    call is let through as a probe (half-open): the breaker closes if it
+    succeeds and stays open for another timeout if it fails. Any answer of
+    the backend, including errors other than ``errors``, is a success.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, errors):
+        self.name = name
+        self.errors = errors
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            # when the breaker opened, or when the last probe was let
+            # through
+            self._opened_at = 0
+
+    def _allow(self):
+        if CONF.ldap_hybrid.ldap_breaker_threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            # a probe which never reported back doesn't block the breaker
+            # for good, another one is let through after the timeout
+            if (now - self._opened_at >=
+                    CONF.ldap_hybrid.ldap_breaker_reset_timeout):
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+        METRICS.incr('breaker.%s.rejected' % self.name)
+        return False
+
+    def _success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                LOG.info('%s answers again, closing the circuit breaker',
+                         self.name)
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def _failure(self):
+        threshold = CONF.ldap_hybrid.ldap_breaker_threshold
+        if threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self._failures >= threshold)):
+                if self.state == self.CLOSED:
+                    LOG.warning('%(name)s failed %(count)d times in a row, '
+                                'opening the circuit breaker',
+                                {'name': self.name, 'count': self._failures})
+                    METRICS.incr('breaker.%s.open' % self.name)
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+    def _rejected(self):
+        return CircuitOpen({'desc': 'The circuit breaker of %s is open' %
+                            self.name})
+
+    def call(self, func, *args, **kwargs):
+        if not self._allow():
+            raise self._rejected()
+        try:
+            result = func(*args, **kwargs)
+        except CircuitOpen:
+            raise
+        except self.errors:
+            self._failure()
+            raise
+        except Exception:
+            self._success()
+            raise
+        self._success()
+        return result
+
+    def iterate(self, func):
+        """Like call(), for a function returning a generator.
+
+        The backend counts as answering once the first item arrives.
+
+        """
+        if not self._allow():
+            raise self._rejected()
+        answered = False
+        try:
+            for item in func():
+                if not answered:
+                    answered = True
+                    self._success()
+                yield item
+        except CircuitOpen:
+            raise
+        except self.errors:
+            self._failure()
+            raise
+        if not answered:
+            self._success()
+
+
+LDAP_BREAKER = CircuitBreaker('ldap', LDAP_OUTAGE_ERRORS)
+
+
+# Holds the RequestMemo of the current request. Under eventlet, keystone
+# monkey patches threading, so this is local to the green thread.
+_request_local = threading.local()
+
+
+class RequestMemo(object):
+    """Results of the backend lookups made during one request."""
+
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+
+@contextlib.contextmanager
+def request_scope():
+    """Memoise the lookups made in the block, see memoised()."""
+    previous = getattr(_request_local, 'memo', None)
+    _request_local.memo = RequestMemo()
+    try:
+        yield _request_local.memo
+    finally:
+        _request_local.memo = previous
+
+
+def _memo_key(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_memo_key(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _memo_key(item))
+                            for key, item in value.items()))
+    if isinstance(value, driver_hints.Hints):
+        return ('hints', _memo_key(value.filters), _memo_key(value.limit))
+    return value
+
+
+def memoised(name, ignore=('session',), required=None):
+    """Decorator returning the earlier result of an identical call.
+
+    Only calls made in a request_scope() are memoised, for the rest of the
+    request. Results are copied, so callers can't change each other's.
+    NotFound errors are remembered as well. Keyword arguments named in
+    ``ignore`` don't count for telling calls apart. With ``required``, only
+    calls passing a value for the argument of that name are memoised, so
+    that results too big to be worth copying can be left out.
+
+    """
+    def decorator(func):
+        if required is not None:
+            position = _arg_names(func).index(required)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            memo = getattr(_request_local, 'memo', None)
+            if memo is None:
+                return func(self, *args, **kwargs)
+            if required is not None:
+                if position < len(args):
+                    value = args[position]
+                else:
+                    value = kwargs.get(required)
+                if value is None:
+                    return func(self, *args, **kwargs)
+            key = (name, id(self), _memo_key(args),
+                   _memo_key(dict((k, v) for k, v in kwargs.items()
+                                  if k not in ignore)))
+            try:
+                error, result = memo.results[key]
+            except KeyError:
+                pass
+            else:
+                memo.hits += 1
+                METRICS.incr('memo.hit')
+                if error is not None:
+                    raise error
+                return copy.deepcopy(result)
+            memo.misses += 1
+            METRICS.incr('memo.miss')
+            try:
+                result = func(self, *args, **kwargs)
+            except exception.NotFound as e:
+                memo.results[key] = (e, None)
+                raise
+            memo.results[key] = (None, copy.deepcopy(result))
+            return result
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+class RequestMemoMiddleware(object):
+    """WSGI middleware giving each request its own memo, see memoised().
+
+    Only requests which don't change anything get one: GET and HEAD
+    requests and token requests. Add it to the keystone-paste.ini
+    pipelines, before the application::
+
+        [filter:hybrid_request_memo]
+        paste.filter_factory =
+            keystone.common.hybrid_common:RequestMemoMiddleware.factory
+
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    @classmethod
+    def factory(cls, global_config, **local_config):
+        def _factory(app):
+            return cls(app)
+        return _factory
+
+    def _read_only(self, environ):
+        method = environ.get('REQUEST_METHOD')
+        if method in ('GET', 'HEAD'):
+            return True
+        path = environ.get('PATH_INFO', '').rstrip('/')
+        return method == 'POST' and path.endswith('/tokens')
+
+    def __call__(self, environ, start_response):
+        if not self._read_only(environ):
+            return self.application(environ, start_response)
+        with request_scope():
+            return self.application(environ, start_response)
+
+
+class ResolvedDefaults(object):
+    """The default project and roles of LDAP users, resolved to ids.
+
+    The ids are looked up on first use and kept for ``defaults_ttl``
+    seconds, or until a project or role is changed. A failed lookup is not
+    repeated on every call: the error is raised again until the retry time
+    is reached, which doubles with every failure up to
+    ``defaults_max_backoff`` seconds.
+
+    """
+
+    def __init__(self, resource_driver):
+        self.resource_driver = resource_driver
+        self._values = None
+        self._expires = 0
+        self._error = None
+        self._retry_at = 0
+        self._backoff = 0
+        self._lock = threading.Lock()
+        for event in ('created', 'updated', 'deleted'):
+            for resource_type in ('project', 'role'):
+                notifications.register_event_callback(
+                    event, resource_type, self._resource_changed)
+
+    @property
+    def project(self):
+        """A copy of the default project, which callers may change."""
+        return dict(self._get()[0])
+
+    @property
+    def project_id(self):
+        return self._get()[0]['id']
+
+    @property
+    def role_ids(self):
+        """Tuple of the default role ids."""
+        return self._get()[1]
+
+    @property
+    def role_refs(self):
+        """New list of the default roles in metadata format, [{'id': ...}].
+
+        Built on every call, so that callers can't change the defaults by
+        changing the list or the dicts in it.
+
+        """
+        return [{'id': role_id} for role_id in self._get()[1]]
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+            self._error = None
+            self._backoff = 0
+
+    def _resource_changed(self, service, resource_type, operation, payload):
+        self.invalidate()
+
+    def _get(self):
+        values = self._values
+        if values is not None and time.time() < self._expires:
+            return values
+        with self._lock:
+            now = time.time()
+            if self._values is not None and now < self._expires:
+                return self._values
+            if self._error is not None and now < self._retry_at:
+                raise self._error
+            try:
+                values = self._resolve()
+            except Exception as e:
+                self._backoff = min(max(1, self._backoff * 2),
+                                    CONF.ldap_hybrid.defaults_max_backoff)
+                self._retry_at = now + self._backoff
+                self._error = e
+                self._values = None
+                raise
+            self._error = None
+            self._backoff = 0
+            self._values = values
+            self._expires = now + CONF.ldap_hybrid.defaults_ttl
+            return values
+
+    def _resolve(self):
+        project = self.resource_driver.get_project_by_name(
+            CONF.ldap_hybrid.default_project,
+            CONF.identity.default_domain_id)
+
+        with sql.transaction() as session:
+            query = session.query(sql_role.RoleTable)
+            query = query.filter(sql_role.RoleTable.name.in_(
+                CONF.ldap_hybrid.default_roles))
+            role_refs = query.all()
+
+        if len(role_refs) != len(CONF.ldap_hybrid.default_roles):
+            raise exception.RoleNotFound(
+                message=_('Could not find one or more roles: %s') %
+                ', '.join(CONF.ldap_hybrid.default_roles))
+
+        return dict(project), tuple(role_ref.id for role_ref in role_refs)
+
+
+def membership_cache():
+    """Return a cache for "is this an LDAP user" lookups."""
+    return LRUCache(CONF.ldap_hybrid.membership_cache_size,
+                    CONF.ldap_hybrid.membership_cache_ttl,
+                    name='membership')
+
+
+class LdapUserAssignmentMixin(object):
+    """What the hybrid assignment drivers share about LDAP users.
+
+    Expects ``ldap_user`` (a UserApi), ``membership_cache``, ``mirror`` and
+    ``defaults`` (ResolvedDefaults) on the driver, as well as the driver's
+    own _merge_default_roles(), which adds the default roles of an LDAP
+    user to the SQL metadata of an assignment.
+
+    """
+
+    @timed('assignment.get_metadata_batch')
+    def get_metadata_batch(self, pairs):
+        """Resolve the metadata of many (user_id, tenant_id) pairs at once.
+
+        Returns a dict mapping each pair to what _get_metadata() returns for
+        it. Pairs for which _get_metadata() would raise MetadataNotFound are
+        left out. All pairs are resolved with one LDAP search for the users
+        which are not cached and one SQL query.
+
+        """
+        pairs = set(pairs)
+        if CONF.ldap_hybrid.trust_materialised_assignments:
+            return get_user_project_metadata(pairs)
+        usernames = self._ldap_user_names(
+            user_id for user_id, tenant_id in pairs)
+        sql_metadata = get_user_project_metadata(pairs)
+        result = {}
+        for user_id, tenant_id in pairs:
+            res = self._merge_default_roles(
+                usernames[user_id], tenant_id,
+                sql_metadata.get((user_id, tenant_id)))
+            if res is not None:
+                result[(user_id, tenant_id)] = res
+        return result
+
+    def _ldap_user_name(self, user_id):
+        """Return the name of an LDAP user, or None for a non-LDAP user.
+
+        The answer is cached (negatively as well) so that the hot paths don't
+        need a round trip to the LDAP server on every call. While the LDAP
+        circuit breaker is open, see _stale_ldap_user_name().
+
+        """
+        name = self.membership_cache.get(user_id)
+        if name is not MISSING:
+            return name
+        try:
+            user = read_through(
+                self.mirror, lambda: self.mirror.get(user_id)[1],
+                lambda: self._search_ldap_user(user_id))
+        except exception.UserNotFound:
+            # Not an LDAP User
+            self.membership_cache.set(
+                user_id, None,
+                ttl=CONF.ldap_hybrid.membership_cache_negative_ttl)
+            return None
+        except CircuitOpen:
+            return self._stale_ldap_user_name(user_id)
+        self.membership_cache.set(user_id, user['name'])
+        return user['name']
+
+    def _stale_ldap_user_name(self, user_id):
+        """Answer _ldap_user_name() without LDAP, which is down.
+
+        An expired cache entry is still good enough. Users which aren't
+        cached at all are treated as SQL users, so that SQL users keep
+        working, but that isn't cached.
+
+        """
+        name = self.membership_cache.get_stale(user_id)
+        if name is MISSING:
+            return None
+        return name
+
+    def _search_ldap_user(self, user_id):
+        METRICS.incr('ldap.search')
+        return self.ldap_user.get(user_id)
+
+    def _ldap_user_names(self, user_ids):
+        """Like _ldap_user_name() for many users, with a single search."""
+        usernames = {}
+        missing = []
+        for user_id in set(user_ids):
+            name = self.membership_cache.get(user_id)
+            if name is MISSING:
+                missing.append(user_id)
+            else:
+                usernames[user_id] = name
+        if missing:
+            try:
+                found = read_through(
+                    self.mirror, lambda: self.mirror.find_names(missing),
+                    lambda: find_ldap_user_names(self.ldap_user, missing))
+            except CircuitOpen:
+                for user_id in missing:
+                    usernames[user_id] = self._stale_ldap_user_name(user_id)
+                return usernames
+            for user_id in missing:
+                name = found.get(user_id)
+                if name is None:
+                    self.membership_cache.set(
+                        user_id, None,
+                        ttl=CONF.ldap_hybrid.membership_cache_negative_ttl)
+                else:
+                    self.membership_cache.set(user_id, name)
+                usernames[user_id] = name
+        return usernames
+
+    def invalidate_ldap_user(self, user_id=None):
+        """Forget the cached LDAP membership of a user (or of all users)."""
+        self.membership_cache.invalidate(user_id)
+
+    def _fixed_default_project_ids(self, user_id):
+        """Return the projects a user gets the default roles on.
+
+        Only those which don't depend on the user's other roles in SQL.
+
+        """
+        return frozenset([self.default_project_id])
+
+    def _role_revoked(self, user_id, project_id):
+        if project_id in self._fixed_default_project_ids(user_id):
+            return
+        unmaterialise_assignments(user_id, project_id)
+
+    def remove_role_from_user_and_project(self, user_id, tenant_id, role_id):
+        super(LdapUserAssignmentMixin, self).remove_role_from_user_and_project(
+            user_id, tenant_id, role_id)
+        self._role_revoked(user_id, tenant_id)
+
+    def delete_grant(self, role_id, user_id=None, group_id=None,
+                     domain_id=None, project_id=None,
+                     inherited_to_projects=False):
+        super(LdapUserAssignmentMixin, self).delete_grant(
+            role_id, user_id=user_id, group_id=group_id, domain_id=domain_id,
+            project_id=project_id,
+            inherited_to_projects=inherited_to_projects)
+        if user_id and project_id:
+            self._role_revoked(user_id, project_id)
+
+    @property
+    def default_project(self):
+        return self.defaults.project
+
+    @property
+    def default_project_id(self):
+        return self.defaults.project_id
+
+    @property
+    def default_roles(self):
+        return self.defaults.role_ids
+
+
+def _chunk_size():
+    """Number of rows or items to handle at a time when streaming users.
+
+    The LDAP page size, or BATCH_SIZE when LDAP isn't paged.
+
+    """
+    return CONF.ldap_hybrid.ldap_page_size or BATCH_SIZE
+
+
+def iter_ldap_entries(user_api, ldap_filter=None, attrs=None,
+                      page_size=None):
+    """Yield the raw (dn, attrs) results of a search for LDAP users.
+
+    Unlike ``user_api.get_all()`` this doesn't build a list of the whole
+    directory: the entries are requested with the simple paged results
+    control and handed out page by page, so only one page is held in memory
+    at a time and the server side size limit doesn't truncate the result.
+    With a ``page_size`` of 0 the entries are requested with a single
+    search instead, like keystone does with ``[ldap] page_size = 0``.
+
+    """
+    if page_size is None:
+        page_size = CONF.ldap_hybrid.ldap_page_size
+    query = u'(&%s(objectClass=%s)(%s=*))' % (
+        ldap_filter or user_api.ldap_filter or '',
+        user_api.object_class,
+        user_api.id_attr)
+    if attrs is None:
+        attrs = set([user_api.id_attr])
+        attrs.update(user_api.attribute_mapping.values())
+        attrs.update(user_api.extra_attr_mapping.keys())
+    attrs = [attr for attr in attrs if attr]
+    if page_size <= 0:
+        METRICS.incr('ldap.search')
+        with user_api.get_connection() as conn:
+            try:
+                entries = conn.search_s(user_api.tree_dn,
+                                        user_api.LDAP_SCOPE, query, attrs)
+            except ldap.NO_SUCH_OBJECT:
+                return
+        for entry in entries:
+            yield entry
+        return
+    control = ldap.controls.SimplePagedResultsControl(
+        True, size=page_size, cookie='')
+
+    with user_api.get_connection() as conn:
+        while True:
+            METRICS.incr('ldap.search')
+            try:
+                msgid = conn.search_ext(user_api.tree_dn,
+                                        user_api.LDAP_SCOPE,
+                                        query, attrs, serverctrls=[control])
+                rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+            except ldap.NO_SUCH_OBJECT:
+                return
+            for entry in rdata:
+                yield entry
+            cookies = [ctrl.cookie for ctrl in serverctrls or []
+                       if ctrl.controlType == control.controlType]
+            if not cookies or not cookies[0]:
+                # Either this was the last page or the server doesn't
+                # support paging and returned everything at once
+                return
+            control.cookie = cookies[0]
+
+
+def iter_ldap_users(user_api, ldap_filter=None, page_size=None):
+    """Yield filtered LDAP user refs, like ``get_all_filtered()`` does."""
+    for entry in iter_ldap_entries(user_api, ldap_filter,
+                                   page_size=page_size):
+        user = user_api._ldap_res_to_model(entry)
+        if user_api.enabled_emulation:
+            user['enabled'] = user_api._get_enabled(user['id'])
+        yield user_api.filter_attributes(user)
+
+
+def read_ldap_user(user_api, dn, user_id):
+    """Return the user ref of the LDAP user with a known DN.
+
+    Reads the entry at the DN itself (a base scope search) rather than
+    searching the user tree for the id. Raises UserNotFound if there is no
+    user with the id at the DN (any longer).
+
+    """
+    query = u'(&%s(objectClass=%s)(%s=%s))' % (
+        user_api.ldap_filter or '',
+        user_api.object_class,
+        user_api.id_attr,
+        ldap.filter.escape_filter_chars(user_id))
+    attrs = set([user_api.id_attr])
+    attrs.update(user_api.attribute_mapping.values())
+    attrs.update(user_api.extra_attr_mapping.keys())
+    attrs = [attr for attr in attrs if attr]
+    METRICS.incr('ldap.read')
+    with user_api.get_connection() as conn:
+        try:
+            res = conn.search_s(dn, ldap.SCOPE_BASE, query, attrs)
+        except ldap.NO_SUCH_OBJECT:
+            res = []
+    if not res:
+        raise exception.UserNotFound(user_id=user_id)
+    user = user_api._ldap_res_to_model(res[0])
+    if user_api.enabled_emulation:
+        user['enabled'] = user_api._get_enabled(user['id'])
+    return user
+
+
+def iter_ldap_user_ids(user_api, page_size=None):
+    """Yield the ids of all LDAP users, fetching only the id attribute."""
+    for entry in iter_ldap_entries(user_api, attrs=[user_api.id_attr],
+                                   page_size=page_size):
+        yield user_api._ldap_res_to_model(entry)['id']
+
+
+def iter_ldap_user_names(user_api, page_size=None):
+    """Yield (id, name) of all LDAP users."""
+    attrs = [user_api.id_attr, user_api.attribute_mapping['name']]
+    for entry in iter_ldap_entries(user_api, attrs=attrs,
+                                   page_size=page_size):
+        user = user_api._ldap_res_to_model(entry)
+        yield user['id'], user['name']
+
+
+def find_ldap_user_names(user_api, user_ids):
+    """Look up many LDAP users by id with one search (per batch of ids).
+
+    Returns a dict mapping the ids of the users found in LDAP to their
+    names. The ids are compared case insensitively, like LDAP does.
+
+    """
+    user_ids = list(user_ids)
+    id_attr = user_api.id_attr
+    name_attr = user_api.attribute_mapping['name']
+    names = {}
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        ldap_filter = u'(|%s)' % u''.join(
+            u'(%s=%s)' % (id_attr, ldap.filter.escape_filter_chars(user_id))
+            for user_id in user_ids[i:i + BATCH_SIZE])
+        if user_api.ldap_filter:
+            ldap_filter = u'(&%s%s)' % (user_api.ldap_filter, ldap_filter)
+        for entry in iter_ldap_entries(user_api, ldap_filter,
+                                       attrs=[id_attr, name_attr]):
+            user = user_api._ldap_res_to_model(entry)
+            names[user['id'].lower()] = user['name']
+    return dict((user_id, names[user_id.lower()]) for user_id in user_ids
+                if user_id.lower() in names)
+
+
+def find_ldap_user_ids(user_api, user_names):
+    """Look up many LDAP users by name with one search (per batch).
+
+    Returns a dict mapping the names of the users found in LDAP to their
+    ids. Only exact matches are returned, even though LDAP compares the
+    names case insensitively.
+
+    """
+    user_names = list(user_names)
+    id_attr = user_api.id_attr
+    name_attr = user_api.attribute_mapping['name']
+    ids = {}
+    for i in range(0, len(user_names), BATCH_SIZE):
+        ldap_filter = u'(|%s)' % u''.join(
+            u'(%s=%s)' % (name_attr, ldap.filter.escape_filter_chars(name))
+            for name in user_names[i:i + BATCH_SIZE])
+        if user_api.ldap_filter:
+            ldap_filter = u'(&%s%s)' % (user_api.ldap_filter, ldap_filter)
+        for entry in iter_ldap_entries(user_api, ldap_filter,
+                                       attrs=[id_attr, name_attr]):
+            user = user_api._ldap_res_to_model(entry)
+            ids[user['name']] = user['id']
+    return dict((name, ids[name]) for name in user_names if name in ids)
+
+
+def get_project_user_ids(project_ids):
+    """Return the ids of the users with a role on any of the projects."""
+    project_ids = list(project_ids)
+    user_ids = set()
+    with sql.transaction() as session:
+        for i in range(0, len(project_ids), BATCH_SIZE):
+            query = session.query(sql_assign.RoleAssignment.actor_id)
+            query = query.filter_by(
+                type=sql_assign.AssignmentType.USER_PROJECT)
+            query = query.filter(sql_assign.RoleAssignment.target_id.in_(
+                project_ids[i:i + BATCH_SIZE]))
+            user_ids.update(row[0] for row in query.distinct())
+    return user_ids
+
+
+def get_user_project_ids(user_ids=None):
+    """Return the projects users have a role on in SQL, by user id.
+
+    Without ``user_ids``, this covers the role assignments of all users.
+
+    """
+    project_ids = collections.defaultdict(set)
+    with sql.transaction() as session:
+        query = session.query(sql_assign.RoleAssignment.actor_id,
+                              sql_assign.RoleAssignment.target_id)
+        query = query.filter_by(type=sql_assign.AssignmentType.USER_PROJECT)
+        if user_ids is None:
+            queries = [query]
+        else:
+            user_ids = list(user_ids)
+            queries = [query.filter(sql_assign.RoleAssignment.actor_id.in_(
+                user_ids[i:i + BATCH_SIZE]))
+                for i in range(0, len(user_ids), BATCH_SIZE)]
+        for query in queries:
+            for user_id, project_id in query.distinct():
+                project_ids[user_id].add(project_id)
+    return project_ids
+
+
+def get_user_project_metadata(pairs):
+    """Return the SQL metadata of many (user_id, project_id) pairs at once.
+
+    The result maps every pair with at least one role assignment to
+    metadata in the format of the SQL assignment driver's _get_metadata().
+
+    """
+    pairs = set(pairs)
+    user_ids = sorted(set(user_id for user_id, project_id in pairs))
+    project_ids = sorted(set(project_id for user_id, project_id in pairs))
+    metadata = {}
+    with sql.transaction() as session:
+        for i in range(0, len(user_ids), BATCH_SIZE):
+            for j in range(0, len(project_ids), BATCH_SIZE):
+                query = session.query(sql_assign.RoleAssignment)
+                query = query.filter_by(
+                    type=sql_assign.AssignmentType.USER_PROJECT)
+                query = query.filter(sql_assign.RoleAssignment.actor_id.in_(
+                    user_ids[i:i + BATCH_SIZE]))
+                query = query.filter(sql_assign.RoleAssignment.target_id.in_(
+                    project_ids[j:j + BATCH_SIZE]))
+                for assignment in query.all():
+                    pair = (assignment.actor_id, assignment.target_id)
+                    if pair not in pairs:
+                        continue
+                    role_ref = {'id': assignment.role_id}
+                    if assignment.inherited:
+                        role_ref['inherited_to'] = 'projects'
+                    metadata.setdefault(pair, {'roles': []})
+                    metadata[pair]['roles'].append(role_ref)
+    return metadata
+
+
+class MaterialisedAssignment(sql.ModelBase, sql.ModelDictMixin):
+    """A default assignment written to the SQL assignment table.
+
+    Tells the materialised assignments apart from those made through
+    keystone, so that they can be removed once they no longer apply.
+
+    """
+    __tablename__ = 'hybrid_materialised_assignment'
+    attributes = ['user_id', 'project_id', 'role_id']
+    user_id = sql.Column(sql.String(64), primary_key=True)
+    project_id = sql.Column(sql.String(64), primary_key=True)
+    role_id = sql.Column(sql.String(64), primary_key=True)
+
+
+def materialise_assignments(driver, rebuild=False):
+    """Write the default assignments of LDAP users to SQL.
+
+    ``driver`` is a hybrid assignment driver, which computes the default
+    assignments with iter_implicit_assignments(). Only the difference to
+    what was materialised before is written, so running this again is
+    cheap and changes nothing if nothing changed. With ``rebuild``, all
+    materialised assignments are removed and written again.
+
+    Returns the number of assignments added and removed.
+
+    """
+    MaterialisedAssignment.__table__.create(sql.get_engine(), checkfirst=True)
+    session = sql.get_session()
+    with session.begin():
+        tracked = set(session.query(MaterialisedAssignment.user_id,
+                                    MaterialisedAssignment.project_id,
+                                    MaterialisedAssignment.role_id))
+        existing = set()
+        real_project_ids = collections.defaultdict(set)
+        query = session.query(sql_assign.RoleAssignment.actor_id,
+                              sql_assign.RoleAssignment.target_id,
+                              sql_assign.RoleAssignment.role_id,
+                              sql_assign.RoleAssignment.inherited)
+        query = query.filter_by(type=sql_assign.AssignmentType.USER_PROJECT)
+        for user_id, project_id, role_id, inherited in query:
+            triple = (user_id, project_id, role_id)
+            if not inherited:
+                existing.add(triple)
+            if inherited or triple not in tracked:
+                real_project_ids[user_id].add(project_id)
+
+    # LDAP is enumerated outside of a transaction, which would keep the
+    # assignment table locked meanwhile
+    wanted = set(driver.iter_implicit_assignments(real_project_ids))
+    materialised = tracked & existing
+    if rebuild:
+        removed = materialised
+        added = wanted - (existing - materialised)
+    else:
+        removed = materialised - wanted
+        added = wanted - existing
+    # materialised assignments which were revoked through keystone are
+    # written again if they still apply
+    gone = tracked - existing
+
+    with session.begin():
+        _delete_assignments(session, removed)
+        _delete_tracked(session, removed | gone)
+        # roles granted through keystone since the assignments were read
+        # are not ours to write (again)
+        query = session.query(sql_assign.RoleAssignment.actor_id,
+                              sql_assign.RoleAssignment.target_id,
+                              sql_assign.RoleAssignment.role_id)
+        query = query.filter_by(type=sql_assign.AssignmentType.USER_PROJECT,
+                                inherited=False)
+        added = sorted(added.difference(query))
+        for i in range(0, len(added), BATCH_SIZE):
+            batch = added[i:i + BATCH_SIZE]
+            session.execute(sql_assign.RoleAssignment.__table__.insert(), [
+                {'type': sql_assign.AssignmentType.USER_PROJECT,
+                 'actor_id': user_id, 'target_id': project_id,
+                 'role_id': role_id, 'inherited': False}
+                for user_id, project_id, role_id in batch])
+            session.execute(MaterialisedAssignment.__table__.insert(), [
+                {'user_id': user_id, 'project_id': project_id,
+                 'role_id': role_id}
+                for user_id, project_id, role_id in batch])
+    return len(added), len(removed)
+
+
+def unmaterialise_assignments(user_id, project_id):
+    """Remove the materialised assignments of a user on a project.
+
+    Called when a role of the user on the project was revoked, so that the
+    default roles, which were only materialised there because of that
+    role, don't outlive it. They are kept while the user still has another
+    role on the project.
+
+    """
+    MaterialisedAssignment.__table__.create(sql.get_engine(), checkfirst=True)
+    session = sql.get_session()
+    with session.begin():
+        tracked = set(role_id for role_id, in session.query(
+            MaterialisedAssignment.role_id).filter_by(
+                user_id=user_id, project_id=project_id))
+        if not tracked:
+            return
+        query = session.query(sql_assign.RoleAssignment.role_id,
+                              sql_assign.RoleAssignment.inherited)
+        query = query.filter_by(type=sql_assign.AssignmentType.USER_PROJECT,
+                                actor_id=user_id, target_id=project_id)
+        for role_id, inherited in query:
+            if inherited or role_id not in tracked:
+                return
+        triples = set((user_id, project_id, role_id) for role_id in tracked)
+        _delete_assignments(session, triples)
+        _delete_tracked(session, triples)
+
+
+def _delete_assignments(session, triples):
+    for user_id, project_id, role_id in triples:
+        session.query(sql_assign.RoleAssignment).filter_by(
+            type=sql_assign.AssignmentType.USER_PROJECT,
+            actor_id=user_id, target_id=project_id, role_id=role_id,
+            inherited=False).delete(synchronize_session=False)
+
+
+def _delete_tracked(session, triples):
+    for user_id, project_id, role_id in triples:
+        session.query(MaterialisedAssignment).filter_by(
+            user_id=user_id, project_id=project_id,
+            role_id=role_id).delete(synchronize_session=False)
+
+
+class MirroredUser(sql.ModelBase, sql.ModelDictMixin):
+    """Local copy of an LDAP user."""
+    __tablename__ = 'hybrid_ldap_user'
+    attributes = ['id', 'name', 'enabled', 'email', 'dn', 'modified']
+    id = sql.Column(sql.String(64), primary_key=True)
+    name = sql.Column(sql.String(255), nullable=False, index=True)
+    enabled = sql.Column(sql.Boolean, nullable=True)
+    email = sql.Column(sql.String(255), nullable=True)
+    dn = sql.Column(sql.Text(), nullable=False)
+    # modifyTimestamp of the LDAP entry, in LDAP generalized time
+    modified = sql.Column(sql.String(32), nullable=True)
+    # the sync which wrote the row, rows left behind by a full sync are
+    # users deleted from LDAP
+    sync_run = sql.Column(sql.String(32), nullable=False)
+
+
+class DirectorySyncState(sql.ModelBase, sql.ModelDictMixin):
+    """Progress of the syncs of the directory mirror."""
+    __tablename__ = 'hybrid_ldap_sync'
+    attributes = ['id', 'last_sync', 'last_full_sync', 'high_water',
+                  'lease_owner', 'lease_until']
+    id = sql.Column(sql.String(64), primary_key=True)
+    last_sync = sql.Column(sql.DateTime, nullable=True)
+    last_full_sync = sql.Column(sql.DateTime, nullable=True)
+    high_water = sql.Column(sql.String(32), nullable=True)
+    # the sync in progress, only one process syncs at a time
+    lease_owner = sql.Column(sql.String(32), nullable=True)
+    lease_until = sql.Column(sql.DateTime, nullable=True)
+
+
+class DirectoryMirror(object):
+    """A copy of the LDAP users in SQL, kept up to date by sync().
+
+    The first sync and every directory_full_sync_interval seconds, all
+    users are read from LDAP and the users which disappeared are removed.
+    In between, only the entries with a modifyTimestamp at least as recent
+    as the most recent one seen so far are read.
+
+    Syncs are serialised across processes by a lease on the sync state: a
+    process which can't take it skips its sync, so that concurrent full
+    syncs don't remove each other's rows.
+
+    """
+
+    STATE_ID = 'users'
+    # seconds a sync holds the lease without renewing it, after which it
+    # is considered dead
+    LEASE_TIME = 300
+    MODIFIED_ATTR = 'modifyTimestamp'
+    # seconds the sync state is cached between reads
+    STATE_CHECK_INTERVAL = 5
+
+    def __init__(self, user_api):
+        self.user_api = user_api
+        engine = sql.get_engine()
+        MirroredUser.__table__.create(engine, checkfirst=True)
+        DirectorySyncState.__table__.create(engine, checkfirst=True)
+        self._last_sync = None
+        self._state_checked = None
+        self._thread = None
+
+    # Reading
+
+    def age(self):
+        """Seconds since the last sync, or None if there never was one."""
+        now = time.time()
+        if (self._state_checked is None or
+                now - self._state_checked > self.STATE_CHECK_INTERVAL):
+            session = sql.get_session()
+            state = session.query(DirectorySyncState).get(self.STATE_ID)
+            self._last_sync = state.last_sync if state else None
+            self._state_checked = now
+        if self._last_sync is None:
+            return None
+        return (datetime.datetime.utcnow() -
+                self._last_sync).total_seconds()
+
+    def is_fresh(self):
+        age = self.age()
+        return (age is not None and
+                age <= CONF.ldap_hybrid.directory_max_staleness)
+
+    def _to_ref(self, row):
+        ref = {'id': row.id, 'name': row.name, 'enabled': row.enabled}
+        if row.email is not None:
+            ref['email'] = row.email
+        return ref
+
+    def get(self, user_id):
+        """Return the DN and the user ref of a mirrored user."""
+        session = sql.get_session()
+        row = session.query(MirroredUser).get(user_id)
+        if row is None:
+            raise exception.UserNotFound(user_id=user_id)
+        return row.dn, self._to_ref(row)
+
+    def get_by_name(self, user_name):
+        session = sql.get_session()
+        row = session.query(MirroredUser).filter_by(name=user_name).first()
+        if row is None:
+            raise exception.UserNotFound(user_id=user_name)
+        return self._to_ref(row)
+
+    def find_names(self, user_ids):
+        """Like find_ldap_user_names(), from the mirror."""
+        user_ids = list(user_ids)
+        names = {}
+        session = sql.get_session()
+        for i in range(0, len(user_ids), BATCH_SIZE):
+            query = session.query(MirroredUser.id, MirroredUser.name)
+            query = query.filter(
+                MirroredUser.id.in_(user_ids[i:i + BATCH_SIZE]))
+            names.update(query.all())
+        return names
+
+    def find_ids(self, user_names):
+        """Like find_ldap_user_ids(), from the mirror."""
+        user_names = list(user_names)
+        ids = {}
+        session = sql.get_session()
+        for i in range(0, len(user_names), BATCH_SIZE):
+            query = session.query(MirroredUser.name, MirroredUser.id)
+            query = query.filter(
+                MirroredUser.name.in_(user_names[i:i + BATCH_SIZE]))
+            ids.update(query.all())
+        return ids
+
+    def iter_users(self, filters=()):
+        """Yield the mirrored user refs which match all the hint filters."""
+        session = sql.get_session()
+        query = session.query(MirroredUser).order_by(MirroredUser.id)
+        for row in query.yield_per(_chunk_size()):
+            ref = self._to_ref(row)
+            if all(_match_filter(ref, f) for f in filters):
+                yield ref
+
+    def iter_user_names(self):
+        session = sql.get_session()
+        query = session.query(MirroredUser.id, MirroredUser.name)
+        query = query.order_by(MirroredUser.id)
+        for row in query.yield_per(_chunk_size()):
+            yield row[0], row[1]
+
+    def iter_user_ids(self):
+        session = sql.get_session()
+        query = session.query(MirroredUser.id).order_by(MirroredUser.id)
+        for row in query.yield_per(_chunk_size()):
+            yield row[0]
+
+    # Syncing
+
+    def sync(self, full=None):
+        """Copy the LDAP users changed since the last sync.
+
+        With ``full=None`` a full sync is done when one is due. Returns the
+        number of users written to the mirror, 0 if another process is
+        syncing.
+
+        """
+        run = uuid.uuid4().hex
+        if not self._take_lease(run):
+            LOG.debug('Another process is syncing the directory mirror')
+            return 0
+        try:
+            return self._sync(run, full)
+        finally:
+            self._release_lease(run)
+
+    def _sync(self, run, full):
+        session = sql.get_session()
+        state = session.query(DirectorySyncState).get(self.STATE_ID)
+        now = datetime.datetime.utcnow()
+        if state.high_water is None:
+            # nothing to be incremental to
+            full = True
+        elif full is None:
+            full = (state.last_full_sync is None or
+                    (now - state.last_full_sync).total_seconds() >=
+                    CONF.ldap_hybrid.directory_full_sync_interval)
+        ldap_filter = None
+        if not full:
+            ldap_filter = u'(&%s(%s>=%s))' % (
+                self.user_api.ldap_filter or '', self.MODIFIED_ATTR,
+                ldap.filter.escape_filter_chars(state.high_water))
+
+        high_water = state.high_water
+        count = 0
+        rows = []
+        for dn, attrs in iter_ldap_entries(self.user_api, ldap_filter,
+                                           attrs=self._attrs()):
+            row = self._to_row(dn, attrs, run)
+            if row['modified'] and row['modified'] > (high_water or ''):
+                high_water = row['modified']
+            rows.append(row)
+            if len(rows) >= BATCH_SIZE:
+                count += self._write(rows, run)
+                rows = []
+        count += self._write(rows, run)
+
+        self._renew_lease(run)
+        with session.begin():
+            if full:
+                # whatever the full sync didn't write is gone from LDAP
+                session.query(MirroredUser).filter(
+                    MirroredUser.sync_run != run).delete(
+                        synchronize_session=False)
+            state = session.query(DirectorySyncState).get(self.STATE_ID)
+            state.last_sync = now
+            if full:
+                state.last_full_sync = now
+            state.high_water = high_water
+        self._last_sync = now
+        self._state_checked = time.time()
+        LOG.debug('Synced %(count)d LDAP users (full: %(full)s)',
+                  {'count': count, 'full': full})
+        return count
+
+    def _take_lease(self, owner):
+        """Take or renew the lease of the sync state for ``owner``.
+
+        Returns False if another sync holds it.
+
+        """
+        now = datetime.datetime.utcnow()
+        until = now + datetime.timedelta(seconds=self.LEASE_TIME)
+        session = sql.get_session()
+        with session.begin():
+            # compare and set, so that only one process gets the lease
+            taken = session.query(DirectorySyncState).filter(
+                DirectorySyncState.id == self.STATE_ID,
+                sqlalchemy.or_(DirectorySyncState.lease_owner == owner,
+                               DirectorySyncState.lease_until.is_(None),
+                               DirectorySyncState.lease_until < now)).update(
+                {'lease_owner': owner, 'lease_until': until},
+                synchronize_session=False)
+        if taken:
+            return True
+        try:
+            with session.begin():
+                session.add(DirectorySyncState(id=self.STATE_ID,
+                                               lease_owner=owner,
+                                               lease_until=until))
+        except sql.DBDuplicateEntry:
+            # the state exists and the lease is held by another sync
+            return False
+        return True
+
+    def _renew_lease(self, owner):
+        if not self._take_lease(owner):
+            # the lease expired and another sync took over, which writes
+            # the users itself
+            raise exception.UnexpectedError(
+                exception=_('Lost the lease of the directory mirror sync'))
+
+    def _release_lease(self, owner):
+        session = sql.get_session()
+        with session.begin():
+            session.query(DirectorySyncState).filter_by(
+                id=self.STATE_ID, lease_owner=owner).update(
+                {'lease_owner': None, 'lease_until': None},
+                synchronize_session=False)
+
+    def _attrs(self):
+        attrs = set([self.user_api.id_attr, self.MODIFIED_ATTR])
+        for name in ('name', 'email', 'enabled'):
+            attr = self.user_api.attribute_mapping.get(name)
+            if attr:
+                attrs.add(attr)
+        return list(attrs)
+
+    def _to_row(self, dn, attrs, run):
+        user = self.user_api._ldap_res_to_model((dn, attrs))
+        if self.user_api.enabled_emulation:
+            user['enabled'] = self.user_api._get_enabled(user['id'])
+        modified = None
+        for key, values in attrs.items():
+            if key.lower() == self.MODIFIED_ATTR.lower() and values:
+                modified = values[0]
+        return {'id': user['id'], 'name': user['name'],
+                'enabled': user.get('enabled'), 'email': user.get('email'),
+                'dn': dn, 'modified': modified, 'sync_run': run}
+
+    def _write(self, rows, run):
+        if not rows:
+            return 0
+        self._renew_lease(run)
+        session = sql.get_session()
+        with session.begin():
+            session.query(MirroredUser).filter(
+                MirroredUser.id.in_([row['id'] for row in rows])).delete(
+                    synchronize_session=False)
+            session.execute(MirroredUser.__table__.insert(), rows)
+        return len(rows)
+
+    def start(self, interval):
+        """Sync every ``interval`` seconds in a background thread."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        name='hybrid-directory-sync')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                LOG.exception('Syncing the LDAP directory mirror failed')
+            time.sleep(interval)
+
+
+def _match_filter(ref, hint_filter):
+    """Check a user ref against a filter of the driver hints.
+
+    Strings are compared case insensitively, like LDAP does.
+
+    """
+    value = ref.get(hint_filter['name'])
+    expected = hint_filter['value']
+    if value is None:
+        return False
+    if isinstance(value, bool):
+        if not isinstance(expected, bool):
+            expected = str(expected).lower() in ('true', '1')
+        return value == expected
+    value = value.lower()
+    expected = expected.lower()
+    comparator = hint_filter['comparator']
+    if comparator == 'contains':
+        return expected in value
+    if comparator == 'startswith':
+        return value.startswith(expected)
+    if comparator == 'endswith':
+        return value.endswith(expected)
+    return value == expected
+
+
+def directory_mirror(user_api):
+    """Return a DirectoryMirror of the LDAP users, if it is enabled."""
+    if not CONF.ldap_hybrid.directory_mirror:
+        return None
+    return DirectoryMirror(user_api)
+
+
+def read_through(mirror, mirror_read, ldap_read):
+    """Read from the mirror when it is fresh, or else from LDAP.
+
+    When LDAP fails, the (stale) mirror is read instead. Without a mirror,
+    this is just ``ldap_read()``. LDAP is called through the circuit
+    breaker, which raises CircuitOpen while LDAP is considered down.
+
+    """
+    if mirror is None:
+        return LDAP_BREAKER.call(ldap_read)
+    if mirror.is_fresh():
+        METRICS.incr('mirror.read')
+        return mirror_read()
+    try:
+        return LDAP_BREAKER.call(ldap_read)
+    except ldap.LDAPError as e:
+        LOG.warning('LDAP failed (%s), reading from the directory mirror '
+                    'last synced %s seconds ago', e, mirror.age())
+        METRICS.incr('mirror.fallback')
+        return mirror_read()
+
+
+def iter_read_through(mirror, mirror_iter, ldap_iter):
+    """Like read_through(), for generators.
+
+    The mirror only stands in for LDAP if it fails before the first result,
+    to never return a user twice.
+
+    """
+    if mirror is None:
+        for item in LDAP_BREAKER.iterate(ldap_iter):
+            yield item
+        return
+    if mirror.is_fresh():
+        METRICS.incr('mirror.read')
+        for item in mirror_iter():
+            yield item
+        return
+    items = LDAP_BREAKER.iterate(ldap_iter)
+    try:
+        first = next(items)
+    except StopIteration:
+        return
+    except ldap.LDAPError as e:
+        LOG.warning('LDAP failed (%s), reading from the directory mirror '
+                    'last synced %s seconds ago', e, mirror.age())
+        METRICS.incr('mirror.fallback')
+        for item in mirror_iter():
+            yield item
+        return
+    yield first
+    for item in items:
+        yield item
+
+
+class Job(object):
+    """Call a function in a background thread.
+
+    A job which isn't waited for any longer, because it timed out, still
+    runs to completion in the background and its result is dropped.
+
+    """
+
+    def __init__(self, func):
+        self.started = time.time()
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func):
+        try:
+            self._result = func()
+        except Exception:
+            self._error = sys.exc_info()
+
+    def _remaining(self, timeout):
+        """Seconds left of a timeout counted from the start of the job."""
+        if not timeout:
+            return None
+        return max(0, self.started + timeout - time.time())
+
+    def _timed_out(self, timeout):
+        return exception.UnexpectedError(
+            exception=_('Timed out after %s seconds') % timeout)
+
+    def result(self, timeout=None):
+        self._thread.join(self._remaining(timeout))
+        if self._thread.is_alive():
+            raise self._timed_out(timeout)
+        if self._error is not None:
+            six.reraise(*self._error)
+        return self._result
+
+
+class StreamJob(Job):
+    """Iterate over a generator in a background thread.
+
+    The items are handed over through a queue of at most ``maxsize`` items,
+    so the background thread runs no further ahead than that and memory
+    stays bounded like with the generator itself.
+
+    """
+
+    def __init__(self, func, maxsize):
+        self._queue = six.moves.queue.Queue(maxsize)
+        self._cancelled = threading.Event()
+        super(StreamJob, self).__init__(func)
+
+    def _run(self, func):
+        try:
+            for item in func():
+                if not self._put((True, item)):
+                    return
+        except Exception:
+            self._error = sys.exc_info()
+        self._put((False, None))
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                pass
+        return False
+
+    def cancel(self):
+        """Stop the background thread, the remaining items are dropped."""
+        self._cancelled.set()
+
+    def iterate(self, timeout=None):
+        try:
+            while True:
+                try:
+                    more, item = self._queue.get(
+                        timeout=self._remaining(timeout))
+                except six.moves.queue.Empty:
+                    raise self._timed_out(timeout)
+                if not more:
+                    if self._error is not None:
+                        six.reraise(*self._error)
+                    return
+                yield item
+        finally:
+            self.cancel()
+
+
+def fan_out(sql_func, ldap_func):
+    """Run the SQL and the LDAP half of a listing.
+
+    ``sql_func()`` returns the SQL result, ``ldap_func(sql_result)`` returns
+    a generator of LDAP results. Returns the SQL result and an iterator over
+    the LDAP results, which callers must close() if they stop iterating
+    early.
+
+    Unless parallel_fanout is enabled, this is just the two calls one after
+    the other. Otherwise the LDAP generator is consumed in a background
+    thread while SQL is queried, and ``ldap_func`` gets None as it can't know
+    the SQL result yet. With fanout_partial_results a failed or timed out
+    SQL query returns None, and a failed LDAP search ends the iteration.
+
+    """
+    if not CONF.ldap_hybrid.parallel_fanout:
+        sql_result = sql_func()
+        return sql_result, ldap_func(sql_result)
+
+    ldap_job = StreamJob(lambda: ldap_func(None), _chunk_size())
+    sql_job = Job(sql_func)
+    try:
+        sql_result = sql_job.result(CONF.ldap_hybrid.fanout_sql_timeout)
+    except Exception:
+        if not CONF.ldap_hybrid.fanout_partial_results:
+            ldap_job.cancel()
+            raise
+        LOG.warning('The SQL query failed, returning LDAP results only',
+                    exc_info=True)
+        sql_result = None
+    return sql_result, PartialResults(ldap_job)
+
+
+class PartialResults(object):
+    """Iterator over the LDAP results of a parallel fan-out.
+
+    Unlike closing a generator which was never started, close() stops the
+    background thread (and frees its LDAP connection) at any time.
+
+    """
+
+    def __init__(self, ldap_job):
+        self.job = ldap_job
+        self._items = self._iterate()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    next = __next__
+
+    def close(self):
+        self._items.close()
+        self.job.cancel()
+
+    def _iterate(self):
+        items = self.job.iterate(CONF.ldap_hybrid.fanout_ldap_timeout)
+        try:
+            for item in items:
+                yield item
+        except Exception:
+            if not CONF.ldap_hybrid.fanout_partial_results:
+                raise
+            LOG.warning('The LDAP search failed, returning partial results',
+                        exc_info=True)
+        finally:
+            self.job.cancel()
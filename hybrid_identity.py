@@ -16,7 +16,15 @@
 
 """Hybrid Identity backend for Keystone on top of the LDAP and SQL backends"""
 
+import hashlib
+import hmac
+import os
+import time
+import uuid
+
 from keystone.common import dependency
+from keystone.common import driver_hints
+from keystone.common import hybrid_common
 from keystone.common import sql
 from keystone.common import utils
 from keystone import exception
@@ -24,99 +32,386 @@ from keystone import identity
 from keystone.identity.backends import ldap as ldap_backend
 from keystone.identity.backends import sql as sql_ident
 
+import ldap
 from oslo_config import cfg
 from oslo_log import log
+import six
+
+hybrid_identity_opts = [
+    cfg.IntOpt('ldap_user_cache_size',
+               default=10000,
+               help='Maximum number of LDAP users whose DN is remembered '
+                    'after a successful login, so that their next login '
+                    'binds directly and then reads the entry at the DN, '
+                    'instead of searching the user tree for it. Set to 0 '
+                    'to disable.'),
+    cfg.IntOpt('ldap_user_cache_ttl',
+               default=300,
+               help='Number of seconds the DN of an LDAP user is '
+                    'remembered after a successful login.'),
+    cfg.BoolOpt('ldap_search_and_bind',
+                default=False,
+                help='Look users up in LDAP before SQL when '
+                     'authenticating. This saves a SQL query per login '
+                     'when most users come from LDAP.'),
+    cfg.BoolOpt('use_origin_index',
+                default=False,
+                help='Remember in a local table whether a user comes from '
+                     'SQL or LDAP, so that a user is looked up in the '
+                     'right backend directly. The table is filled as users '
+                     'are looked up, or all at once by the '
+                     'sync_user_origins command of hybrid_manage.py.'),
+    cfg.IntOpt('auth_cache_size',
+               default=0,
+               help='Maximum number of users whose last successful login '
+                    'is remembered, so that logging in again with the same '
+                    'password skips the password hash (SQL users) or the '
+                    'bind (LDAP users). Only a keyed hash of the user id '
+                    'and password is kept, with a key generated when '
+                    'keystone starts. Set to 0 to disable.'),
+    cfg.IntOpt('auth_cache_ttl',
+               default=60,
+               help='Number of seconds a successful login is remembered. '
+                    'Users updated or deleted through keystone, by any '
+                    'keystone process, must log in again at once, which '
+                    'costs a SQL lookup per remembered login. Changes made '
+                    'in LDAP directly (e.g. a new password or a disabled '
+                    'user) are only noticed after this time.'),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(hybrid_identity_opts, 'ldap_hybrid')
 LOG = log.getLogger(__name__)
 
+ORIGIN_SQL = 'sql'
+ORIGIN_LDAP = 'ldap'
+
+
+class UserOrigin(sql.ModelBase, sql.ModelDictMixin):
+    """Which backend a user comes from, indexed by id and by name."""
+    __tablename__ = 'hybrid_user_origin'
+    attributes = ['id', 'name', 'domain_id', 'origin', 'dn']
+    id = sql.Column(sql.String(64), primary_key=True)
+    name = sql.Column(sql.String(255), nullable=False)
+    domain_id = sql.Column(sql.String(64), nullable=False)
+    origin = sql.Column(sql.String(8), nullable=False)
+    dn = sql.Column(sql.Text(), nullable=True)
+    __table_args__ = (sql.Index('ixu_hybrid_user_origin_name',
+                                'domain_id', 'name'), {})
+
+
+class AuthVersion(sql.ModelBase, sql.ModelDictMixin):
+    """Changes whenever a user is updated or deleted through keystone.
+
+    Remembered logins are only valid for the version they were made with,
+    so that a change made by one keystone process is seen by all of them.
+
+    """
+    __tablename__ = 'hybrid_auth_version'
+    attributes = ['user_id', 'version']
+    user_id = sql.Column(sql.String(64), primary_key=True)
+    version = sql.Column(sql.String(32), nullable=False)
+
 
 @dependency.requires('assignment_api')
 class Identity(sql_ident.Identity):
     def __init__(self, *args, **kwargs):
         super(Identity, self).__init__(*args, **kwargs)
         self.ldap = ldap_backend.Identity(CONF)
-        self.domain_aware = True
+        self.bind_stats = hybrid_common.LatencyStats()
+        self.ldap_user_cache = hybrid_common.LRUCache(
+            CONF.ldap_hybrid.ldap_user_cache_size,
+            CONF.ldap_hybrid.ldap_user_cache_ttl,
+            name='ldap_user')
+        self.auth_cache = hybrid_common.LRUCache(
+            CONF.ldap_hybrid.auth_cache_size,
+            CONF.ldap_hybrid.auth_cache_ttl,
+            name='auth')
+        # the key of the password hashes in auth_cache, it never leaves
+        # the process
+        self._auth_key = os.urandom(32)
+        if self.auth_cache.maxsize > 0:
+            AuthVersion.__table__.create(sql.get_engine(), checkfirst=True)
+        hybrid_common.configure_metrics()
+        if CONF.ldap_hybrid.use_origin_index:
+            UserOrigin.__table__.create(sql.get_engine(), checkfirst=True)
+        self.mirror = hybrid_common.directory_mirror(self.ldap.user)
+        if self.mirror and CONF.ldap_hybrid.directory_sync_interval > 0:
+            self.mirror.start(CONF.ldap_hybrid.directory_sync_interval)
 
     # Identity interface
+    @hybrid_common.timed('identity.authenticate')
     def authenticate(self, user_id, password):
         """Authenticate based on a user and password.
 
         Tries to authenticate using the SQL backend first, if that fails
-        it tries the LDAP backend.
+        it tries the LDAP backend. LDAP users which authenticated before are
+        bound directly, without looking them up in SQL and LDAP again.
+        With the auth cache, a repeated successful login is answered
+        without checking the password against SQL or LDAP at all.
 
         """
         if not password:
             raise AssertionError('Invalid user / password')
 
+        if self.auth_cache.maxsize <= 0:
+            return self._authenticate(user_id, password)
+        digest = self._auth_digest(user_id, password)
+        cached = self.auth_cache.get(user_id)
+        if (cached is not hybrid_common.MISSING and
+                hmac.compare_digest(cached[0], digest)):
+            version = self._auth_version(user_id)
+            if cached[2] == version:
+                return dict(cached[1])
+        else:
+            # only needed to remember the login, read before authenticating
+            # so that a change made meanwhile invalidates it
+            version = self._auth_version(user_id)
+        user_ref = self._authenticate(user_id, password)
+        self.auth_cache.set(user_id, (digest, dict(user_ref), version))
+        return user_ref
+
+    def _auth_version(self, user_id):
         session = sql.get_session()
+        return session.query(AuthVersion.version).filter_by(
+            user_id=user_id).scalar()
+
+    def _auth_digest(self, user_id, password):
+        if isinstance(user_id, six.text_type):
+            user_id = user_id.encode('utf-8')
+        if isinstance(password, six.text_type):
+            password = password.encode('utf-8')
+        return hmac.new(self._auth_key, user_id + b'\0' + password,
+                        hashlib.sha256).digest()
+
+    def _forget_login(self, user_id):
+        """Invalidate the remembered logins of a user in all processes.
+
+        Called after the user was changed, so that a login made before the
+        change can't be remembered with the new version.
+
+        """
+        self.auth_cache.invalidate(user_id)
+        if self.auth_cache.maxsize <= 0:
+            return
+        session = sql.get_session()
+        with session.begin():
+            session.merge(AuthVersion(user_id=user_id,
+                                      version=uuid.uuid4().hex))
+
+    def _authenticate(self, user_id, password):
+        dn = self.ldap_user_cache.get(user_id)
+        if dn is not hybrid_common.MISSING:
+            # a wrong password fails right here, only a DN which no longer
+            # exists is looked up again
+            if self._check_ldap_password(dn, password):
+                try:
+                    # read after the bind, so that a user disabled in LDAP
+                    # meanwhile is returned as disabled
+                    return identity.filter_user(
+                        self._read_ldap_user(user_id, dn))
+                except exception.UserNotFound:
+                    pass
+            # the user might have been moved in LDAP, so look it up again
+            # before giving up
+            self.ldap_user_cache.invalidate(user_id)
+
+        session = sql.get_session()
+        origin = self._get_origin(session, id=user_id)
+        tried_ldap = False
+        if (CONF.ldap_hybrid.ldap_search_and_bind or
+                (origin is not None and origin.origin == ORIGIN_LDAP)):
+            tried_ldap = True
+            try:
+                return self._authenticate_ldap_user(
+                    user_id, password, record_origin=origin is None)
+            except exception.UserNotFound:
+                if origin is not None:
+                    self._forget_origin(user_id)
+                    origin = None
+            except hybrid_common.CircuitOpen:
+                if origin is not None:
+                    raise
+                # LDAP is down, but this might be a SQL user. If it isn't,
+                # the LDAP lookup below fails fast again.
+                tried_ldap = False
+
         try:
-            user_ref = self._get_user(session, user_id)
+            user_ref = super(Identity, self)._get_user(session, user_id)
         except exception.UserNotFound:
-            raise AssertionError('Invalid user / password')
+            if tried_ldap:
+                raise AssertionError('Invalid user / password')
+            try:
+                return self._authenticate_ldap_user(user_id, password,
+                                                    record_origin=True)
+            except exception.UserNotFound:
+                raise AssertionError('Invalid user / password')
+        if origin is None:
+            self._record_origin(user_ref, ORIGIN_SQL)
 
         try:
-            # if the user_ref has a password, it's from the SQL backend and
-            # we can just check if it coincides with the one we got
             assert utils.check_password(password, user_ref['password']), \
                 'Invalid user / password'
         except TypeError:
             raise AssertionError('Invalid user / password')
-        except KeyError:  # if it doesn't have a password, it must be LDAP
-            conn = None
-            try:
-                # get_connection does a bind for us which checks the password
-                #conn = self.user.get_connection(self.user._id_to_dn(user_id),
-                #                                password)
-                dn = self.ldap.user._id_to_dn(user_id)
-                conn = self.ldap.user.get_connection(dn, password)
-                assert conn
-            except Exception:
-                raise AssertionError('Invalid user / password')
-            else:
-                LOG.debug("Authenticated user with LDAP.")
-                self.domain_aware = False
-            finally:
-                if conn:
-                    conn.unbind_s()
-        else:
-            LOG.debug("Authenticated user with SQL.")
-            # turn the SQLAlchemy User object into a dict to match what
-            # LDAP would return
-            user_ref = user_ref.to_dict()
 
+        LOG.debug("Authenticated user with SQL.")
+        # turn the SQLAlchemy User object into a dict to match what
+        # LDAP would return
+        return identity.filter_user(user_ref.to_dict())
+
+    def _authenticate_ldap_user(self, user_id, password,
+                                record_origin=False):
+        dn, user_ref = self._get_ldap_user(user_id)
+        if record_origin:
+            self._record_origin(user_ref, ORIGIN_LDAP, dn)
+        if not self._check_ldap_password(dn, password):
+            raise AssertionError('Invalid user / password')
+        self.ldap_user_cache.set(user_id, dn)
         return identity.filter_user(user_ref)
 
+    def _check_ldap_password(self, dn, password):
+        """Bind as ``dn`` to check a password.
+
+        Returns False if there is no entry with the DN (any longer), and
+        raises AssertionError if the password is wrong.
+
+        """
+        conn = None
+        try:
+            conn = self._ldap_bind(dn, password)
+            if not conn:
+                raise AssertionError('Invalid user / password')
+        except hybrid_common.CircuitOpen:
+            # LDAP is down, the password could not be checked
+            raise
+        except (ldap.NO_SUCH_OBJECT, ldap.INVALID_DN_SYNTAX):
+            return False
+        except Exception:
+            raise AssertionError('Invalid user / password')
+        finally:
+            if conn:
+                conn.unbind_s()
+        LOG.debug("Authenticated user with LDAP.")
+        return True
+
+    def _ldap_bind(self, dn, password):
+        """Bind to LDAP as an end user to check their password.
+
+        get_connection does the bind for us. With end_user_auth the
+        connection comes from the dedicated authentication pool when
+        [ldap] use_auth_pool is enabled, so a connection bound with user
+        credentials is never handed out for searches. While the LDAP
+        circuit breaker is open this raises CircuitOpen without binding.
+
+        """
+        start = time.time()
+        try:
+            return hybrid_common.LDAP_BREAKER.call(
+                self.ldap.user.get_connection, dn, password,
+                end_user_auth=True)
+        finally:
+            elapsed = time.time() - start
+            self.bind_stats.record(elapsed)
+            hybrid_common.METRICS.timing('ldap.bind', elapsed)
+
     def is_domain_aware(self):
-        # XXX we only need domain_aware to be False when authenticating
-        # as an LDAP user; after that, all operations will be done on
-        # the SQL database and domain_aware needs to be True. This code
-        # makes the assumption that the result of authenticate() should
-        # be read as not domain_aware (for LDAP), after which
-        # domain_aware should revert to True.
-        domain_aware = self.domain_aware
-        if not self.domain_aware:
-            self.domain_aware = True
-        return domain_aware
+        # LDAP users are always returned with the default domain set on the
+        # user ref itself, so the driver is domain aware for both kinds of
+        # users. Nothing about the origin of a user is kept on the driver,
+        # which is shared by all concurrent requests.
+        return True
+
+    def _get_origin(self, session, **filters):
+        """Return the origin index entry of a user, if there is one."""
+        if not CONF.ldap_hybrid.use_origin_index:
+            return None
+        return session.query(UserOrigin).filter_by(**filters).first()
+
+    def _record_origin(self, user_ref, origin, dn=None):
+        if not CONF.ldap_hybrid.use_origin_index:
+            return
+        # a separate session, as the caller may be in the middle of a
+        # transaction of its own
+        session = sql.get_session()
+        try:
+            with session.begin():
+                session.merge(UserOrigin(id=user_ref['id'],
+                                         name=user_ref['name'],
+                                         domain_id=user_ref['domain_id'],
+                                         origin=origin, dn=dn))
+        except sql.DBDuplicateEntry:
+            # recorded by a concurrent request
+            pass
+
+    def _forget_origin(self, user_id):
+        if not CONF.ldap_hybrid.use_origin_index:
+            return
+        session = sql.get_session()
+        with session.begin():
+            session.query(UserOrigin).filter_by(id=user_id).delete()
 
     def _get_user(self, session, user_id):
+        origin = self._get_origin(session, id=user_id)
+        if origin is not None:
+            try:
+                if origin.origin == ORIGIN_LDAP:
+                    return self._get_ldap_user(user_id)[1]
+                return super(Identity, self)._get_user(session, user_id)
+            except exception.UserNotFound:
+                # stale entry, look the user up in both backends again
+                self._forget_origin(user_id)
         # try SQL first
         try:
             user_ref = super(Identity, self)._get_user(session, user_id)
         except exception.UserNotFound:
             # then try LDAP
-            user_ref = self.ldap.user.get(user_id)
-            user_ref['domain_id'] = CONF.identity.default_domain_id
-            # Above we assume no password is in the user_ref:
-            # except KeyError:  # if it doesn't have a password, it must be LDAP
-            # But if the LDAP server returns a password, this except
-            # fails so we should remove it if it's there
-            if 'password' in user_ref:
-                del user_ref['password']
+            dn, user_ref = self._get_ldap_user(user_id)
+            self._record_origin(user_ref, ORIGIN_LDAP, dn)
             return user_ref
         else:
+            self._record_origin(user_ref, ORIGIN_SQL)
             return user_ref
 
+    def _get_ldap_user(self, user_id):
+        """Return the DN and the user ref of an LDAP user.
+
+        Both come from a single search, so there is no need for another
+        search to turn the user id into a DN before binding. With the
+        directory mirror enabled, both may come from the mirror instead.
+
+        """
+        dn, user_ref = hybrid_common.read_through(
+            self.mirror, lambda: self.mirror.get(user_id),
+            lambda: self._search_ldap_user(user_id))
+        user_ref['domain_id'] = CONF.identity.default_domain_id
+        # Callers tell SQL from LDAP users by the missing password. If the
+        # LDAP server returns a password, remove it.
+        user_ref.pop('password', None)
+        return dn, user_ref
+
+    def _read_ldap_user(self, user_id, dn):
+        """Return the user ref of an LDAP user whose DN is known."""
+        if self.mirror:
+            return self._get_ldap_user(user_id)[1]
+        user_ref = hybrid_common.LDAP_BREAKER.call(
+            hybrid_common.read_ldap_user, self.ldap.user, dn, user_id)
+        user_ref['domain_id'] = CONF.identity.default_domain_id
+        user_ref.pop('password', None)
+        return user_ref
+
+    def _search_ldap_user(self, user_id):
+        hybrid_common.METRICS.incr('ldap.search')
+        res = self.ldap.user._ldap_get(user_id)
+        if res is None:
+            raise exception.UserNotFound(user_id=user_id)
+        user_ref = self.ldap.user._ldap_res_to_model(res)
+        if self.ldap.user.enabled_emulation:
+            user_ref['enabled'] = self.ldap.user._get_enabled(user_id)
+        return res[0], user_ref
+
+    @hybrid_common.timed('identity.get_user')
+    @hybrid_common.memoised('identity.get_user')
     def get_user(self, user_id):
         LOG.debug("Called get_user %s" % user_id)
         session = sql.get_session()
@@ -128,41 +423,222 @@ class Identity(sql_ident.Identity):
             pass
         return identity.filter_user(user)
 
+    @hybrid_common.timed('identity.get_user_by_name')
+    @hybrid_common.memoised('identity.get_user_by_name')
     def get_user_by_name(self, user_name, domain_id):
         LOG.debug("Called get_user_by_name %s, %s" % (user_name, domain_id))
+        session = sql.get_session()
+        origin = self._get_origin(session, name=user_name,
+                                  domain_id=domain_id)
+        if origin is not None:
+            try:
+                if origin.origin == ORIGIN_LDAP:
+                    return self._get_ldap_user_by_name(user_name)
+                return super(Identity, self).get_user_by_name(user_name,
+                                                              domain_id)
+            except exception.UserNotFound:
+                # stale entry, look the user up in both backends again
+                self._forget_origin(origin.id)
         # try SQL first
         try:
             user = super(Identity, self).get_user_by_name(user_name, domain_id)
         except exception.UserNotFound:
             # then try LDAP
-            user = identity.filter_user(self.ldap.user.get_by_name(user_name))
-            user['domain_id'] = CONF.identity.default_domain_id
+            user = self._get_ldap_user_by_name(user_name)
+            self._record_origin(user, ORIGIN_LDAP)
             return user
         else:
+            self._record_origin(user, ORIGIN_SQL)
             return user
 
+    def _get_ldap_user_by_name(self, user_name):
+        user = identity.filter_user(hybrid_common.read_through(
+            self.mirror, lambda: self.mirror.get_by_name(user_name),
+            lambda: self._search_ldap_user_by_name(user_name)))
+        user['domain_id'] = CONF.identity.default_domain_id
+        return user
+
+    def _search_ldap_user_by_name(self, user_name):
+        hybrid_common.METRICS.incr('ldap.search')
+        return self.ldap.user.get_by_name(user_name)
+
+    @hybrid_common.timed('identity.list_users')
     def list_users(self, hints):
-        # get a copy of the filters to be able to pass them into the
-        # ldap backends
-        save_filters = list(hints.filters)
-        sql_users = super(Identity, self).list_users(hints)
-        hints.filters = save_filters
+        """List the SQL and LDAP users matching the hints.
+
+        The filters are turned into a WHERE clause for SQL and a search
+        filter for LDAP. Filters which either backend could not apply are
+        left in the hints for the caller. The limit applies to the combined
+        result, and LDAP is only paged as far as needed to fill it.
+        With parallel_fanout, SQL and LDAP are queried at the same time.
+
+        """
+        filters = list(hints.filters)
+        limit = hints.limit['limit'] if hints.limit else None
         # Assume that LDAP users are in the default domain, so only query ldap
         # when there's either no domain filter or when it matches the default
         # domain id.
         domain_filter = hints.get_exact_filter_by_name('domain_id')
-        ldap_users = []
-        if (not domain_filter or
-                domain_filter['value'] == CONF.identity.default_domain_id):
-            ldap_users = self.ldap.user.get_all_filtered(hints)
-            for user in ldap_users:
-                user['domain_id'] = CONF.identity.default_domain_id
-        return sql_users + ldap_users
+        if (domain_filter and
+                domain_filter['value'] != CONF.identity.default_domain_id):
+            return super(Identity, self).list_users(hints)
+
+        ldap_hints = driver_hints.Hints()
+        ldap_hints.filters = [f for f in filters if f['name'] != 'domain_id']
+        # filter_query removes the filters it satisfied from ldap_hints
+        ldap_filter = self.ldap.user.filter_query(ldap_hints,
+                                                  self.ldap.user.ldap_filter)
+        # the mirror applies the same filters as the LDAP search
+        mirror_filters = [f for f in filters if f['name'] != 'domain_id' and
+                          f not in ldap_hints.filters]
+        # SQL gets hints of its own, with parallel_fanout it might still be
+        # running after it was given up on
+        sql_hints = driver_hints.Hints()
+        sql_hints.filters = list(filters)
+        if limit is not None:
+            sql_hints.set_limit(limit)
+
+        def list_sql_users():
+            return super(Identity, self).list_users(sql_hints)
+
+        def list_ldap_users(sql_users):
+            page_size = CONF.ldap_hybrid.ldap_page_size
+            if limit is not None and not ldap_hints.filters:
+                # one more than needed tells whether the list was truncated
+                needed = limit - len(sql_users or [])
+                page_size = min(page_size, max(needed, 0) + 1)
+            return hybrid_common.iter_read_through(
+                self.mirror, lambda: self.mirror.iter_users(mirror_filters),
+                lambda: hybrid_common.iter_ldap_users(
+                    self.ldap.user, ldap_filter, page_size=page_size))
+
+        sql_users, ldap_users = hybrid_common.fan_out(list_sql_users,
+                                                      list_ldap_users)
+        if sql_users is None:
+            # SQL failed and partial results are fine, so the caller has to
+            # apply all the filters to the LDAP users
+            sql_users = []
+            sql_filters = filters
+        else:
+            sql_filters = sql_hints.filters
+            if sql_hints.limit and sql_hints.limit['truncated']:
+                ldap_users.close()
+                hints.filters = sql_filters
+                hints.set_limit(limit, truncated=True)
+                return sql_users
+
+        hints.filters = [f for f in filters
+                         if f in sql_filters or f in ldap_hints.filters]
+        if limit is None or hints.filters:
+            # Without a limit, or if the caller still has to filter, all
+            # LDAP users are needed
+            remaining = None
+        else:
+            remaining = limit - len(sql_users)
+
+        users = list(sql_users)
+        truncated = False
+        # LDAP users are fetched page by page and appended as they come
+        # in, rather than building intermediate lists of the whole
+        # directory
+        for user in ldap_users:
+            if remaining is not None:
+                if remaining == 0:
+                    truncated = True
+                    break
+                remaining -= 1
+            user['domain_id'] = CONF.identity.default_domain_id
+            users.append(user)
+        ldap_users.close()
+        if limit is not None:
+            hints.set_limit(limit, truncated=truncated)
+        return users
 
     def update_user(self, user_id, user):
+        self.ldap_user_cache.invalidate(user_id)
         session = sql.get_session()
         user_ref = self._get_user(session, user_id)
+        if 'name' in user:
+            # the name is part of the origin index entry
+            self._forget_origin(user_id)
         # LDAP user_ref is a dict. SQL user_ref is a User object
         if isinstance(user_ref, dict):
-            return self.ldap.update_user(user_id, user)
-        return super(Identity, self).update_user(user_id, user)
+            # the directory mirror picks the change up with its next sync
+            result = self.ldap.update_user(user_id, user)
+        else:
+            result = super(Identity, self).update_user(user_id, user)
+        self._forget_login(user_id)
+        return result
+
+    def delete_user(self, user_id):
+        self.ldap_user_cache.invalidate(user_id)
+        self._forget_origin(user_id)
+        result = super(Identity, self).delete_user(user_id)
+        self._forget_login(user_id)
+        return result
+
+    def sync_origin_index(self):
+        """Fill the origin index with all SQL and LDAP users.
+
+        Returns the number of users recorded. Users which are in both
+        backends are recorded as SQL users, as SQL is looked at first.
+        The entries are written in batches, each in a transaction of its
+        own, so that the table isn't locked while LDAP is enumerated and
+        lookups can keep recording users meanwhile.
+
+        """
+        session = sql.get_session()
+        with session.begin():
+            query = session.query(sql_ident.User.id, sql_ident.User.name,
+                                  sql_ident.User.domain_id)
+            rows = [{'id': user_id, 'name': name, 'domain_id': domain_id,
+                     'origin': ORIGIN_SQL, 'dn': None}
+                    for user_id, name, domain_id in query]
+        seen = set(row['id'] for row in rows)
+        count = 0
+        for i in range(0, len(rows), hybrid_common.BATCH_SIZE):
+            count += self._replace_origins(
+                rows[i:i + hybrid_common.BATCH_SIZE])
+        rows = []
+        for dn, attrs in hybrid_common.iter_ldap_entries(self.ldap.user):
+            user_ref = self.ldap.user._ldap_res_to_model((dn, attrs))
+            if user_ref['id'] in seen:
+                continue
+            seen.add(user_ref['id'])
+            rows.append({'id': user_ref['id'], 'name': user_ref['name'],
+                         'domain_id': CONF.identity.default_domain_id,
+                         'origin': ORIGIN_LDAP, 'dn': dn})
+            if len(rows) >= hybrid_common.BATCH_SIZE:
+                count += self._replace_origins(rows)
+                rows = []
+        count += self._replace_origins(rows)
+
+        # Entries of users which are gone. This may also remove entries
+        # recorded by lookups during the sync, which is harmless: they are
+        # recorded again on the next lookup.
+        stale = [user_id for user_id, in session.query(UserOrigin.id)
+                 if user_id not in seen]
+        for i in range(0, len(stale), hybrid_common.BATCH_SIZE):
+            with session.begin():
+                session.query(UserOrigin).filter(UserOrigin.id.in_(
+                    stale[i:i + hybrid_common.BATCH_SIZE])).delete(
+                        synchronize_session=False)
+        return count
+
+    def _replace_origins(self, rows):
+        """Write a batch of origin index entries, replacing existing ones."""
+        if not rows:
+            return 0
+        user_ids = [row['id'] for row in rows]
+        session = sql.get_session()
+        while True:
+            try:
+                with session.begin():
+                    session.query(UserOrigin).filter(
+                        UserOrigin.id.in_(user_ids)).delete(
+                            synchronize_session=False)
+                    session.execute(UserOrigin.__table__.insert(), rows)
+            except sql.DBDuplicateEntry:
+                # a lookup recorded one of the users meanwhile
+                continue
+            return len(rows)
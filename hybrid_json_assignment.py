@@ -13,14 +13,22 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
 from keystone import config
 from keystone import exception
 from keystone.assignment.backends import sql as sql_assign
-from keystone.assignment.role_backends import sql as sql_role
+from keystone.common import hybrid_common
 from keystone.common import manager
 from keystone.common import sql
-from keystone.i18n import _
 from keystone.identity.backends import ldap as ldap_backend
+from keystone.resource.backends import sql as resource_sql
 
 from oslo_config import cfg
 
@@ -45,57 +53,494 @@ hybrid_opts = [
                     'instead.'),
 ]
 
+json_opts = [
+    cfg.StrOpt('user_project_map',
+               default='/etc/keystone/user-project-map.json',
+               help='JSON file mapping LDAP user names to the names of the '
+                    'projects they get the default roles on'),
+    cfg.StrOpt('user_project_map_format',
+               default='json',
+               choices=['json', 'yaml'],
+               help='Format of the user project map file. Parsing YAML is '
+                    'a lot slower, only use it for maps which are not '
+                    'valid JSON.'),
+    cfg.StrOpt('user_project_map_index',
+               help='Compiled index of the user project map, created with '
+                    '"hybrid_manage.py compile_user_project_map". If set, '
+                    'it is used instead of user_project_map and shared by '
+                    'all keystone processes through the page cache.'),
+    cfg.IntOpt('user_project_map_check_interval',
+               default=10,
+               help='Number of seconds between checks whether the user '
+                    'project map file changed. Changes are loaded without '
+                    'a restart. Set to 0 to disable reloading.'),
+    cfg.BoolOpt('effective_assignment_index',
+                default=False,
+                help='Keep the projects every LDAP user gets the default '
+                     'roles on in memory, by user and by project, so that '
+                     'listing the role assignments of projects doesn\'t '
+                     'enumerate all LDAP users.'),
+    cfg.IntOpt('effective_assignment_index_ttl',
+               default=300,
+               help='Number of seconds after which the effective '
+                    'assignment index is rebuilt, to pick up new LDAP '
+                    'users. Role assignments made through this keystone '
+                    'process and changes of the user project map are '
+                    'picked up at once.'),
+]
+
 CONF = config.CONF
 CONF.register_opts(hybrid_opts, 'ldap_hybrid')
+CONF.register_opts(json_opts, 'ldap_hybrid')
+
+_INDEX_MAGIC = b'HUPM'
+_INDEX_VERSION = 2
+_INDEX_HEADER = struct.Struct('<4sIIIII')
+_UINT = struct.Struct('<I')
+
+
+class _ReloadingMap(object):
+    """Base class of user project maps which are reloaded when changed.
+
+    Reloading builds a new index and swaps it in, so lookups never see a
+    half loaded map.
+
+    """
+
+    def __init__(self, path, check_interval=0):
+        self.path = path
+        self.check_interval = check_interval
+        self._index = {}
+        self._mtime = None
+        self._next_check = 0
+        self._reload_lock = threading.Lock()
+        self.load()
+
+    def get(self, username, default=None):
+        """Return the set of project ids of a user."""
+        self._check_reload()
+        return self._index.get(username, default)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def __len__(self):
+        return len(self._index)
+
+    def items(self):
+        """Iterate over (user name, project ids) pairs."""
+        return self._index.items()
+
+    def users_of(self, project_id):
+        """Return the names of the users mapped to a project."""
+        raise NotImplementedError()
+
+    def load(self):
+        raise NotImplementedError()
+
+    def _check_reload(self):
+        if self.check_interval <= 0 or time.time() < self._next_check:
+            return
+        # Only one thread reloads, the others carry on with the current map
+        if not self._reload_lock.acquire(False):
+            return
+        try:
+            self._next_check = time.time() + self.check_interval
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self.load()
+            except Exception:
+                LOG.exception('Could not reload %s, keeping the previous '
+                              'user project map', self.path)
+        finally:
+            self._reload_lock.release()
+
+
+class UserProjectMap(_ReloadingMap):
+    """Projects granted to LDAP users by the user project map file.
+
+    The file maps user names to lists of project names. The names are
+    resolved to project ids when the file is loaded, and the file is
+    loaded again when its modification time changes.
+
+    Every user is mapped to a frozenset of project ids. Users with the same
+    projects share a single frozenset, and all sets share the project id
+    strings, which keeps large maps small. users_of() builds a reverse
+    index on first use, which takes about as much memory again in every
+    keystone process; MappedUserProjectMap doesn't need one.
+
+    """
+
+    def __init__(self, path, resolve_project_names, check_interval=0,
+                 file_format='json'):
+        self.file_format = file_format
+        self._resolve_project_names = resolve_project_names
+        self._reverse = None
+        super(UserProjectMap, self).__init__(path, check_interval)
+
+    def users_of(self, project_id):
+        self._check_reload()
+        index = self._index
+        reverse = self._reverse
+        if reverse is None or reverse[0] is not index:
+            # built on first use, as most deployments never need it
+            users = collections.defaultdict(list)
+            for username, project_ids in index.items():
+                for mapped_project_id in project_ids:
+                    users[mapped_project_id].append(username)
+            reverse = (index, dict(users))
+            self._reverse = reverse
+        return reverse[1].get(project_id, ())
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'r') as f:
+            if self.file_format == 'yaml':
+                usermap = yaml.safe_load(f)
+            else:
+                usermap = json.load(f)
+
+        names = set()
+        for projectnames in usermap.values():
+            names.update(projectnames)
+        projectids = self._resolve_project_names(names)
+        missing = names.difference(projectids)
+        if missing:
+            LOG.warning('Projects in %(path)s not found: %(names)s',
+                        {'path': self.path,
+                         'names': ', '.join(sorted(missing))})
+
+        index = {}
+        # lists of project names -> frozenset of ids, and the frozensets
+        # themselves so that equal sets are only kept once
+        by_names = {}
+        shared = {}
+        for user, projectnames in usermap.items():
+            key = tuple(projectnames)
+            projects = by_names.get(key)
+            if projects is None:
+                projects = frozenset(projectids[name] for name in key
+                                     if name in projectids)
+                projects = shared.setdefault(projects, projects)
+                by_names[key] = projects
+            index[user] = projects
+        self._index = index
+        self._mtime = mtime
+        LOG.info('Loaded %(count)d users from %(path)s',
+                 {'count': len(index), 'path': self.path})
+
+
+class _MappedIndex(object):
+    """Lookups in a compiled user project map without deserialising it.
+
+    See compile_user_project_map() for the layout of the file.
+
+    """
+
+    def __init__(self, mm):
+        self._mm = mm
+        (magic, version, self._users, projects, entries,
+         names_size) = _INDEX_HEADER.unpack_from(mm, 0)
+        if magic != _INDEX_MAGIC:
+            raise ValueError('Not a compiled user project map')
+        if version != _INDEX_VERSION:
+            raise ValueError('Compiled user project map of version %d, '
+                             'recompile it' % version)
+        self._projects_count = projects
+        pos = _INDEX_HEADER.size
+        self._name_offsets = pos
+        pos += _UINT.size * (self._users + 1)
+        self._list_offsets = pos
+        pos += _UINT.size * (self._users + 1)
+        self._list = pos
+        pos += _UINT.size * entries
+        self._project_offsets = pos
+        pos += _UINT.size * (projects + 1)
+        self._member_offsets = pos
+        pos += _UINT.size * (projects + 1)
+        self._member_list = pos
+        pos += _UINT.size * entries
+        self._names = pos
+        self._project_ids = pos + names_size
+
+    def __len__(self):
+        return self._users
+
+    def _uint(self, base, i):
+        return _UINT.unpack_from(self._mm, base + _UINT.size * i)[0]
+
+    def _name(self, i):
+        return self._mm[self._names + self._uint(self._name_offsets, i):
+                        self._names + self._uint(self._name_offsets, i + 1)]
+
+    def _project_id(self, k):
+        start = self._project_ids + self._uint(self._project_offsets, k)
+        end = self._project_ids + self._uint(self._project_offsets, k + 1)
+        return self._mm[start:end]
+
+    def _users_of(self, k):
+        return [self._name(self._uint(self._member_list, j)).decode('utf-8')
+                for j in range(self._uint(self._member_offsets, k),
+                               self._uint(self._member_offsets, k + 1))]
+
+    def _projects(self, i):
+        projects = set()
+        for j in range(self._uint(self._list_offsets, i),
+                       self._uint(self._list_offsets, i + 1)):
+            k = self._uint(self._list, j)
+            projects.add(self._project_id(k).decode('utf-8'))
+        return frozenset(projects)
+
+    def get(self, username, default=None):
+        key = username.encode('utf-8')
+        # the user names are sorted, so binary search them
+        lo, hi = 0, self._users
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = self._name(mid)
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return self._projects(mid)
+        return default
+
+    def items(self):
+        for i in range(self._users):
+            yield self._name(i).decode('utf-8'), self._projects(i)
+
+    def users_of(self, project_id):
+        key = project_id.encode('utf-8')
+        # the project ids are sorted as well
+        lo, hi = 0, self._projects_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._project_id(mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return self._users_of(mid)
+        return ()
+
+
+class MappedUserProjectMap(_ReloadingMap):
+    """User project map served from a compiled, memory mapped index.
+
+    The index is created offline from the JSON map with
+    ``hybrid_manage.py compile_user_project_map``. All keystone processes
+    on a host share its pages through the page cache and opening it takes
+    no time regardless of its size. The index has a section by project as
+    well, so users_of() doesn't need a reverse index in memory either.
+
+    """
+
+    def users_of(self, project_id):
+        self._check_reload()
+        return self._index.users_of(project_id)
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            index = _MappedIndex(mm)
+        except Exception:
+            mm.close()
+            raise
+        # Lookups in flight may still use the previous mapping, so leave
+        # closing it to the garbage collector
+        self._index = index
+        self._mtime = mtime
+        LOG.info('Mapped %(count)d users from %(path)s',
+                 {'count': len(index), 'path': self.path})
+
+
+def _write_uints(f, values):
+    values = list(values)
+    for i in range(0, len(values), 65536):
+        chunk = values[i:i + 65536]
+        f.write(struct.pack('<%dI' % len(chunk), *chunk))
+
+
+def compile_user_project_map(usermap, path):
+    """Write (user name, project ids) pairs as a compiled index file.
+
+    All integers are unsigned 32 bit little endian. The file contains, in
+    this order:
+
+    * the header: magic, version, number of users, number of projects,
+      number of project list entries and size of the user name blob
+    * offsets of each user name in the name blob (users + 1)
+    * offsets of each user's projects in the project list (users + 1)
+    * the project list: indexes into the project id table
+    * offsets of each project id in the project id blob (projects + 1)
+    * offsets of each project's users in the member list (projects + 1)
+    * the member list: indexes of the users, the reverse of the project
+      list
+    * the UTF-8 encoded user names, sorted
+    * the UTF-8 encoded project ids, sorted
+
+    The file is written next to ``path`` and renamed into place, so running
+    keystone processes pick up either the old or the new index.
+
+    """
+    users = sorted((name.encode('utf-8'),
+                    sorted(project_id.encode('utf-8')
+                           for project_id in projects))
+                   for name, projects in usermap)
+    project_ids = sorted(set(project_id for name, projects in users
+                             for project_id in projects))
+    project_index = dict((project_id, k)
+                         for k, project_id in enumerate(project_ids))
+    name_offsets = [0]
+    list_offsets = [0]
+    project_list = []
+    members = [[] for project_id in project_ids]
+    for i, (name, projects) in enumerate(users):
+        name_offsets.append(name_offsets[-1] + len(name))
+        for project_id in projects:
+            k = project_index[project_id]
+            project_list.append(k)
+            members[k].append(i)
+        list_offsets.append(len(project_list))
+    project_offsets = [0]
+    member_offsets = [0]
+    for project_id, member_list in zip(project_ids, members):
+        project_offsets.append(project_offsets[-1] + len(project_id))
+        member_offsets.append(member_offsets[-1] + len(member_list))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, len(users),
+                                   len(project_ids), len(project_list),
+                                   name_offsets[-1]))
+        _write_uints(f, name_offsets)
+        _write_uints(f, list_offsets)
+        _write_uints(f, project_list)
+        _write_uints(f, project_offsets)
+        _write_uints(f, member_offsets)
+        _write_uints(f, (i for member_list in members for i in member_list))
+        for name, projects in users:
+            f.write(name)
+        for project_id in project_ids:
+            f.write(project_id)
+    os.rename(tmp_path, path)
+
+
+def resolve_project_names(names):
+    """Map project names in the default domain to their ids.
+
+    The names are resolved with a single query (per chunk of names)
+    instead of one query per project.
+
+    """
+    names = list(names)
+    projectids = {}
+    with sql.transaction() as session:
+        for i in range(0, len(names), hybrid_common.BATCH_SIZE):
+            query = session.query(resource_sql.Project.name,
+                                  resource_sql.Project.id)
+            query = query.filter(
+                resource_sql.Project.domain_id ==
+                CONF.identity.default_domain_id)
+            query = query.filter(resource_sql.Project.name.in_(
+                names[i:i + hybrid_common.BATCH_SIZE]))
+            projectids.update(query.all())
+    return projectids
 
 
-class Assignment(sql_assign.Assignment):
-    _default_roles = list()
-    _default_project = None
+class EffectiveAssignmentIndex(object):
+    """The projects each LDAP user gets the default roles on.
 
+    These are the default project, the user's projects in the user project
+    map and the projects the user has a role on in SQL. The index is kept
+    both by user and by project. Updates replace the affected sets instead
+    of changing them in place, so that readers can iterate over them
+    without locking.
+
+    """
+
+    def __init__(self, by_user, by_project, built_for):
+        self._by_user = by_user
+        self._by_project = by_project
+        self._lock = threading.Lock()
+        # what the index was built from, see Assignment._assignment_index()
+        self.built_for = built_for
+        self.expires = (time.time() +
+                        CONF.ldap_hybrid.effective_assignment_index_ttl)
+
+    def __len__(self):
+        return len(self._by_user)
+
+    def projects_of(self, user_id):
+        return self._by_user.get(user_id)
+
+    def users_of(self, project_id):
+        return self._by_project.get(project_id, frozenset())
+
+    def items(self):
+        """Iterate over (user id, project ids) pairs."""
+        return list(self._by_user.items())
+
+    def update(self, user_id, project_ids):
+        """Set the projects of a user, None removes the user."""
+        with self._lock:
+            old = self._by_user.get(user_id, frozenset())
+            new = project_ids or frozenset()
+            for project_id in old - new:
+                self._by_project[project_id] = (
+                    self._by_project[project_id] - frozenset([user_id]))
+            for project_id in new - old:
+                self._by_project[project_id] = (
+                    self._by_project.get(project_id, frozenset()) |
+                    frozenset([user_id]))
+            if project_ids is None:
+                self._by_user.pop(user_id, None)
+            else:
+                self._by_user[user_id] = project_ids
+
+
+class Assignment(hybrid_common.LdapUserAssignmentMixin,
+                 sql_assign.Assignment):
     def __init__(self, *args, **kwargs):
         super(Assignment, self).__init__(*args, **kwargs)
         self.ldap_user = ldap_backend.UserApi(CONF)
+        self.membership_cache = hybrid_common.membership_cache()
+        self.mirror = hybrid_common.directory_mirror(self.ldap_user)
 
         self.resource_driver = manager.load_driver(
             'keystone.resource', self.default_resource_driver())
+        self.defaults = hybrid_common.ResolvedDefaults(self.resource_driver)
+        hybrid_common.configure_metrics()
 
-        with open('/etc/keystone/user-project-map.json', 'r') as f:
-            self.userprojectmap = yaml.load(f)
-        projectidcache = {}
-        for user in self.userprojectmap:
-            projectids = {}
-            for projectname in self.userprojectmap[user]:
-                try:
-                    projectid = projectidcache[projectname]
-                except:
-                    # cache miss - need to fetch from DB
-                    try:
-                        project = self.resource_driver.get_project_by_name(
-                            projectname, CONF.identity.default_domain_id)
-                        projectid = project['id']
-                        projectidcache[projectname] = project['id']
-                    except:
-                        pass
-                projectids[projectid] = 1
-            self.userprojectmap[user] = projectids
+        if CONF.ldap_hybrid.user_project_map_index:
+            self.userprojectmap = MappedUserProjectMap(
+                CONF.ldap_hybrid.user_project_map_index,
+                CONF.ldap_hybrid.user_project_map_check_interval)
+        else:
+            self.userprojectmap = UserProjectMap(
+                CONF.ldap_hybrid.user_project_map,
+                resolve_project_names,
+                CONF.ldap_hybrid.user_project_map_check_interval,
+                CONF.ldap_hybrid.user_project_map_format)
+        self._index = None
+        self._index_lock = threading.Lock()
 
+    @hybrid_common.timed('assignment.get_metadata')
+    @hybrid_common.memoised('assignment.get_metadata')
     def _get_metadata(self, user_id=None, tenant_id=None,
                       domain_id=None, group_id=None, session=None):
+        if CONF.ldap_hybrid.trust_materialised_assignments:
+            return super(Assignment, self)._get_metadata(
+                user_id, tenant_id, domain_id, group_id, session)
         # We only want to apply 'default_roles' to users from LDAP, so
         # check if this is an LDAP User first
-        is_ldap = False
-        try:
-            user = self.ldap_user.get(user_id)
-            username = user['name']
-        except exception.UserNotFound:
-            # Not an LDAP User
-            username = ""
-        else:
-            is_ldap = True
+        username = self._ldap_user_name(user_id)
 
-        LOG.warning('_get_metadata for user=%(user)s',
-                    {'user': user_id})
+        LOG.debug('_get_metadata for user=%(user)s', {'user': user_id})
         try:
             res = super(Assignment, self)._get_metadata(
                 user_id, tenant_id, domain_id, group_id, session)
@@ -103,108 +548,346 @@ class Assignment(sql_assign.Assignment):
             LOG.debug('MetadataNotFound for user=%(user)s %(t)s'
                       ' - falling back to JSON data',
                       {'user': user_id, 't': tenant_id})
-            if is_ldap and (self.default_project_id == tenant_id or
-                            tenant_id in self.userprojectmap[username]):
-                return {
-                    'roles': [
-                        {'id': role_id} for role_id in self.default_roles
-                    ]
-                }
-            else:
-                raise
+            res = None
         else:
             LOG.debug('found user=%(user)s in DB', {'user': user_id})
-            if is_ldap:
-                roles = res.get('roles', [])
-                res['roles'] = roles + [
-                    {'id': role_id} for role_id in self.default_roles
-                ]
-            return res
+        res = self._merge_default_roles(username, tenant_id, res)
+        if res is None:
+            raise exception.MetadataNotFound()
+        return res
 
-    @property
-    def default_project(self):
-        if self._default_project is None:
-            self._default_project = self.resource_driver.get_project_by_name(
-                CONF.ldap_hybrid.default_project,
-                CONF.identity.default_domain_id)
-        return dict(self._default_project)
+    def _merge_default_roles(self, username, tenant_id, res):
+        """Add the default roles to the SQL metadata of an assignment.
 
-    @property
-    def default_project_id(self):
-        return self.default_project['id']
+        ``username`` is None for non-LDAP users and ``res`` is None if there
+        is no assignment in SQL. Returns None if there is no metadata at
+        all.
 
-    @property
-    def default_roles(self):
-        if not self._default_roles:
-            with sql.transaction() as session:
-                query = session.query(sql_role.RoleTable)
-                query = query.filter(sql_role.RoleTable.name.in_(
-                    CONF.ldap_hybrid.default_roles))
-                role_refs = query.all()
-
-            if len(role_refs) != len(CONF.ldap_hybrid.default_roles):
-                raise exception.RoleNotFound(
-                    message=_('Could not find one or more roles: %s') %
-                    ', '.join(CONF.ldap_hybrid.default_roles))
-
-            self._default_roles = [role_ref.id for role_ref in role_refs]
-        return self._default_roles
+        """
+        if username is None:
+            return res
+        if res is None:
+            if self.default_project_id == tenant_id:
+                return {'roles': self.defaults.role_refs}
+            hybrid_common.METRICS.incr('json_map.lookup')
+            if tenant_id in self.userprojectmap.get(username, ()):
+                return {'roles': self.defaults.role_refs}
+            return None
+        roles = res.get('roles', [])
+        res['roles'] = roles + self.defaults.role_refs
+        return res
 
+    @hybrid_common.timed('assignment.list_role_assignments')
+    @hybrid_common.memoised('assignment.list_role_assignments',
+                            required='user_id')
     def list_role_assignments(self, role_id=None, user_id=None, group_ids=None,
                               domain_id=None, project_ids=None,
                               inherited_to_projects=None):
-        role_assignments = super(Assignment, self).list_role_assignments(
-            role_id=role_id, user_id=user_id, group_ids=group_ids,
-            domain_id=domain_id, project_ids=project_ids,
-            inherited_to_projects=inherited_to_projects)
+        LOG.debug('list_role_assignments for user=%(user)s',
+                  {'user': user_id})
+
+        def list_sql_assignments():
+            return super(Assignment, self).list_role_assignments(
+                role_id=role_id, user_id=user_id, group_ids=group_ids,
+                domain_id=domain_id, project_ids=project_ids,
+                inherited_to_projects=inherited_to_projects)
+
+        if not self._matches_default_assignments(
+                role_id, user_id, group_ids, domain_id, project_ids,
+                inherited_to_projects):
+            # None of the default assignments can pass the filters, so there
+            # is no need to enumerate the LDAP users at all
+            return list_sql_assignments()
+
+        # resolved before the LDAP users are fanned out, so that a failed
+        # lookup can't leave the background search behind
+        roles = [role for role in self.default_roles
+                 if role_id is None or role == role_id]
         if user_id:
-            ldap_users = [self.ldap_user.get_filtered(user_id)]
+            username = self._ldap_user_name(user_id)
+            if username is None:
+                return list_sql_assignments()
+            role_assignments = list_sql_assignments()
+            sql_project_ids = hybrid_common.get_user_project_ids(
+                [user_id]).get(user_id, ())
+            ldap_users = [(user_id, self._effective_project_ids(
+                username, sql_project_ids))]
+        elif CONF.ldap_hybrid.effective_assignment_index:
+            role_assignments = list_sql_assignments()
+            ldap_users = self._indexed_ldap_users(project_ids)
+        elif project_ids and self.default_project_id not in project_ids:
+            # Only the users mapped to these projects and the users with a
+            # role on them in SQL get the default roles on them, so there is
+            # no need to go through all LDAP users
+            role_assignments = list_sql_assignments()
+            ldap_users = self._project_members(project_ids)
         else:
-            ldap_users = self.ldap_user.get_all_filtered(None)
-
-        LOG.warning('xxhybrid list_role_assignments: user=%(user)s',
-                    {'user': user_id})
-        # This will be really slow for setups with lots of users, but there
-        # is not other way to achieve it currently
-        for user in ldap_users:
-            # Skip LDAP User if it already as an assignemt,
-            # else add the default assignment
-            if any(a for a in role_assignments if
-                   ('user_id'in a and a['user_id'] == user['id'])):
-                continue
-            else:
-                for role in self.default_roles:
+            # stream the LDAP users page by page instead of loading the
+            # whole directory into memory. With parallel_fanout they are
+            # fetched while SQL is being queried.
+            role_assignments, ldap_users = hybrid_common.fan_out(
+                list_sql_assignments,
+                lambda sql_result: self._iter_ldap_users_projects())
+            if role_assignments is None:
+                # SQL failed and partial results are fine
+                role_assignments = []
+
+        # Index the assignments which are in SQL already, so that checking
+        # each default assignment is a set lookup instead of a scan of all
+        # assignments
+        existing = set((a['user_id'], a['project_id'], a['role_id'])
+                       for a in role_assignments
+                       if 'user_id' in a and 'project_id' in a)
+        wanted = set(project_ids) if project_ids else None
+        for ldap_user_id, ldap_project_ids in ldap_users:
+            if wanted is not None:
+                ldap_project_ids = wanted.intersection(ldap_project_ids)
+            for project_id in ldap_project_ids:
+                for role in roles:
+                    if (ldap_user_id, project_id, role) in existing:
+                        continue
                     role_assignments.append({
                         'role_id': role,
-                        'project_id': self.default_project_id,
-                        'user_id': user['id']
+                        'project_id': project_id,
+                        'user_id': ldap_user_id
                     })
         return role_assignments
 
-    def list_project_ids_for_user(self, user_id, group_ids, hints):
-        LOG.warning('xxhybrid list_project_ids_for_user: user=%(user)s',
-                    {'user': user_id})
-        project_ids = super(Assignment, self).list_project_ids_for_user(
-            user_id, group_ids, hints)
+    def _matches_default_assignments(self, role_id, user_id, group_ids,
+                                     domain_id, project_ids,
+                                     inherited_to_projects):
+        """Check if any default assignment can pass the given filters.
+
+        Default assignments are direct, non-inherited user assignments of the
+        default roles, see _effective_project_ids() for their projects.
+
+        """
+        if CONF.ldap_hybrid.trust_materialised_assignments:
+            # they are in SQL already
+            return False
+        if domain_id or inherited_to_projects:
+            return False
+        if group_ids and not user_id:
+            return False
+        if role_id and role_id not in self.default_roles:
+            return False
+        return True
+
+    def _effective_project_ids(self, username, sql_project_ids=()):
+        """Return the projects an LDAP user gets the default roles on.
+
+        These are the default project, the user's projects in the user
+        project map and the projects the user has a role on in SQL, exactly
+        those _get_metadata() adds the default roles for.
 
-        # Make sure the default project is in the project list for the user
-        # user_id
+        """
+        hybrid_common.METRICS.incr('json_map.lookup')
+        project_ids = set(self.userprojectmap.get(username, ()))
+        project_ids.add(self.default_project_id)
+        project_ids.update(sql_project_ids)
+        return frozenset(project_ids)
+
+    def _fixed_default_project_ids(self, user_id):
+        username = self._ldap_user_name(user_id)
+        if username is None:
+            return frozenset()
+        return self._effective_project_ids(username)
+
+    def _iter_ldap_users_projects(self):
+        """Yield (user id, effective project ids) of all LDAP users."""
+        sql_project_ids = hybrid_common.get_user_project_ids()
+        for user_id, username in hybrid_common.iter_read_through(
+                self.mirror, lambda: self.mirror.iter_user_names(),
+                lambda: hybrid_common.iter_ldap_user_names(self.ldap_user)):
+            yield user_id, self._effective_project_ids(
+                username, sql_project_ids.get(user_id, ()))
+
+    def iter_implicit_assignments(self, sql_project_ids):
+        """Yield (user id, project id, role id) of all default assignments.
+
+        ``sql_project_ids`` is a dict of sets of the projects the users have
+        other roles on in SQL, by user id. See _effective_project_ids().
+
+        """
+        role_ids = self.default_roles
+        for user_id, username in hybrid_common.iter_read_through(
+                self.mirror, lambda: self.mirror.iter_user_names(),
+                lambda: hybrid_common.iter_ldap_user_names(self.ldap_user)):
+            for project_id in self._effective_project_ids(
+                    username, sql_project_ids.get(user_id, ())):
+                for role_id in role_ids:
+                    yield user_id, project_id, role_id
+
+    def _project_members(self, project_ids):
+        """Return (user id, effective project ids) of project members.
+
+        The members are the LDAP users which get the default roles on any of
+        the projects. Finding them takes time in proportion to their number,
+        not to the size of the directory.
+
+        """
+        mapped_names = set()
         for project_id in project_ids:
-            if project_id == self.default_project_id:
-                return project_ids
+            mapped_names.update(self.userprojectmap.users_of(project_id))
+        usernames = {}
+        if mapped_names:
+            found = hybrid_common.read_through(
+                self.mirror, lambda: self.mirror.find_ids(mapped_names),
+                lambda: hybrid_common.find_ldap_user_ids(self.ldap_user,
+                                                         mapped_names))
+            usernames.update((user_id, name) for name, user_id in
+                             found.items())
+        sql_user_ids = hybrid_common.get_project_user_ids(project_ids)
+        sql_user_ids.difference_update(usernames)
+        if sql_user_ids:
+            usernames.update((user_id, name) for user_id, name in
+                             self._ldap_user_names(sql_user_ids).items()
+                             if name is not None)
+        if not usernames:
+            return []
+        sql_project_ids = hybrid_common.get_user_project_ids(usernames)
+        members = []
+        for user_id, name in usernames.items():
+            members.append((user_id, self._effective_project_ids(
+                name, sql_project_ids.get(user_id, ()))))
+        return members
 
-        # We only want to apply 'default_project' to users from LDAP, so
-        # check if this is an LDAP User first
+    def _indexed_ldap_users(self, project_ids):
+        """Like _iter_ldap_users_projects(), from the index."""
+        index = self._assignment_index()
+        if not project_ids:
+            return index.items()
+        user_ids = set()
+        for project_id in project_ids:
+            user_ids.update(index.users_of(project_id))
+        return [(user_id, index.projects_of(user_id))
+                for user_id in user_ids]
+
+    def _assignment_index(self):
+        """Return the effective assignment index, built when needed.
+
+        The index is rebuilt when it expired, or when the user project map
+        or the default project changed since it was built. Only one thread
+        rebuilds it, the others keep using the previous index meanwhile.
+        While the LDAP circuit breaker is open, the previous index is kept.
+
+        """
+        index = self._index
+        built_for = (self.userprojectmap._mtime, self.default_project_id)
+        if (index is not None and index.built_for == built_for and
+                index.expires > time.time()):
+            return index
+        if not self._index_lock.acquire(index is None):
+            return index
         try:
-            user = self.ldap_user.get(user_id)
-            username = user['name']
-        except exception.UserNotFound:
-            # Not an LDAP User
-            pass
-        else:
-            if username in self.userprojectmap:
-                project_ids.extend(self.userprojectmap[username].keys())
-            else:
-                project_ids.append(self.default_project_id)
+            if self._index is not index:
+                # built by another thread while waiting for the lock
+                return self._index
+            by_user = {}
+            by_project = collections.defaultdict(set)
+            # users with the same projects share a single frozenset
+            shared = {}
+            try:
+                for user_id, project_ids in self._iter_ldap_users_projects():
+                    project_ids = shared.setdefault(project_ids, project_ids)
+                    by_user[user_id] = project_ids
+                    for project_id in project_ids:
+                        by_project[project_id].add(user_id)
+            except hybrid_common.CircuitOpen:
+                if index is None:
+                    raise
+                LOG.warning('LDAP is down, keeping the previous effective '
+                            'assignment index')
+                return index
+            self._index = EffectiveAssignmentIndex(
+                by_user,
+                dict((project_id, frozenset(user_ids))
+                     for project_id, user_ids in by_project.items()),
+                built_for)
+            LOG.info('Indexed the effective assignments of %d LDAP users',
+                     len(by_user))
+            return self._index
+        finally:
+            self._index_lock.release()
+
+    def _assignments_changed(self, user_id=None):
+        """Update the index after SQL assignments of a user changed.
+
+        Without a user, the index is rebuilt on its next use.
+
+        """
+        index = self._index
+        if index is None:
+            return
+        if user_id is None:
+            index.expires = 0
+            return
+        username = self._ldap_user_name(user_id)
+        if username is None:
+            return
+        index.update(user_id, self._effective_project_ids(
+            username,
+            hybrid_common.get_user_project_ids([user_id]).get(user_id, ())))
+
+    def add_role_to_user_and_project(self, user_id, tenant_id, role_id):
+        super(Assignment, self).add_role_to_user_and_project(
+            user_id, tenant_id, role_id)
+        self._assignments_changed(user_id)
+
+    def remove_role_from_user_and_project(self, user_id, tenant_id, role_id):
+        super(Assignment, self).remove_role_from_user_and_project(
+            user_id, tenant_id, role_id)
+        self._assignments_changed(user_id)
+
+    def create_grant(self, role_id, user_id=None, group_id=None,
+                     domain_id=None, project_id=None,
+                     inherited_to_projects=False):
+        super(Assignment, self).create_grant(
+            role_id, user_id=user_id, group_id=group_id, domain_id=domain_id,
+            project_id=project_id,
+            inherited_to_projects=inherited_to_projects)
+        if user_id and project_id:
+            self._assignments_changed(user_id)
+
+    def delete_grant(self, role_id, user_id=None, group_id=None,
+                     domain_id=None, project_id=None,
+                     inherited_to_projects=False):
+        super(Assignment, self).delete_grant(
+            role_id, user_id=user_id, group_id=group_id, domain_id=domain_id,
+            project_id=project_id,
+            inherited_to_projects=inherited_to_projects)
+        if user_id and project_id:
+            self._assignments_changed(user_id)
+
+    def delete_project_assignments(self, project_id):
+        super(Assignment, self).delete_project_assignments(project_id)
+        self._assignments_changed()
+
+    def delete_role_assignments(self, role_id):
+        super(Assignment, self).delete_role_assignments(role_id)
+        self._assignments_changed()
+
+    def delete_user(self, user_id):
+        super(Assignment, self).delete_user(user_id)
+        self._assignments_changed(user_id)
+
+    @hybrid_common.timed('assignment.list_project_ids_for_user')
+    @hybrid_common.memoised('assignment.list_project_ids_for_user')
+    def list_project_ids_for_user(self, user_id, group_ids, hints):
+        LOG.debug('list_project_ids_for_user for user=%(user)s',
+                  {'user': user_id})
+        project_ids = super(Assignment, self).list_project_ids_for_user(
+            user_id, group_ids, hints)
+        if CONF.ldap_hybrid.trust_materialised_assignments:
+            return project_ids
+
+        # We only want to apply 'default_project' and the user project map
+        # to users from LDAP, so check if this is an LDAP User first
+        username = self._ldap_user_name(user_id)
+        if username is not None:
+            listed = set(project_ids)
+            for project_id in self._effective_project_ids(username):
+                if project_id not in listed:
+                    project_ids.append(project_id)
 
         return project_ids
@@ -0,0 +1,189 @@
+# Copyright 2015 SUSE Linux Products GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Management commands for the hybrid backends, in the style of
+keystone-manage::
+
+    python hybrid_manage.py --config-file /etc/keystone/keystone.conf \
+        compile_user_project_map
+
+"""
+
+import sys
+
+from keystone.assignment.backends import hybrid_json_assignment
+from keystone.common import hybrid_common
+from keystone.common import manager
+from keystone.common import sql
+from keystone import config
+from keystone.identity.backends import hybrid_identity
+from keystone.identity.backends import ldap as ldap_backend
+
+from oslo_config import cfg
+from oslo_log import log
+
+CONF = cfg.CONF
+LOG = log.getLogger(__name__)
+
+
+class BaseApp(object):
+
+    name = None
+
+    @classmethod
+    def add_argument_parser(cls, subparsers):
+        parser = subparsers.add_parser(cls.name, help=cls.__doc__)
+        parser.set_defaults(cmd_class=cls)
+        return parser
+
+
+class CompileUserProjectMap(BaseApp):
+    """Compile the user project map into a memory mapped index."""
+
+    name = 'compile_user_project_map'
+
+    @classmethod
+    def add_argument_parser(cls, subparsers):
+        parser = super(CompileUserProjectMap,
+                       cls).add_argument_parser(subparsers)
+        parser.add_argument('--source', default=None,
+                            help='User project map to compile. Defaults to '
+                                 '[ldap_hybrid] user_project_map.')
+        parser.add_argument('--output', default=None,
+                            help='Index file to write. Defaults to '
+                                 '[ldap_hybrid] user_project_map_index.')
+        return parser
+
+    @staticmethod
+    def main():
+        source = CONF.command.source or CONF.ldap_hybrid.user_project_map
+        output = (CONF.command.output or
+                  CONF.ldap_hybrid.user_project_map_index)
+        if not output:
+            LOG.error('No output file, use --output or set '
+                      '[ldap_hybrid] user_project_map_index')
+            sys.exit(1)
+        usermap = hybrid_json_assignment.UserProjectMap(
+            source, hybrid_json_assignment.resolve_project_names,
+            file_format=CONF.ldap_hybrid.user_project_map_format)
+        hybrid_json_assignment.compile_user_project_map(usermap.items(),
+                                                        output)
+        LOG.info('Compiled %(count)d users into %(output)s',
+                 {'count': len(usermap), 'output': output})
+
+
+class MaterialiseAssignments(BaseApp):
+    """Write the default assignments of LDAP users to SQL."""
+
+    name = 'materialise_assignments'
+
+    @classmethod
+    def add_argument_parser(cls, subparsers):
+        parser = super(MaterialiseAssignments,
+                       cls).add_argument_parser(subparsers)
+        parser.add_argument('--rebuild', action='store_true', default=False,
+                            help='Remove all materialised assignments and '
+                                 'write them again, instead of only the '
+                                 'changes since the last run.')
+        return parser
+
+    @staticmethod
+    def main():
+        driver = manager.load_driver('keystone.assignment',
+                                     CONF.assignment.driver)
+        if not hasattr(driver, 'iter_implicit_assignments'):
+            LOG.error('The [assignment] driver is not a hybrid assignment '
+                      'driver')
+            sys.exit(1)
+        added, removed = hybrid_common.materialise_assignments(
+            driver, rebuild=CONF.command.rebuild)
+        LOG.info('Added %(added)d and removed %(removed)d default '
+                 'assignments', {'added': added, 'removed': removed})
+
+
+class SyncUserOrigins(BaseApp):
+    """Record the origin of all SQL and LDAP users in the origin index."""
+
+    name = 'sync_user_origins'
+
+    @staticmethod
+    def main():
+        if not CONF.ldap_hybrid.use_origin_index:
+            LOG.error('The origin index is disabled, set '
+                      '[ldap_hybrid] use_origin_index to true first')
+            sys.exit(1)
+        count = hybrid_identity.Identity().sync_origin_index()
+        LOG.info('Recorded the origin of %d users', count)
+
+
+class SyncDirectory(BaseApp):
+    """Copy the changed LDAP users into the directory mirror."""
+
+    name = 'sync_directory'
+
+    @classmethod
+    def add_argument_parser(cls, subparsers):
+        parser = super(SyncDirectory, cls).add_argument_parser(subparsers)
+        parser.add_argument('--full', action='store_true', default=None,
+                            help='Copy all users and remove the users '
+                                 'deleted from LDAP, even if a full sync '
+                                 'is not due yet.')
+        return parser
+
+    @staticmethod
+    def main():
+        if not CONF.ldap_hybrid.directory_mirror:
+            LOG.error('The directory mirror is disabled, set '
+                      '[ldap_hybrid] directory_mirror to true first')
+            sys.exit(1)
+        mirror = hybrid_common.DirectoryMirror(ldap_backend.UserApi(CONF))
+        count = mirror.sync(full=CONF.command.full)
+        LOG.info('Synced %d LDAP users', count)
+
+
+CMDS = [
+    CompileUserProjectMap,
+    MaterialiseAssignments,
+    SyncDirectory,
+    SyncUserOrigins,
+]
+
+
+def add_command_parsers(subparsers):
+    for cmd in CMDS:
+        cmd.add_argument_parser(subparsers)
+
+
+command_opt = cfg.SubCommandOpt('command',
+                                title='Commands',
+                                help='Available commands',
+                                handler=add_command_parsers)
+
+
+def main(argv=None, config_files=None):
+    if argv is None:
+        argv = sys.argv
+    CONF.register_cli_opt(command_opt)
+    config.configure()
+    sql.initialize()
+    CONF(args=argv[1:],
+         project='keystone',
+         usage='%(prog)s [' + '|'.join([cmd.name for cmd in CMDS]) + ']',
+         default_config_files=config_files)
+    config.setup_logging()
+    CONF.command.cmd_class.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,9 +12,29 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import itertools
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
 import uuid
+
+import ldap
+import mock
+import sqlalchemy
+
+from keystone.assignment.backends import hybrid_json_assignment
+from keystone.assignment.backends import sql as sql_assign
+from keystone.common import driver_hints
+from keystone.common import hybrid_common
 from keystone.common import ldap as common_ldap
+from keystone.common import sql
 from keystone import config
+from keystone import exception
+from keystone.identity.backends import hybrid_identity
+from keystone.identity.backends import sql as sql_ident
 from keystone import tests
 from keystone.tests import fakeldap
 from keystone.tests import test_backend
@@ -23,9 +43,28 @@ from keystone.tests import test_backend_sql
 DEFAULT_DOMAIN_ID = config.CONF.identity.default_domain_id
 
 
-class HybridIdentity(test_backend_sql.SqlIdentity, test_backend.IdentityTests):
+class PagingFakeLdap(fakeldap.FakeLdap):
+    """FakeLdap which honours the cookie of the paged results control."""
+
+    pages = 0
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None,
+                resp_ctrl_classes=None):
+        params = fakeldap.PendingRequests[msgid]
+        request_ctrl = params[5][0]
+        offset = int(request_ctrl.cookie or 0)
+        results = self.search_s(*params[:5])
+        end = offset + request_ctrl.size
+        cookie = str(end) if end < len(results) else ''
+        PagingFakeLdap.pages += 1
+        ctrl = ldap.controls.SimplePagedResultsControl(
+            True, size=request_ctrl.size, cookie=cookie)
+        return (ldap.RES_SEARCH_RESULT, results[offset:end], msgid, [ctrl])
+
+
+class HybridTests(test_backend_sql.SqlTests):
     def setUp(self):
-        super(HybridIdentity, self).setUp()
+        super(HybridTests, self).setUp()
         common_ldap.register_handler('fake://', fakeldap.FakeLdap)
         tenant = {'id': uuid.uuid4().hex,
                   'name': 'demo',
@@ -33,16 +72,45 @@ class HybridIdentity(test_backend_sql.SqlIdentity, test_backend.IdentityTests):
         self.assignment_api.create_project(tenant['id'], tenant)
 
     def config_files(self):
-        config_files = super(HybridIdentity, self).config_files()
+        config_files = super(HybridTests, self).config_files()
         config_files.append(tests.dirs.tests_conf('backend_hybrid.conf'))
         return config_files
 
     def config_overrides(self):
-        super(HybridIdentity, self).config_overrides()
+        super(HybridTests, self).config_overrides()
         self.config_fixture.config(
             group='identity',
             driver='keystone.identity.backends.hybrid.Identity')
 
+    def create_ldap_user(self, name=None, password=None):
+        user_id = uuid.uuid4().hex
+        user = {'id': user_id,
+                'name': name or user_id,
+                'enabled': True}
+        if password:
+            user['password'] = password
+        self.identity_api.driver.ldap.create_user(user_id, user)
+        return user_id
+
+    def create_sql_user(self):
+        return self.identity_api.create_user(
+            {'name': uuid.uuid4().hex, 'domain_id': DEFAULT_DOMAIN_ID,
+             'password': uuid.uuid4().hex, 'enabled': True})
+
+    def create_role(self):
+        role = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex}
+        self.assignment_api.create_role(role['id'], role)
+        return role
+
+    def create_project(self):
+        project = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex,
+                   'domain_id': DEFAULT_DOMAIN_ID}
+        self.assignment_api.create_project(project['id'], project)
+        return project
+
+
+class HybridIdentity(HybridTests, test_backend_sql.SqlIdentity,
+                     test_backend.IdentityTests):
     def test_delete_project_with_user_association(self):
         self.skipTest('Conflicts with default project setting')
 
@@ -69,3 +137,1194 @@ class HybridIdentity(test_backend_sql.SqlIdentity, test_backend.IdentityTests):
 
     def test_multi_role_grant_by_user_group_on_project_domain(self):
         self.skipTest('Conflicts with default project setting')
+
+
+class HybridLdapPaging(HybridTests):
+    def setUp(self):
+        super(HybridLdapPaging, self).setUp()
+        common_ldap.register_handler('fake://', PagingFakeLdap)
+        PagingFakeLdap.pages = 0
+        self.user_api = self.identity_api.driver.ldap.user
+
+    def test_iter_ldap_users_fetches_page_by_page(self):
+        user_ids = set(self.create_ldap_user() for x in range(10))
+        users = hybrid_common.iter_ldap_users(self.user_api, page_size=3)
+        # nothing is fetched before the first user is consumed and only a
+        # single page is held while iterating over it
+        self.assertEqual(0, PagingFakeLdap.pages)
+        first = next(users)
+        self.assertEqual(1, PagingFakeLdap.pages)
+        seen = set([first['id']]) | set(user['id'] for user in users)
+        self.assertEqual(user_ids, seen)
+        self.assertEqual(4, PagingFakeLdap.pages)
+
+    def test_unpaged(self):
+        user_ids = set(self.create_ldap_user() for x in range(10))
+        self.config_fixture.config(group='ldap_hybrid', ldap_page_size=0)
+        users = hybrid_common.iter_ldap_users(self.user_api)
+        self.assertEqual(user_ids, set(user['id'] for user in users))
+        users = self.identity_api.driver.list_users(driver_hints.Hints())
+        self.assertTrue(user_ids.issubset(set(u['id'] for u in users)))
+        # the paged results control was never sent
+        self.assertEqual(0, PagingFakeLdap.pages)
+
+    def test_list_users_includes_every_page(self):
+        user_ids = set(self.create_ldap_user() for x in range(10))
+        self.config_fixture.config(group='ldap_hybrid', ldap_page_size=4)
+        users = self.identity_api.driver.list_users(driver_hints.Hints())
+        self.assertTrue(user_ids.issubset(set(u['id'] for u in users)))
+
+    def test_list_users_stops_paging_at_limit(self):
+        name = uuid.uuid4().hex
+        for x in range(10):
+            self.create_ldap_user(name=name)
+        hints = driver_hints.Hints()
+        hints.add_filter('name', name)
+        hints.set_limit(3)
+        users = self.identity_api.driver.list_users(hints)
+        self.assertEqual(3, len(users))
+        self.assertEqual([name] * 3, [user['name'] for user in users])
+        self.assertTrue(hints.limit['truncated'])
+        # the name filter was applied by both backends
+        self.assertEqual([], hints.filters)
+        self.assertEqual(1, PagingFakeLdap.pages)
+
+    def test_list_users_limit_not_reached(self):
+        name = uuid.uuid4().hex
+        for x in range(2):
+            self.create_ldap_user(name=name)
+        hints = driver_hints.Hints()
+        hints.add_filter('name', name)
+        hints.set_limit(3)
+        users = self.identity_api.driver.list_users(hints)
+        self.assertEqual(2, len(users))
+        self.assertFalse(hints.limit['truncated'])
+
+
+class HybridAuthentication(HybridTests):
+    def test_ldap_login_binds_directly_when_known(self):
+        password = uuid.uuid4().hex
+        user_id = self.create_ldap_user(password=password)
+        driver = self.identity_api.driver
+        driver.authenticate(user_id, password)
+        with mock.patch.object(driver.ldap.user, '_ldap_get') as ldap_get:
+            user = driver.authenticate(user_id, password)
+            self.assertRaises(AssertionError, driver.authenticate,
+                              user_id, uuid.uuid4().hex)
+        self.assertEqual(user_id, user['id'])
+        self.assertNotIn('password', user)
+        # a wrong password neither looks the user up again nor forgets
+        # the DN
+        self.assertFalse(ldap_get.called)
+        self.assertIsNot(hybrid_common.MISSING,
+                         driver.ldap_user_cache.get(user_id))
+
+    def test_ldap_login_with_stale_dn(self):
+        password = uuid.uuid4().hex
+        user_id = self.create_ldap_user(password=password)
+        driver = self.identity_api.driver
+        driver.ldap_user_cache.set(user_id, 'cn=moved,cn=example,cn=com')
+        user = driver.authenticate(user_id, password)
+        self.assertEqual(user_id, user['id'])
+        self.assertNotEqual('cn=moved,cn=example,cn=com',
+                            driver.ldap_user_cache.get(user_id))
+
+    def test_ldap_login_when_known_sees_disabled_user(self):
+        password = uuid.uuid4().hex
+        user_id = self.create_ldap_user(password=password)
+        driver = self.identity_api.driver
+        driver.authenticate(user_id, password)
+        # disabled in LDAP directly, not through keystone
+        driver.ldap.update_user(user_id, {'enabled': False})
+        with mock.patch.object(driver.ldap.user, '_ldap_get') as ldap_get:
+            user = driver.authenticate(user_id, password)
+        self.assertFalse(ldap_get.called)
+        self.assertFalse(user['enabled'])
+
+    def test_ldap_login_search_and_bind(self):
+        self.config_fixture.config(group='ldap_hybrid',
+                                   ldap_search_and_bind=True)
+        password = uuid.uuid4().hex
+        user_id = self.create_ldap_user(password=password)
+        user = self.identity_api.driver.authenticate(user_id, password)
+        self.assertEqual(user_id, user['id'])
+        self.assertEqual(DEFAULT_DOMAIN_ID, user['domain_id'])
+
+    def test_concurrent_logins_dont_mix_up_users(self):
+        driver = self.identity_api.driver
+        password = uuid.uuid4().hex
+        ldap_user_ids = [self.create_ldap_user(password=password)
+                         for i in range(5)]
+        sql_user = self.identity_api.create_user(
+            {'name': uuid.uuid4().hex, 'domain_id': DEFAULT_DOMAIN_ID,
+             'password': password, 'enabled': True})
+        errors = []
+
+        def ldap_logins(user_id):
+            try:
+                for i in range(20):
+                    user = driver.authenticate(user_id, password)
+                    self.assertEqual(user_id, user['id'])
+                    self.assertEqual(DEFAULT_DOMAIN_ID, user['domain_id'])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=ldap_logins, args=(user_id,))
+                   for user_id in ldap_user_ids]
+        for thread in threads:
+            thread.start()
+        # SQL logins in between must never see state left behind by the
+        # concurrent LDAP logins
+        for i in range(20):
+            user = driver.authenticate(sql_user['id'], password)
+            self.assertEqual(sql_user['id'], user['id'])
+            self.assertTrue(driver.is_domain_aware())
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+
+class HybridAuthCache(HybridTests):
+    def config_overrides(self):
+        super(HybridAuthCache, self).config_overrides()
+        self.config_fixture.config(group='ldap_hybrid', auth_cache_size=100)
+
+    def test_repeated_login_skips_password_check(self):
+        password = uuid.uuid4().hex
+        sql_user = self.identity_api.create_user(
+            {'name': uuid.uuid4().hex, 'domain_id': DEFAULT_DOMAIN_ID,
+             'password': password, 'enabled': True})
+        ldap_user_id = self.create_ldap_user(password=password)
+        driver = self.identity_api.driver
+        driver.authenticate(sql_user['id'], password)
+        driver.authenticate(ldap_user_id, password)
+        with mock.patch.object(hybrid_identity.utils,
+                               'check_password') as check_password:
+            with mock.patch.object(driver, '_ldap_bind') as ldap_bind:
+                user = driver.authenticate(sql_user['id'], password)
+                driver.authenticate(ldap_user_id, password)
+        self.assertFalse(check_password.called)
+        self.assertFalse(ldap_bind.called)
+        self.assertEqual(sql_user['id'], user['id'])
+        self.assertRaises(AssertionError, driver.authenticate,
+                          sql_user['id'], uuid.uuid4().hex)
+        # only a keyed hash of the password is kept
+        for entry, expires in driver.auth_cache._data.values():
+            digest, user_ref, version = entry
+            self.assertNotIn(password.encode('utf-8'), digest)
+            self.assertNotIn('password', user_ref)
+
+    def test_update_user_forgets_login(self):
+        password = uuid.uuid4().hex
+        user = self.identity_api.create_user(
+            {'name': uuid.uuid4().hex, 'domain_id': DEFAULT_DOMAIN_ID,
+             'password': password, 'enabled': True})
+        driver = self.identity_api.driver
+        driver.authenticate(user['id'], password)
+        driver.update_user(user['id'], {'password': uuid.uuid4().hex})
+        self.assertRaises(AssertionError, driver.authenticate,
+                          user['id'], password)
+
+    def test_change_by_other_process_forgets_login(self):
+        password = uuid.uuid4().hex
+        user_id = self.create_ldap_user(password=password)
+        driver = self.identity_api.driver
+        driver.authenticate(user_id, password)
+        # another keystone process has its own driver and auth cache
+        other = hybrid_identity.Identity()
+        other._forget_login(user_id)
+        with mock.patch.object(driver, '_ldap_bind') as ldap_bind:
+            driver.authenticate(user_id, password)
+        self.assertTrue(ldap_bind.called)
+
+
+class HybridOriginIndex(HybridTests):
+    def config_overrides(self):
+        super(HybridOriginIndex, self).config_overrides()
+        self.config_fixture.config(group='ldap_hybrid', use_origin_index=True)
+
+    def test_known_ldap_user_skips_sql(self):
+        driver = self.identity_api.driver
+        user_id = self.create_ldap_user()
+        driver.get_user(user_id)
+        with mock.patch.object(sql_ident.Identity, '_get_user') as get_user:
+            user = driver.get_user(user_id)
+            by_name = driver.get_user_by_name(user_id, DEFAULT_DOMAIN_ID)
+        self.assertFalse(get_user.called)
+        self.assertEqual(user_id, user['id'])
+        self.assertEqual(user_id, by_name['id'])
+
+    def test_stale_entry_falls_back(self):
+        driver = self.identity_api.driver
+        user = self.create_sql_user()
+        driver._record_origin(user, hybrid_identity.ORIGIN_LDAP)
+        self.assertEqual(user['id'], driver.get_user(user['id'])['id'])
+        origin = driver._get_origin(sql.get_session(), id=user['id'])
+        self.assertEqual(hybrid_identity.ORIGIN_SQL, origin.origin)
+
+    def test_sync_origin_index(self):
+        driver = self.identity_api.driver
+        ldap_user_id = self.create_ldap_user()
+        sql_user = self.create_sql_user()
+        self.assertTrue(driver.sync_origin_index() >= 2)
+        session = sql.get_session()
+        self.assertEqual(hybrid_identity.ORIGIN_LDAP,
+                         driver._get_origin(session, id=ldap_user_id).origin)
+        self.assertEqual(hybrid_identity.ORIGIN_SQL,
+                         driver._get_origin(session,
+                                            id=sql_user['id']).origin)
+
+    def test_sync_origin_index_replaces_entries(self):
+        driver = self.identity_api.driver
+        sql_user = self.create_sql_user()
+        driver._record_origin(sql_user, hybrid_identity.ORIGIN_LDAP)
+        gone = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex,
+                'domain_id': DEFAULT_DOMAIN_ID}
+        driver._record_origin(gone, hybrid_identity.ORIGIN_SQL)
+        driver.sync_origin_index()
+        session = sql.get_session()
+        self.assertEqual(hybrid_identity.ORIGIN_SQL,
+                         driver._get_origin(session,
+                                            id=sql_user['id']).origin)
+        self.assertIsNone(driver._get_origin(session, id=gone['id']))
+
+
+class HybridDirectoryMirror(HybridTests):
+    def config_overrides(self):
+        super(HybridDirectoryMirror, self).config_overrides()
+        self.config_fixture.config(group='ldap_hybrid', directory_mirror=True)
+
+    def test_reads_served_from_fresh_mirror(self):
+        driver = self.identity_api.driver
+        user_id = self.create_ldap_user()
+        driver.mirror.sync()
+        hints = driver_hints.Hints()
+        hints.add_filter('name', user_id)
+        with mock.patch.object(driver.ldap.user, '_ldap_get') as ldap_get:
+            with mock.patch.object(hybrid_common,
+                                   'iter_ldap_users') as iter_users:
+                user = driver.get_user(user_id)
+                users = driver.list_users(hints)
+        self.assertFalse(ldap_get.called)
+        self.assertFalse(iter_users.called)
+        self.assertEqual(user_id, user['id'])
+        self.assertEqual(DEFAULT_DOMAIN_ID, user['domain_id'])
+        self.assertEqual([user_id], [u['id'] for u in users])
+
+    def test_stale_mirror_used_when_ldap_fails(self):
+        self.config_fixture.config(group='ldap_hybrid',
+                                   directory_max_staleness=-1)
+        user_id = self.create_ldap_user()
+        self.identity_api.driver.mirror.sync()
+        identity_driver = self.identity_api.driver
+        assignment_driver = self.assignment_api.driver
+        with mock.patch.object(identity_driver.ldap.user, '_ldap_get',
+                               side_effect=ldap.SERVER_DOWN):
+            self.assertEqual(user_id, identity_driver.get_user(user_id)['id'])
+        with mock.patch.object(assignment_driver.ldap_user, 'get',
+                               side_effect=ldap.SERVER_DOWN):
+            self.assertEqual(user_id,
+                             assignment_driver._ldap_user_name(user_id))
+
+    def test_full_sync_removes_deleted_users(self):
+        mirror = self.identity_api.driver.mirror
+        user_id = self.create_ldap_user()
+        mirror.sync()
+        self.assertEqual(user_id, mirror.get(user_id)[1]['id'])
+        self.identity_api.driver.ldap.user.delete(user_id)
+        mirror.sync(full=True)
+        self.assertRaises(exception.UserNotFound, mirror.get, user_id)
+
+    def test_concurrent_syncs_are_skipped(self):
+        mirror = self.identity_api.driver.mirror
+        user_id = self.create_ldap_user()
+        mirror.sync()
+        # another process is in the middle of a sync
+        self.assertTrue(mirror._take_lease('other'))
+        with mock.patch.object(hybrid_common,
+                               'iter_ldap_entries') as entries:
+            self.assertEqual(0, mirror.sync(full=True))
+        self.assertFalse(entries.called)
+        self.assertEqual(user_id, mirror.get(user_id)[1]['id'])
+        mirror._release_lease('other')
+        self.assertEqual(1, mirror.sync(full=True))
+
+    def test_incremental_sync_reads_changed_entries(self):
+        mirror = self.identity_api.driver.mirror
+        self.create_ldap_user()
+        mirror.sync()
+        session = sql.get_session()
+        with session.begin():
+            state = session.query(hybrid_common.DirectorySyncState).get(
+                mirror.STATE_ID)
+            state.high_water = '20150101000000Z'
+        with mock.patch.object(hybrid_common, 'iter_ldap_entries',
+                               return_value=iter([])) as entries:
+            self.assertEqual(0, mirror.sync())
+        self.assertIn('(modifyTimestamp>=20150101000000Z)',
+                      entries.call_args[0][1])
+
+
+class HybridCircuitBreaker(HybridTests):
+    def config_overrides(self):
+        super(HybridCircuitBreaker, self).config_overrides()
+        self.config_fixture.config(group='ldap_hybrid',
+                                   ldap_breaker_threshold=2,
+                                   ldap_breaker_reset_timeout=60)
+
+    def setUp(self):
+        super(HybridCircuitBreaker, self).setUp()
+        self.breaker = hybrid_common.LDAP_BREAKER
+        self.breaker.reset()
+        self.addCleanup(self.breaker.reset)
+
+    def test_opens_and_probes(self):
+        down = mock.Mock(side_effect=ldap.SERVER_DOWN)
+        for i in range(2):
+            self.assertRaises(ldap.SERVER_DOWN, self.breaker.call, down)
+        self.assertEqual('open', self.breaker.state)
+        self.assertRaises(hybrid_common.CircuitOpen, self.breaker.call, down)
+        self.assertEqual(2, down.call_count)
+
+        later = time.time() + 61
+        with mock.patch.object(hybrid_common.time, 'time',
+                               return_value=later):
+            # the probe fails, so the breaker stays open
+            self.assertRaises(ldap.SERVER_DOWN, self.breaker.call, down)
+            self.assertEqual('open', self.breaker.state)
+        with mock.patch.object(hybrid_common.time, 'time',
+                               return_value=later + 61):
+            self.assertEqual(1, self.breaker.call(lambda: 1))
+        self.assertEqual('closed', self.breaker.state)
+
+    def test_sql_users_keep_working_while_ldap_is_down(self):
+        self.config_fixture.config(group='ldap_hybrid',
+                                   ldap_search_and_bind=True)
+        password = uuid.uuid4().hex
+        sql_user = self.identity_api.create_user(
+            {'name': uuid.uuid4().hex, 'domain_id': DEFAULT_DOMAIN_ID,
+             'password': password, 'enabled': True})
+        ldap_user_id = self.create_ldap_user()
+        identity_driver = self.identity_api.driver
+        assignment_driver = self.assignment_api.driver
+        assignment_driver.membership_cache.set(ldap_user_id, ldap_user_id,
+                                               ttl=-1)
+        with mock.patch.object(identity_driver.ldap.user, '_ldap_get',
+                               side_effect=ldap.SERVER_DOWN) as ldap_get:
+            for i in range(2):
+                self.assertRaises(ldap.SERVER_DOWN,
+                                  identity_driver.get_user, ldap_user_id)
+            with mock.patch.object(assignment_driver.ldap_user,
+                                   'get') as get:
+                user = identity_driver.authenticate(sql_user['id'],
+                                                    password)
+                self.assertIsNone(
+                    assignment_driver._ldap_user_name(sql_user['id']))
+                # expired, but better than nothing
+                self.assertEqual(
+                    ldap_user_id,
+                    assignment_driver._ldap_user_name(ldap_user_id))
+                self.assertRaises(hybrid_common.CircuitOpen,
+                                  identity_driver.get_user, ldap_user_id)
+        self.assertEqual(sql_user['id'], user['id'])
+        self.assertFalse(get.called)
+        self.assertEqual(2, ldap_get.call_count)
+
+
+class HybridParallelFanOut(HybridTests):
+    def config_overrides(self):
+        super(HybridParallelFanOut, self).config_overrides()
+        self.config_fixture.config(group='ldap_hybrid', parallel_fanout=True)
+
+    def slow_ldap_users(self, *args, **kwargs):
+        time.sleep(1)
+        yield {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex}
+
+    def test_list_users(self):
+        ldap_user_ids = set(self.create_ldap_user() for i in range(3))
+        sql_user = self.create_sql_user()
+        user_ids = set(user['id'] for user in
+                       self.identity_api.driver.list_users(
+                           driver_hints.Hints()))
+        self.assertTrue(ldap_user_ids.issubset(user_ids))
+        self.assertIn(sql_user['id'], user_ids)
+
+    def test_list_role_assignments(self):
+        driver = self.assignment_api.driver
+        default_role = self.create_role()
+        self.config_fixture.config(group='ldap_hybrid',
+                                   default_roles=[default_role['name']])
+        user_id = self.create_ldap_user()
+        assignments = driver.list_role_assignments()
+        self.assertIn({'role_id': default_role['id'],
+                       'project_id': driver.default_project_id,
+                       'user_id': user_id}, assignments)
+
+    def test_close_stops_ldap_thread(self):
+        # more results than fit in the queue, so the thread blocks on it
+        sql_result, ldap_results = hybrid_common.fan_out(
+            lambda: [], lambda sql_result: itertools.count())
+        ldap_results.close()
+        ldap_results.job._thread.join(5)
+        self.assertFalse(ldap_results.job._thread.is_alive())
+
+    def test_ldap_timeout(self):
+        self.config_fixture.config(group='ldap_hybrid',
+                                   fanout_ldap_timeout=0.1)
+        self.create_sql_user()
+        with mock.patch.object(hybrid_common, 'iter_ldap_users',
+                               self.slow_ldap_users):
+            self.assertRaises(exception.UnexpectedError,
+                              self.identity_api.driver.list_users,
+                              driver_hints.Hints())
+
+    def test_ldap_timeout_partial_results(self):
+        self.config_fixture.config(group='ldap_hybrid',
+                                   fanout_ldap_timeout=0.1,
+                                   fanout_partial_results=True)
+        sql_user = self.create_sql_user()
+        with mock.patch.object(hybrid_common, 'iter_ldap_users',
+                               self.slow_ldap_users):
+            users = self.identity_api.driver.list_users(driver_hints.Hints())
+        self.assertIn(sql_user['id'], [user['id'] for user in users])
+
+
+class HybridMetrics(HybridTests):
+    def config_overrides(self):
+        super(HybridMetrics, self).config_overrides()
+        self.config_fixture.config(group='ldap_hybrid',
+                                   metrics_sink='registry')
+
+    def setUp(self):
+        super(HybridMetrics, self).setUp()
+        self.addCleanup(setattr, hybrid_common.METRICS, 'sink', None)
+
+    def test_calls_are_counted_by_source(self):
+        password = uuid.uuid4().hex
+        user_id = self.create_ldap_user(password=password)
+        self.identity_api.driver.authenticate(user_id, password)
+        assignment_driver = self.assignment_api.driver
+        assignment_driver._ldap_user_name(user_id)
+        assignment_driver._ldap_user_name(user_id)
+
+        snapshot = hybrid_common.METRICS.sink.snapshot()
+        timings = snapshot['timings']
+        counters = snapshot['counters']
+        self.assertEqual(1, timings['identity.authenticate']['count'])
+        self.assertEqual(1, timings['ldap.bind']['count'])
+        self.assertIn('sql.query', timings)
+        # one search by the identity and one by the assignment driver
+        self.assertEqual(2, counters['ldap.search'])
+        self.assertEqual(1, counters['cache.membership.miss'])
+        self.assertEqual(1, counters['cache.membership.hit'])
+
+
+class HybridRequestMemo(HybridTests):
+    def issue_token(self, user_id, project_id):
+        """The driver calls keystone makes for a project scoped token."""
+        identity_driver = self.identity_api.driver
+        assignment_driver = self.assignment_api.driver
+        identity_driver.get_user(user_id)
+        assignment_driver.list_project_ids_for_user(user_id, [],
+                                                    driver_hints.Hints())
+        identity_driver.get_user(user_id)
+        for i in range(3):
+            assignment_driver._get_metadata(user_id=user_id,
+                                            tenant_id=project_id)
+        identity_driver.get_user(user_id)
+
+    def count_queries(self, func):
+        queries = []
+
+        def listener(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        engine = sql.get_engine()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            func()
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    listener)
+        return len(queries)
+
+    def test_token_issue_makes_fewer_calls(self):
+        user_id = self.create_ldap_user()
+        project_id = self.assignment_api.driver.default_project_id
+        self.issue_token(user_id, project_id)
+
+        driver = self.identity_api.driver
+        with mock.patch.object(driver, '_search_ldap_user',
+                               wraps=driver._search_ldap_user) as search:
+            unscoped = self.count_queries(
+                lambda: self.issue_token(user_id, project_id))
+            self.assertEqual(3, search.call_count)
+            search.reset_mock()
+            with hybrid_common.request_scope() as memo:
+                scoped = self.count_queries(
+                    lambda: self.issue_token(user_id, project_id))
+            self.assertEqual(1, search.call_count)
+        self.assertEqual(3, memo.misses)
+        self.assertEqual(4, memo.hits)
+        self.assertLess(scoped, unscoped)
+
+    def test_results_are_copies(self):
+        user_id = self.create_ldap_user()
+        driver = self.identity_api.driver
+        with hybrid_common.request_scope():
+            driver.get_user(user_id)['name'] = 'changed'
+            self.assertEqual(user_id, driver.get_user(user_id)['name'])
+            self.assertRaises(exception.UserNotFound, driver.get_user,
+                              uuid.uuid4().hex)
+
+    def test_only_user_role_assignments_are_memoised(self):
+        user_id = self.create_ldap_user()
+        driver = self.assignment_api.driver
+        with hybrid_common.request_scope() as memo:
+            driver.list_role_assignments()
+            driver.list_role_assignments()
+            self.assertEqual((0, 0), (memo.hits, memo.misses))
+            driver.list_role_assignments(user_id=user_id)
+            driver.list_role_assignments(user_id=user_id)
+            self.assertEqual((1, 1), (memo.hits, memo.misses))
+
+    def test_middleware_scopes_read_only_requests(self):
+        memos = []
+
+        def app(environ, start_response):
+            memos.append(getattr(hybrid_common._request_local, 'memo', None))
+            return []
+
+        middleware = hybrid_common.RequestMemoMiddleware.factory({})(app)
+        middleware({'REQUEST_METHOD': 'POST',
+                    'PATH_INFO': '/v3/auth/tokens'}, None)
+        middleware({'REQUEST_METHOD': 'PATCH',
+                    'PATH_INFO': '/v3/users/123'}, None)
+        self.assertIsNotNone(memos[0])
+        self.assertIsNone(memos[1])
+        self.assertIsNone(getattr(hybrid_common._request_local, 'memo',
+                                  None))
+
+
+class HybridTrace(HybridTests):
+    def config_overrides(self):
+        super(HybridTrace, self).config_overrides()
+        fd, self.trace_file = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, self.trace_file)
+        self.config_fixture.config(group='ldap_hybrid',
+                                   trace_file=self.trace_file)
+
+    def setUp(self):
+        super(HybridTrace, self).setUp()
+        self.addCleanup(hybrid_common._replace_recorder, None)
+
+    def test_calls_are_recorded(self):
+        password = uuid.uuid4().hex
+        user_id = self.create_ldap_user(password=password)
+        driver = self.identity_api.driver
+        driver.authenticate(user_id, password)
+        self.assertRaises(AssertionError, driver.authenticate,
+                          user_id, uuid.uuid4().hex)
+        self.assignment_api.driver.list_project_ids_for_user(
+            user_id, [], driver_hints.Hints())
+
+        with open(self.trace_file) as f:
+            trace = f.read()
+        self.assertNotIn(password, trace)
+        entries = [json.loads(line) for line in trace.splitlines()]
+        logins = [e for e in entries if e['method'] == 'authenticate']
+        self.assertEqual(2, len(logins))
+        self.assertEqual('identity', logins[0]['driver'])
+        self.assertEqual({'user_id': user_id, 'password': '***'},
+                         logins[0]['args'])
+        self.assertIn('ldap', logins[0]['sources'])
+        self.assertIsNone(logins[0]['error'])
+        self.assertEqual('AssertionError', logins[1]['error'])
+        listing = entries[-1]
+        self.assertEqual('assignment', listing['driver'])
+        self.assertEqual('list_project_ids_for_user', listing['method'])
+        self.assertEqual({'__hints__': {'filters': [], 'limit': None}},
+                         listing['args']['hints'])
+
+
+    def test_reconfigure_closes_file(self):
+        hybrid_common.configure_metrics()
+        recorder = hybrid_common.METRICS.recorder
+        # configuring again with the same file keeps the recorder
+        hybrid_common.configure_metrics()
+        self.assertIs(recorder, hybrid_common.METRICS.recorder)
+        self.config_fixture.config(group='ldap_hybrid', trace_file=None)
+        hybrid_common.configure_metrics()
+        self.assertIsNone(hybrid_common.METRICS.recorder)
+        self.assertTrue(recorder._file.closed)
+
+
+class HybridMetricsSinks(tests.TestCase):
+    def test_disabled(self):
+        self.assertIsNone(hybrid_common.METRICS.sink)
+        wrapped = hybrid_common.timed('test')(lambda x: x + 1)
+        self.assertEqual(2, wrapped(1))
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        sink = hybrid_common.StatsdSink('127.0.0.1',
+                                        server.getsockname()[1], 'hybrid')
+        sink.incr('ldap.search')
+        self.assertEqual(b'hybrid.ldap.search:1|c', server.recv(512))
+        sink.timing('ldap.bind', 0.25)
+        self.assertEqual(b'hybrid.ldap.bind:250.000|ms', server.recv(512))
+
+
+class HybridRoleAssignments(HybridTests):
+    def setUp(self):
+        super(HybridRoleAssignments, self).setUp()
+        self.default_role = self.create_role()
+        self.config_fixture.config(group='ldap_hybrid',
+                                   default_roles=[self.default_role['name']])
+        self.other_role = self.create_role()
+        self.project = self.create_project()
+        self.driver = self.assignment_api.driver
+        self.default_project_id = self.driver.default_project_id
+        self.ldap_user_id = self.create_ldap_user()
+        self.assigned_ldap_user_id = self.create_ldap_user()
+        self.driver.add_role_to_user_and_project(
+            self.assigned_ldap_user_id, self.project['id'],
+            self.other_role['id'])
+        self.sql_user_id = self.create_sql_user()['id']
+        self.driver.add_role_to_user_and_project(
+            self.sql_user_id, self.project['id'], self.other_role['id'])
+        self.group_id = uuid.uuid4().hex
+        self.driver.create_grant(self.other_role['id'],
+                                 group_id=self.group_id,
+                                 project_id=self.project['id'])
+        self.driver.create_grant(self.other_role['id'],
+                                 user_id=self.ldap_user_id,
+                                 domain_id=DEFAULT_DOMAIN_ID)
+        self.driver.create_grant(self.other_role['id'],
+                                 user_id=self.sql_user_id,
+                                 domain_id=DEFAULT_DOMAIN_ID,
+                                 inherited_to_projects=True)
+
+    def default_assignment(self, user_id, project_id=None):
+        return {'role_id': self.default_role['id'],
+                'project_id': project_id or self.default_project_id,
+                'user_id': user_id}
+
+    def sql_assignments(self, **filters):
+        return sql_assign.Assignment.list_role_assignments(self.driver,
+                                                           **filters)
+
+    def assert_same_assignments(self, expected, assignments):
+        def key(assignment):
+            return json.dumps(assignment, sort_keys=True)
+
+        self.assertEqual(sorted(expected, key=key),
+                         sorted(assignments, key=key))
+
+    def assert_sql_only(self, **filters):
+        """Assert that the filters skip the directory and return SQL."""
+        with mock.patch.object(hybrid_common, 'iter_ldap_user_ids',
+                               side_effect=AssertionError):
+            assignments = self.driver.list_role_assignments(**filters)
+        self.assert_same_assignments(self.sql_assignments(**filters),
+                                     assignments)
+        return assignments
+
+    def test_defaults_of_ldap_users(self):
+        assignments = self.driver.list_role_assignments()
+        for user_id in (self.ldap_user_id, self.assigned_ldap_user_id):
+            self.assertEqual(1, assignments.count(
+                self.default_assignment(user_id)))
+        # and on the projects they have another role on
+        self.assertIn(self.default_assignment(self.assigned_ldap_user_id,
+                                              self.project['id']),
+                      assignments)
+        self.assertNotIn(self.default_assignment(self.ldap_user_id,
+                                                 self.project['id']),
+                         assignments)
+        self.assertNotIn(self.default_assignment(self.sql_user_id),
+                         assignments)
+        for assignment in self.sql_assignments():
+            self.assertIn(assignment, assignments)
+
+    def test_default_role_in_sql_is_listed_once(self):
+        self.driver.add_role_to_user_and_project(
+            self.ldap_user_id, self.default_project_id,
+            self.default_role['id'])
+        for filters in ({}, {'user_id': self.ldap_user_id}):
+            assignments = self.driver.list_role_assignments(**filters)
+            self.assertEqual(1, assignments.count(
+                self.default_assignment(self.ldap_user_id)))
+
+    def test_same_as_materialised(self):
+        def listed(**filters):
+            return sorted(
+                (a['user_id'], a['project_id'], a['role_id'])
+                for a in self.driver.list_role_assignments(**filters)
+                if 'user_id' in a and 'project_id' in a)
+
+        filters = [{}, {'user_id': self.assigned_ldap_user_id},
+                   {'project_ids': [self.project['id']]},
+                   {'role_id': self.default_role['id']}]
+        expected = [listed(**f) for f in filters]
+        hybrid_common.materialise_assignments(self.driver)
+        self.config_fixture.config(group='ldap_hybrid',
+                                   trust_materialised_assignments=True)
+        self.assertEqual(expected, [listed(**f) for f in filters])
+
+    def test_role_filter(self):
+        assignments = self.driver.list_role_assignments(
+            role_id=self.default_role['id'])
+        self.assertIn(self.default_assignment(self.ldap_user_id),
+                      assignments)
+        self.assertEqual([], [a for a in assignments
+                              if a['role_id'] != self.default_role['id']])
+        self.assertNotEqual(
+            [], self.assert_sql_only(role_id=self.other_role['id']))
+
+    def test_project_filter(self):
+        assignments = self.driver.list_role_assignments(
+            project_ids=[self.default_project_id])
+        self.assertIn(self.default_assignment(self.ldap_user_id),
+                      assignments)
+        self.assertEqual([], [a for a in assignments
+                              if a['project_id'] != self.default_project_id])
+        # only the members of the project are looked at
+        with mock.patch.object(hybrid_common, 'iter_ldap_user_ids',
+                               side_effect=AssertionError):
+            assignments = self.driver.list_role_assignments(
+                project_ids=[self.project['id']])
+        self.assert_same_assignments(
+            self.sql_assignments(project_ids=[self.project['id']]) +
+            [self.default_assignment(self.assigned_ldap_user_id,
+                                     self.project['id'])],
+            assignments)
+
+    def test_domain_filter(self):
+        self.assertNotEqual(
+            [], self.assert_sql_only(domain_id=DEFAULT_DOMAIN_ID))
+
+    def test_inherited_filter(self):
+        self.assertNotEqual(
+            [], self.assert_sql_only(inherited_to_projects=True))
+
+    def test_group_filter(self):
+        assignments = self.assert_sql_only(group_ids=[self.group_id])
+        self.assertEqual([self.group_id],
+                         [a['group_id'] for a in assignments])
+
+    def test_sql_user_filter(self):
+        self.assertNotEqual(
+            [], self.assert_sql_only(user_id=self.sql_user_id))
+
+    def test_ldap_user_filter(self):
+        assignments = self.driver.list_role_assignments(
+            user_id=self.ldap_user_id)
+        self.assertIn(self.default_assignment(self.ldap_user_id),
+                      assignments)
+        self.assertEqual(set([self.ldap_user_id]),
+                         set(a['user_id'] for a in assignments))
+        # the SQL assignment adds the default roles on its project
+        assignments = self.driver.list_role_assignments(
+            user_id=self.assigned_ldap_user_id)
+        self.assert_same_assignments(
+            self.sql_assignments(user_id=self.assigned_ldap_user_id) +
+            [self.default_assignment(self.assigned_ldap_user_id),
+             self.default_assignment(self.assigned_ldap_user_id,
+                                     self.project['id'])],
+            assignments)
+
+
+class HybridJsonAssignment(HybridTests):
+    def config_overrides(self):
+        super(HybridJsonAssignment, self).config_overrides()
+        fd, self.map_path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, self.map_path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({}, f)
+        self.config_fixture.config(
+            group='assignment',
+            driver='keystone.assignment.backends.hybrid_json_assignment.'
+                   'Assignment')
+        self.config_fixture.config(group='ldap_hybrid',
+                                   user_project_map=self.map_path)
+
+    def setUp(self):
+        super(HybridJsonAssignment, self).setUp()
+        self.default_role = self.create_role()
+        self.config_fixture.config(group='ldap_hybrid',
+                                   default_roles=[self.default_role['name']])
+        self.mapped_project = self.create_project()
+        self.user_name = uuid.uuid4().hex
+        self.user_id = self.create_ldap_user(name=self.user_name)
+        with open(self.map_path, 'w') as f:
+            json.dump({self.user_name: [self.mapped_project['name']]}, f)
+        self.driver = self.assignment_api.driver
+        self.driver.userprojectmap = hybrid_json_assignment.UserProjectMap(
+            self.map_path, hybrid_json_assignment.resolve_project_names)
+
+    def listed_project_ids(self, **filters):
+        return set(a['project_id']
+                   for a in self.driver.list_role_assignments(**filters)
+                   if a.get('user_id') == self.user_id and
+                   a['role_id'] == self.default_role['id'])
+
+    def assert_paths_agree(self, expected, **filters):
+        self.assertEqual(expected, self.listed_project_ids(**filters))
+        self.assertEqual(expected, set(self.driver.list_project_ids_for_user(
+            self.user_id, [], driver_hints.Hints())))
+        for project_id in expected:
+            roles = self.driver._get_metadata(user_id=self.user_id,
+                                              tenant_id=project_id)['roles']
+            self.assertIn({'id': self.default_role['id']}, roles)
+
+    def test_map_projects_are_listed(self):
+        default_project_id = self.driver.default_project_id
+        self.assert_paths_agree(set([default_project_id,
+                                     self.mapped_project['id']]))
+        self.assertEqual(set([default_project_id]),
+                         self.listed_project_ids(
+                             user_id=self.user_id,
+                             project_ids=[default_project_id]))
+
+    def test_project_filter_skips_directory(self):
+        other_role = self.create_role()
+        sql_member_id = self.create_ldap_user()
+        self.driver.add_role_to_user_and_project(
+            sql_member_id, self.mapped_project['id'], other_role['id'])
+        self.create_ldap_user()
+        empty_project = self.create_project()
+        with mock.patch.object(hybrid_common, 'iter_ldap_user_names',
+                               side_effect=AssertionError):
+            assignments = self.driver.list_role_assignments(
+                project_ids=[self.mapped_project['id']])
+            with mock.patch.object(hybrid_common, 'iter_ldap_entries',
+                                   side_effect=AssertionError):
+                self.assertEqual([], self.driver.list_role_assignments(
+                    project_ids=[empty_project['id']]))
+        self.assertEqual(set([self.user_id, sql_member_id]),
+                         set(a['user_id'] for a in assignments
+                             if a['role_id'] == self.default_role['id']))
+
+    def test_index(self):
+        self.config_fixture.config(group='ldap_hybrid',
+                                   effective_assignment_index=True)
+        expected = set([self.driver.default_project_id,
+                        self.mapped_project['id']])
+        self.assert_paths_agree(expected)
+        self.assertEqual(set([self.mapped_project['id']]),
+                         self.listed_project_ids(
+                             project_ids=[self.mapped_project['id']]))
+
+        # a SQL assignment adds the default roles on its project as well,
+        # and the index follows it without a rebuild
+        other_project = self.create_project()
+        other_role = self.create_role()
+        with mock.patch.object(hybrid_common, 'iter_ldap_user_names') as names:
+            self.driver.add_role_to_user_and_project(
+                self.user_id, other_project['id'], other_role['id'])
+            self.assertEqual(set([other_project['id']]),
+                             self.listed_project_ids(
+                                 project_ids=[other_project['id']]))
+        self.assertFalse(names.called)
+        expected.add(other_project['id'])
+        self.assert_paths_agree(expected)
+
+
+class HybridMaterialisedAssignments(HybridTests):
+    def roles(self, user_id, project_id):
+        metadata = self.assignment_api.driver._get_metadata(
+            user_id=user_id, tenant_id=project_id)
+        return sorted(role['id'] for role in metadata['roles'])
+
+    def test_materialise_and_trust(self):
+        driver = self.assignment_api.driver
+        user_id = self.create_ldap_user()
+        role = self.create_role()
+        project = self.create_project()
+        driver.add_role_to_user_and_project(user_id, project['id'],
+                                            role['id'])
+        default_project_id = driver.default_project_id
+        expected = dict((project_id, self.roles(user_id, project_id))
+                        for project_id in (default_project_id,
+                                           project['id']))
+        project_ids = sorted(driver.list_project_ids_for_user(
+            user_id, [], driver_hints.Hints()))
+
+        defaults = len(driver.default_roles)
+        self.assertEqual((2 * defaults, 0),
+                         hybrid_common.materialise_assignments(driver))
+        self.assertEqual((0, 0),
+                         hybrid_common.materialise_assignments(driver))
+
+        self.config_fixture.config(group='ldap_hybrid',
+                                   trust_materialised_assignments=True)
+        driver.invalidate_ldap_user()
+        with mock.patch.object(driver.ldap_user, 'get') as get:
+            for project_id, roles in expected.items():
+                self.assertEqual(roles, self.roles(user_id, project_id))
+            self.assertEqual(project_ids, sorted(
+                driver.list_project_ids_for_user(user_id, [],
+                                                 driver_hints.Hints())))
+        self.assertFalse(get.called)
+
+    def test_revoked_role_removes_defaults(self):
+        driver = self.assignment_api.driver
+        user_id = self.create_ldap_user()
+        role = self.create_role()
+        project = self.create_project()
+        driver.add_role_to_user_and_project(user_id, project['id'],
+                                            role['id'])
+        hybrid_common.materialise_assignments(driver)
+        driver.remove_role_from_user_and_project(user_id, project['id'],
+                                                 role['id'])
+        # removed with the role, not only by the next run
+        self.config_fixture.config(group='ldap_hybrid',
+                                   trust_materialised_assignments=True)
+        self.assertRaises(exception.MetadataNotFound, self.roles,
+                          user_id, project['id'])
+        self.assertNotEqual([], self.roles(user_id,
+                                           driver.default_project_id))
+        defaults = len(driver.default_roles)
+        self.assertEqual((0, 0),
+                         hybrid_common.materialise_assignments(driver))
+        self.assertEqual((defaults, defaults),
+                         hybrid_common.materialise_assignments(driver,
+                                                               rebuild=True))
+
+    def test_concurrent_grant_is_left_alone(self):
+        driver = self.assignment_api.driver
+        user_id = self.create_ldap_user()
+        role_id = driver.default_roles[0]
+        iter_implicit_assignments = driver.iter_implicit_assignments
+
+        def grant_meanwhile(sql_project_ids):
+            driver.add_role_to_user_and_project(
+                user_id, driver.default_project_id, role_id)
+            return iter_implicit_assignments(sql_project_ids)
+
+        with mock.patch.object(driver, 'iter_implicit_assignments',
+                               grant_meanwhile):
+            hybrid_common.materialise_assignments(driver)
+        tracked = sql.get_session().query(
+            hybrid_common.MaterialisedAssignment).filter_by(
+                user_id=user_id, project_id=driver.default_project_id,
+                role_id=role_id).count()
+        self.assertEqual(0, tracked)
+
+
+class HybridMetadataBatch(HybridTests):
+    def test_batch_matches_single_calls(self):
+        driver = self.assignment_api.driver
+        default_role = self.create_role()
+        self.config_fixture.config(group='ldap_hybrid',
+                                   default_roles=[default_role['name']])
+        other_role = self.create_role()
+        project = self.create_project()
+        ldap_user_id = self.create_ldap_user()
+        sql_user_id = self.identity_api.create_user(
+            {'name': uuid.uuid4().hex, 'domain_id': DEFAULT_DOMAIN_ID,
+             'enabled': True})['id']
+        for user_id in (ldap_user_id, sql_user_id):
+            self.assignment_api.add_role_to_user_and_project(
+                user_id, project['id'], other_role['id'])
+
+        pairs = [(user_id, project_id)
+                 for user_id in (ldap_user_id, sql_user_id)
+                 for project_id in (driver.default_project_id,
+                                    project['id'])]
+        expected = {}
+        for user_id, project_id in pairs:
+            try:
+                expected[(user_id, project_id)] = driver._get_metadata(
+                    user_id=user_id, tenant_id=project_id)
+            except exception.MetadataNotFound:
+                pass
+        # the SQL user has no role on the default project
+        self.assertEqual(3, len(expected))
+
+        def sorted_roles(metadata):
+            return dict((pair, sorted(res['roles'], key=lambda r: r['id']))
+                        for pair, res in metadata.items())
+
+        driver.invalidate_ldap_user()
+        self.assertEqual(sorted_roles(expected),
+                         sorted_roles(driver.get_metadata_batch(pairs)))
+
+
+class HybridResolvedDefaults(HybridTests):
+    def test_defaults_are_cached(self):
+        defaults = self.assignment_api.driver.defaults
+        resource_driver = defaults.resource_driver
+        with mock.patch.object(
+                resource_driver, 'get_project_by_name',
+                wraps=resource_driver.get_project_by_name) as get_project:
+            project_id = defaults.project_id
+            self.assertEqual(project_id, defaults.project_id)
+            self.assertEqual([{'id': role_id}
+                              for role_id in defaults.role_ids],
+                             defaults.role_refs)
+            # callers get their own copies
+            defaults.role_refs[0]['id'] = 'changed'
+            defaults.project['id'] = 'changed'
+            self.assertEqual(project_id, defaults.project_id)
+            self.assertNotIn({'id': 'changed'}, defaults.role_refs)
+        self.assertEqual(1, get_project.call_count)
+
+    def test_failed_lookup_backs_off(self):
+        self.config_fixture.config(group='ldap_hybrid',
+                                   default_project=uuid.uuid4().hex)
+        defaults = self.assignment_api.driver.defaults
+        resource_driver = defaults.resource_driver
+        with mock.patch.object(
+                resource_driver, 'get_project_by_name',
+                wraps=resource_driver.get_project_by_name) as get_project:
+            for i in range(3):
+                self.assertRaises(exception.ProjectNotFound,
+                                  getattr, defaults, 'project_id')
+        self.assertEqual(1, get_project.call_count)
+
+    def test_project_rename_invalidates(self):
+        driver = self.assignment_api.driver
+        project = driver.default_project
+        self.assignment_api.update_project(
+            project['id'], {'name': uuid.uuid4().hex})
+        self.assertRaises(exception.ProjectNotFound,
+                          getattr, driver, 'default_project_id')
+
+
+class HybridUserProjectMap(tests.TestCase):
+    def setUp(self):
+        super(HybridUserProjectMap, self).setUp()
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.projects = {'p1': 'id1', 'p2': 'id2', 'p3': 'id3'}
+        self.resolved = []
+
+    def resolve(self, names):
+        self.resolved.append(set(names))
+        return dict((name, self.projects[name]) for name in names
+                    if name in self.projects)
+
+    def write_map(self, usermap, mtime):
+        with open(self.path, 'w') as f:
+            json.dump(usermap, f)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_names_resolved_at_once(self):
+        self.write_map({'alice': ['p1', 'p2'], 'bob': ['p2', 'nope']}, 1000)
+        usermap = hybrid_json_assignment.UserProjectMap(self.path,
+                                                        self.resolve)
+        self.assertEqual([set(['p1', 'p2', 'nope'])], self.resolved)
+        self.assertEqual(set(['id1', 'id2']), usermap.get('alice'))
+        self.assertEqual(set(['id2']), usermap.get('bob'))
+        self.assertNotIn('carol', usermap)
+
+    def test_equal_project_sets_are_shared(self):
+        self.write_map({'alice': ['p1', 'p2'], 'bob': ['p2', 'p1'],
+                        'carol': ['p1', 'p2']}, 1000)
+        usermap = hybrid_json_assignment.UserProjectMap(self.path,
+                                                        self.resolve)
+        self.assertIs(usermap.get('alice'), usermap.get('bob'))
+        self.assertIs(usermap.get('alice'), usermap.get('carol'))
+
+    def test_users_of_project(self):
+        self.write_map({'alice': ['p1', 'p2'], 'bob': ['p2']}, 1000)
+        usermap = hybrid_json_assignment.UserProjectMap(self.path,
+                                                        self.resolve)
+        self.assertEqual(['alice'], list(usermap.users_of('id1')))
+        self.assertEqual(set(['alice', 'bob']), set(usermap.users_of('id2')))
+        self.assertEqual((), usermap.users_of('id3'))
+
+    def test_yaml(self):
+        with open(self.path, 'w') as f:
+            f.write('alice:\n  - p1\n')
+        usermap = hybrid_json_assignment.UserProjectMap(
+            self.path, self.resolve, file_format='yaml')
+        self.assertEqual(set(['id1']), usermap.get('alice'))
+
+    def test_reload_on_change(self):
+        self.write_map({'alice': ['p1']}, 1000)
+        usermap = hybrid_json_assignment.UserProjectMap(
+            self.path, self.resolve, check_interval=1)
+        self.write_map({'alice': ['p3']}, 2000)
+        usermap._next_check = 0
+        self.assertEqual(set(['id3']), usermap.get('alice'))
+
+    def test_compiled_index(self):
+        self.write_map({'alice': ['p1', 'p2'], 'bob': ['p2'], 'carol': []},
+                       1000)
+        usermap = hybrid_json_assignment.UserProjectMap(self.path,
+                                                        self.resolve)
+        index_path = self.path + '.idx'
+        self.addCleanup(os.remove, index_path)
+        hybrid_json_assignment.compile_user_project_map(usermap.items(),
+                                                        index_path)
+        mapped = hybrid_json_assignment.MappedUserProjectMap(index_path)
+        self.assertEqual(3, len(mapped))
+        for user in ('alice', 'bob', 'carol'):
+            self.assertEqual(usermap.get(user), mapped.get(user))
+        self.assertNotIn('dave', mapped)
+        self.assertEqual(sorted(usermap.items()), sorted(mapped.items()))
+        for project_id in ('id1', 'id2', 'id3'):
+            self.assertEqual(sorted(usermap.users_of(project_id)),
+                             sorted(mapped.users_of(project_id)))
+
+    def test_broken_file_keeps_previous_map(self):
+        self.write_map({'alice': ['p1']}, 1000)
+        usermap = hybrid_json_assignment.UserProjectMap(
+            self.path, self.resolve, check_interval=1)
+        with open(self.path, 'w') as f:
+            f.write('{"alice": [')
+        os.utime(self.path, (2000, 2000))
+        usermap._next_check = 0
+        self.assertEqual(set(['id1']), usermap.get('alice'))
+
+
+class HybridLRUCache(tests.TestCase):
+    def test_hit_miss_and_eviction(self):
+        cache = hybrid_common.LRUCache(2, 60)
+        self.assertIs(hybrid_common.MISSING, cache.get('a'))
+        cache.set('a', 'ldap-user')
+        cache.set('b', None)
+        self.assertEqual('ldap-user', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        # 'a' was used more recently than 'b', so 'b' gets evicted
+        cache.get('a')
+        cache.set('c', 'other')
+        self.assertIs(hybrid_common.MISSING, cache.get('b'))
+        self.assertEqual({'size': 2, 'hits': 3, 'misses': 2,
+                          'evictions': 1}, cache.stats())
+
+    def test_expiry_and_invalidation(self):
+        cache = hybrid_common.LRUCache(10, 60)
+        cache.set('a', 'x', ttl=-1)
+        self.assertIs(hybrid_common.MISSING, cache.get('a'))
+        cache.set('b', 'y')
+        cache.invalidate('b')
+        self.assertIs(hybrid_common.MISSING, cache.get('b'))
+        cache.set('c', 'z')
+        cache.invalidate()
+        self.assertEqual(0, len(cache))
+
+    def test_disabled(self):
+        cache = hybrid_common.LRUCache(0, 60)
+        cache.set('a', 'x')
+        self.assertIs(hybrid_common.MISSING, cache.get('a'))
+
+
+class HybridLatencyStats(tests.TestCase):
+    def test_stats(self):
+        stats = hybrid_common.LatencyStats(window=100)
+        for ms in range(1, 101):
+            stats.record(ms / 1000.0)
+        summary = stats.stats()
+        self.assertEqual(100, summary['count'])
+        self.assertAlmostEqual(0.0505, summary['mean'])
+        self.assertEqual(0.1, summary['max'])
+        self.assertEqual(0.051, summary['p50'])
+        self.assertEqual(0.099, summary['p99'])